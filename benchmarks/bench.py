@@ -0,0 +1,315 @@
+"""
+Regent benchmarks
+
+Starts a service on a temporary socket and measures request latency and
+throughput with trivial, CPU-bound and sleep-bound operations, the cost of a
+connection, and the cost per byte of payload.
+
+Usage::
+
+    python benchmarks/bench.py
+    python benchmarks/bench.py --threads 8 --save baseline.json
+    python benchmarks/bench.py --threads 8 --compare baseline.json
+
+The working copy of ``regent`` is imported, rather than any installed version.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from regent.client import Client  # noqa: E402
+from regent.service import AsyncService, Operation, Service  # noqa: E402
+
+
+SECRET = "benchmark"
+
+PAYLOAD_SIZES = [16, 1024, 64 * 1024, 1024 * 1024]
+
+
+class Noop(Operation):
+    def perform(self):
+        return None
+
+
+class Echo(Operation):
+    def prepare(self, data):
+        self.data = data
+
+    def perform(self):
+        return self.data
+
+
+class Cpu(Operation):
+    def prepare(self, data):
+        self.n = int(data or 10000)
+
+    def perform(self):
+        total = 0
+        for i in range(self.n):
+            total += i * i
+        return total
+
+
+class Sleep(Operation):
+    def prepare(self, data):
+        self.seconds = float(data or 0.01)
+
+    def perform(self):
+        time.sleep(self.seconds)
+
+
+def serve(socket_path, options):
+    """
+    Run the service - called in a child process
+    """
+    cls = AsyncService if options["async"] else Service
+    service = cls(
+        socket_path=socket_path,
+        socket_secret=SECRET,
+        threads=options["threads"],
+    )
+    service.register("noop", Noop)
+    service.register("echo", Echo)
+    service.register("cpu", Cpu)
+    service.register("sleep", Sleep)
+    service.listen()
+
+
+def start_service(socket_path, options):
+    process = multiprocessing.Process(
+        target=serve,
+        args=(socket_path, options),
+        daemon=True,
+    )
+    process.start()
+
+    # Wait for the socket
+    client = Client(socket_path, SECRET)
+    deadline = time.monotonic() + 10
+    while 1:
+        try:
+            client.request("noop")
+            break
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            client.reset()
+            time.sleep(0.05)
+    return process
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = min(int(len(values) * pct / 100), len(values) - 1)
+    return values[index]
+
+
+def drive(socket_path, options, op_name, data, clients, requests, keepalive=True):
+    """
+    Call the operation from several client threads
+
+    Returns a summary of latencies and throughput
+    """
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    per_client = max(requests // clients, 1)
+
+    def worker():
+        client = Client(
+            socket_path,
+            SECRET,
+            socket_timeout=60,
+            keepalive=keepalive,
+            codec=options["codec"],
+        )
+        mine = []
+        for _ in range(per_client):
+            start = time.perf_counter()
+            response = client.request(op_name, data)
+            mine.append(time.perf_counter() - start)
+            if "error" in response:
+                errors.append(response["error"])
+        if keepalive:
+            client.close()
+        with lock:
+            latencies.extend(mine)
+
+    threads = [threading.Thread(target=worker) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    if errors:
+        raise RuntimeError("{} errors, eg: {}".format(len(errors), errors[0]))
+
+    return {
+        "requests": len(latencies),
+        "rps": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+def connection_cost(socket_path, options):
+    """
+    Return the cost of a connection in microseconds, as the difference between
+    the median p50 latencies of one-shot and keep-alive requests
+
+    The two are interleaved over several runs, so drift in the machine's load
+    affects both equally.
+    """
+    requests = options["requests"]
+    keepalive = []
+    one_shot = []
+    for _ in range(options["repeats"]):
+        keepalive.append(
+            drive(socket_path, options, "noop", None, 1, requests)["p50_ms"]
+        )
+        one_shot.append(
+            drive(socket_path, options, "noop", None, 1, requests, keepalive=False)[
+                "p50_ms"
+            ]
+        )
+    costs = [(shot - alive) * 1000 for shot, alive in zip(one_shot, keepalive)]
+    return {
+        "cost": (statistics.median(one_shot) - statistics.median(keepalive)) * 1000,
+        "min": min(costs),
+        "max": max(costs),
+    }
+
+
+def run(socket_path, options):
+    """
+    Run all benchmarks and return the results
+    """
+    clients = options["clients"]
+    requests = options["requests"]
+    results = {}
+
+    # Warm up the service, client and caches before measuring anything
+    if options["warmup"]:
+        drive(socket_path, options, "noop", None, 1, options["warmup"])
+        drive(socket_path, options, "noop", None, 1, options["warmup"], False)
+
+    results["noop serial"] = drive(socket_path, options, "noop", None, 1, requests)
+    results["noop concurrent"] = drive(
+        socket_path, options, "noop", None, clients, requests
+    )
+    results["cpu concurrent"] = drive(
+        socket_path, options, "cpu", 10000, clients, requests // 4
+    )
+    results["sleep concurrent"] = drive(
+        socket_path, options, "sleep", 0.01, clients, requests // 10
+    )
+
+    # Connection cost is the difference between one-shot and keep-alive
+    results["noop one-shot"] = drive(
+        socket_path, options, "noop", None, 1, requests, keepalive=False
+    )
+    results["connection_us"] = connection_cost(socket_path, options)
+
+    # Cost per byte is the slope between the smallest and largest payloads
+    for size in PAYLOAD_SIZES:
+        count = max(min(requests, 64 * 1024 * 1024 // size), 20)
+        results["echo {}B".format(size)] = drive(
+            socket_path, options, "echo", "x" * size, 1, count
+        )
+    smallest = results["echo {}B".format(PAYLOAD_SIZES[0])]["p50_ms"]
+    largest = results["echo {}B".format(PAYLOAD_SIZES[-1])]["p50_ms"]
+    results["byte_ns"] = {
+        "cost": (largest - smallest) * 1e6 / (PAYLOAD_SIZES[-1] - PAYLOAD_SIZES[0]) / 2,
+    }
+
+    return results
+
+
+def report(results, baseline=None):
+    """
+    Print the results, with the change from the baseline if given
+    """
+    for name, metrics in results.items():
+        parts = []
+        for key, value in metrics.items():
+            part = "{}={:.3f}".format(key, value)
+            if baseline and name in baseline and key in baseline[name]:
+                old = baseline[name][key]
+                if old:
+                    part += " ({:+.1f}%)".format((value - old) / old * 100)
+            parts.append(part)
+        print("{:<20} {}".format(name, "  ".join(parts)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark a regent service")
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--async", action="store_true", dest="use_async")
+    parser.add_argument("--codec", default=None)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument(
+        "--warmup", type=int, default=200, help="Requests to send before measuring"
+    )
+    parser.add_argument(
+        "--repeats", type=int, default=5, help="Runs to take the median of"
+    )
+    parser.add_argument("--save", metavar="PATH", help="Save results as a baseline")
+    parser.add_argument("--compare", metavar="PATH", help="Compare with a baseline")
+    args = parser.parse_args()
+
+    options = {
+        "threads": args.threads,
+        "async": args.use_async,
+        "codec": args.codec,
+        "clients": args.clients,
+        "requests": args.requests,
+        "warmup": args.warmup,
+        "repeats": args.repeats,
+    }
+
+    tmp_dir = tempfile.mkdtemp(prefix="regent-bench-")
+    socket_path = os.path.join(tmp_dir, "bench.sock")
+    process = start_service(socket_path, options)
+    try:
+        results = run(socket_path, options)
+    finally:
+        process.terminate()
+        process.join()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            saved = json.load(file)
+        baseline = saved["results"]
+        if saved["options"] != options:
+            print("Warning: baseline was run with different options")
+
+    print(
+        "Python {} on {}, options: {}".format(
+            platform.python_version(), platform.platform(), options
+        )
+    )
+    report(results, baseline)
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump({"options": options, "results": results}, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
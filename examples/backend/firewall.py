@@ -6,59 +6,62 @@ Assumes firewall is ufw
 Test with:
     {"secret": "123456", "op": "open", "data": {"ip": "192.168.0.1"}}
     {"secret": "123456", "op": "close", "data": {"ip": "192.168.0.1"}}
+    {"secret": "123456", "op": "status"}
+    {"secret": "123456", "batch": [{"op": "open", "data": {"ip": "8.8.8.8"}}, {"op": "open", "data": {"ip": "8.8.4.4"}}]}
 """
-import ipaddress
-
 from regent.service import Operation, Service
+from regent.service.command import Command
+from regent.service.schema import IPAddress
 
 
-class FirewallOpen(Operation):
-    PORTS = [22]
-    COMMAND = "ufw allow proto tcp from {ip} to any port {port}"
+# Give up on ufw after 30 seconds, and only run one at a time
+UFW = Command(["ufw"], timeout=30, limit=1)
 
-    def prepare(self, data):
-        """
-        Validate the input and prepare the safe context
-        """
-        ip = data.get("ip")
-        if not ip:
-            raise ValueError("Missing IP")
 
-        try:
-            addr = ipaddress.ip_address(ip)
-        except ValueError:
-            raise ValueError("Invalid IP")
+class FirewallStatus(Operation):
+    # Cache the rules until they are changed
+    cache_ttl = 300
 
-        if not addr.version == 4:
-            raise ValueError("IPv4 only")
+    def perform(self):
+        """
+        List the firewall rules
+        """
+        return UFW.run("status").stdout
 
-        if addr.is_private or addr.is_multicast:
-            raise ValueError("IP not allowed")
 
-        self.ip = ip
+class FirewallOpen(Operation):
+    PORTS = [22]
+    COMMAND = "allow proto tcp from {ip} to any port {port}"
+    invalidates = ["status"]
+
+    # Validate the input - the default prepare() sets self.ip
+    schema = {
+        "ip": IPAddress(
+            version=4,
+            allow_private=False,
+            allow_multicast=False,
+        ),
+    }
 
     def perform(self):
         """
         Open the firewall
         """
-        from subprocess import call
-
         for port in self.PORTS:
             cmd = self.COMMAND.format(ip=self.ip, port=port)
-            print(cmd)
-            ok = call(cmd.split(" "))
-            if ok != 0:
-                raise ValueError("Failed to change firewall")
+            UFW.run(*cmd.split(" "))
 
 
 class FirewallClose(FirewallOpen):
-    COMMAND = "ufw delete allow proto tcp from {ip} to any port {port}"
+    COMMAND = "delete allow proto tcp from {ip} to any port {port}"
 
 
 service = Service(
     socket_path="/tmp/regent-firewall.sock",
     socket_secret="123456",
+    threads=4,
 )
 service.register("open", FirewallOpen)
 service.register("close", FirewallClose)
+service.register("status", FirewallStatus)
 service.listen()
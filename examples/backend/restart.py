@@ -1,24 +1,16 @@
 """
 Restart the machine
 """
-from subprocess import call
-
 from regent.service import Operation, Service, auth
+from regent.service.command import run
+from regent.service.schema import Choice
 
 
 class Restart(Operation):
-    def prepare(self, data):
-        """
-        Validate the input and prepare the safe context
-        """
-        service_name = data.get("service_name")
-        if not service_name:
-            raise ValueError("Missing service name")
-
-        if service_name not in ["nginx", "supervisor"]:
-            raise ValueError("Unexpected service name")
-
-        self.service_name = service_name
+    # Validate the input - the default prepare() sets self.service_name
+    schema = {
+        "service_name": Choice(["nginx", "supervisor"]),
+    }
 
     def auth(self):
         """
@@ -57,7 +49,7 @@ class Restart(Operation):
         """
         Perform the operation on the service name from the context
         """
-        call(["service", "restart", self.service_name])
+        run(["service", "restart", self.service_name], timeout=120)
 
 
 service = Service(
@@ -6,16 +6,17 @@ See which user the service is running as
 Test with:
     {"secret": "123456", "op": "whoami"}
 """
-import subprocess
-
 from regent.service import Operation, Service
+from regent.service.command import run
 
 
 class WhoAmI(Operation):
+    # Answer simultaneous requests with one subprocess, and remember the answer
+    coalesce = True
+    cache_ttl = 60
+
     def perform(self):
-        value = subprocess.check_output("whoami")
-        value = value.strip().decode("utf-8")
-        return value
+        return run("whoami", timeout=5).stdout.strip()
 
 
 service = Service(
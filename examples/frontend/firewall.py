@@ -7,25 +7,32 @@ import time
 from regent.client import Client
 
 
+IPS = ["8.8.8.8", "8.8.4.4"]
+
+
+def change(op_name, label):
+    # Send all IPs in one request
+    responses = client.request_many([(op_name, {"ip": ip}) for ip in IPS])
+    failed = False
+    for ip, response in zip(IPS, responses):
+        if response.get("success"):
+            print("Firewall {} for {}".format(label, ip))
+        else:
+            print("Error for {}: {}".format(ip, response.get("error")))
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
 client = Client(
     socket_path="/tmp/regent-firewall.sock",
     socket_secret="123456",
 )
 
-response = client.request("open", {"ip": "8.8.8.8"})
-if response.get("success"):
-    print("Firewall open")
-else:
-    print("Error: {}".format(response.get("error")))
-    sys.exit(1)
+change("open", "open")
 client.close()
 
 time.sleep(5)
 
 client.reset()
-response = client.request("close", {"ip": "8.8.8.8"})
-if response.get("success"):
-    print("Firewall closed")
-else:
-    print("Error: {}".format(response.get("error")))
-    sys.exit(1)
+change("close", "closed")
@@ -1,4 +1,6 @@
 """
 Regent frontend
 """
+from .async_client import AsyncClient  # noqa
 from .client import Client  # noqa
+from .pool import ClientPool  # noqa
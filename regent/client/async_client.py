@@ -0,0 +1,106 @@
+"""
+Send a request to a service from an asyncio event loop
+"""
+import asyncio
+import time
+
+from ..constants import SOCKET_MAX_SIZE, SOCKET_TIMEOUT
+from ..exceptions import ProcessError, SocketError
+from ..socket import AsyncSocket
+from .client import FINISHED, Requests, batch_request, batch_responses, poll_delays
+
+
+class AsyncClient(Requests):
+    def __init__(
+        self,
+        socket_path,
+        socket_secret,
+        socket_timeout=SOCKET_TIMEOUT,
+        socket_max_size=SOCKET_MAX_SIZE,
+        codec=None,
+    ):
+        self.socket_path = socket_path
+        self.socket_secret = socket_secret
+        self.socket_timeout = socket_timeout
+        self.socket_max_size = socket_max_size
+        self.codec = codec
+
+    def envelope(self):
+        """
+        Return the secret, and the deadline after which the client will have
+        stopped waiting for the response, to send with a request
+        """
+        out = {"secret": self.socket_secret}
+        if self.socket_timeout is not None:
+            out["deadline"] = time.time() + self.socket_timeout
+        return out
+
+    async def request_many(self, requests, parallel=False):
+        """
+        Async equivalent of ``Client.request_many()``
+        """
+        requests = list(requests)
+        response = await self.call_service(batch_request(requests, parallel))
+        return batch_responses(response, len(requests))
+
+    async def wait(self, job_id, timeout=None, interval=1):
+        """
+        Async equivalent of ``Client.wait()``
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for delay in poll_delays(interval):
+            response = await self.poll(job_id)
+            if "error" in response or response["data"]["status"] in FINISHED:
+                return response
+            if deadline is not None and time.monotonic() + delay > deadline:
+                raise SocketError("Timed out waiting for job")
+            await asyncio.sleep(delay)
+
+    async def stream(self, op_name, data=None):
+        """
+        Request an operation which yields its result, and iterate over the
+        chunks as they arrive
+
+        Raises ``ProcessError`` if the operation fails
+        """
+        out = self.envelope()
+        out.update(op=op_name, data=data, stream=True)
+
+        socket = await AsyncSocket.connect(
+            self.socket_path,
+            self.socket_timeout,
+            self.socket_max_size,
+            self.codec,
+        )
+        try:
+            await socket.write(out)
+            while 1:
+                message = await socket.read()
+                if "chunk" not in message:
+                    break
+                yield message["chunk"]
+        finally:
+            await socket.close()
+
+        if "error" in message:
+            raise ProcessError(message["error"])
+
+    async def call_service(self, data):
+        """
+        Write to and read from the service
+        """
+        out = self.envelope()
+        out.update(data)
+
+        socket = await AsyncSocket.connect(
+            self.socket_path,
+            self.socket_timeout,
+            self.socket_max_size,
+            self.codec,
+        )
+        try:
+            await socket.write(out)
+            response = await socket.read()
+        finally:
+            await socket.close()
+        return response
@@ -1,18 +1,83 @@
 """
 Send a request to a service
 """
-from ..constants import SOCKET_TIMEOUT
+import itertools
+import time
+from collections import deque
+
+from ..constants import SOCKET_MAX_SIZE, SOCKET_TIMEOUT
+from ..exceptions import ProcessError, SocketError
 from ..socket import Socket
 
 
-class Client(object):
-    def __init__(
-        self,
-        socket_path,
-        socket_secret,
-        socket_timeout=SOCKET_TIMEOUT,
-    ):
-        self.socket = Socket(socket_path, socket_secret, socket_timeout)
+#: Statuses of background operations which have finished
+FINISHED = ("done", "failed")
+
+
+def poll_delays(interval):
+    """
+    Generate delays between polls, backing off up to ``interval`` seconds
+    """
+    delay = min(0.05, interval)
+    while 1:
+        yield delay
+        delay = min(delay * 2, interval)
+
+
+def batch_request(requests, parallel):
+    """
+    Build a batch request from ``(op_name, data)`` pairs
+    """
+    return {
+        "batch": [{"op": op_name, "data": data} for op_name, data in requests],
+        "parallel": parallel,
+    }
+
+
+def batch_responses(response, count):
+    """
+    Return the list of item responses from a batch response
+    """
+    if "error" in response:
+        return [dict(response) for _ in range(count)]
+    return response["data"]
+
+
+class Stream(object):
+    """
+    Iterator over the chunks of a streamed response
+
+    Once it is exhausted, ``response`` holds the final response, which will
+    have a ``uid`` if the operation is waiting for authorisation. If the
+    operation fails, ``ProcessError`` is raised.
+    """
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.response = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        message = next(self.messages)
+        if "chunk" in message:
+            return message["chunk"]
+
+        self.response = message
+        self.messages.close()
+        if "error" in message:
+            raise ProcessError(message["error"])
+        raise StopIteration()
+
+
+class Requests(object):
+    """
+    Requests shared by the clients
+
+    Subclasses send them with ``call_service()``. On ``AsyncClient`` each
+    method returns an awaitable.
+    """
 
     def request(self, op_name, data=None):
         """
@@ -25,6 +90,84 @@ class Client(object):
             }
         )
 
+    def request_many(self, requests, parallel=False):
+        """
+        Request several operations in one round trip
+
+        Arguments:
+            requests    List of ``(op_name, data)`` pairs
+            parallel    If ``True``, the service may perform them concurrently
+
+        Returns a list with a response for each request. If the whole batch
+        fails, such as when the secret is wrong, each response has the error.
+        """
+        requests = list(requests)
+        response = self.call_service(batch_request(requests, parallel))
+        return batch_responses(response, len(requests))
+
+    def submit(self, op_name, data=None):
+        """
+        Request an operation to be performed in the background
+
+        Returns without waiting for it to be performed. If the request is
+        successful, the response ``data`` is the record of the job, with the
+        ``job`` id to pass to ``poll()`` or ``wait()``.
+        """
+        return self.call_service(
+            {
+                "op": op_name,
+                "data": data,
+                "background": True,
+            }
+        )
+
+    def poll(self, job_id):
+        """
+        Check on an operation submitted in the background
+
+        If the request is successful, the response ``data`` is the record of
+        the job, with its ``status`` (``pending``, ``running``, ``done`` or
+        ``failed``), ``progress``, and ``result`` or ``error``.
+        """
+        return self.call_service(
+            {
+                "job": job_id,
+            }
+        )
+
+    def delivery(self, uid):
+        """
+        Check on the auth request for an operation on hold which is sent by
+        the service's outbox
+
+        If the request is successful, the response ``data`` is the record of
+        the delivery, with its ``status`` (``pending``, ``sent`` or
+        ``failed``), number of ``attempts``, and the ``error`` from the last
+        failed attempt.
+        """
+        return self.call_service(
+            {
+                "delivery": uid,
+            }
+        )
+
+    def wait(self, job_id, timeout=None, interval=1):
+        """
+        Poll until an operation submitted in the background has finished
+
+        Polls quickly at first, backing off to every ``interval`` seconds.
+        Returns the last response, or raises ``SocketError`` if the operation
+        has not finished within ``timeout`` seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for delay in poll_delays(interval):
+            response = self.poll(job_id)
+            if "error" in response or response["data"]["status"] in FINISHED:
+                return response
+            if deadline is not None and time.monotonic() + delay > deadline:
+                raise SocketError("Timed out waiting for job")
+            time.sleep(delay)
+
     def auth(self, uid, data=None):
         """
         Authorise a suspended operation
@@ -36,20 +179,187 @@ class Client(object):
             }
         )
 
+
+class Client(Requests):
+    def __init__(
+        self,
+        socket_path,
+        socket_secret,
+        socket_timeout=SOCKET_TIMEOUT,
+        keepalive=False,
+        socket_max_size=SOCKET_MAX_SIZE,
+        codec=None,
+    ):
+        """
+        Arguments:
+            keepalive   If ``True``, keep the connection open between requests
+                        and allow requests to be pipelined with ``send()`` and
+                        ``receive()``. If ``False``, connect for each request.
+            socket_max_size
+                        Maximum size of a response, in bytes
+            codec       Name of the codec to use - ``json``, ``orjson`` or
+                        ``msgpack``. If not set, messages are sent as
+                        newline-terminated JSON.
+        """
+        self.socket = Socket(
+            socket_path,
+            socket_secret,
+            socket_timeout,
+            socket_max_size,
+            codec,
+        )
+        self.keepalive = keepalive
+        self.connected = False
+        self.ids = itertools.count(1)
+        self.responses = {}
+        self.chunks = {}
+
+    def stream(self, op_name, data=None):
+        """
+        Request an operation which yields its result, and iterate over the
+        chunks as they arrive
+
+        Returns a ``Stream``
+        """
+        return self.stream_service(
+            {
+                "op": op_name,
+                "data": data,
+                "stream": True,
+            }
+        )
+
+    def stream_service(self, data):
+        """
+        Write to the service and return a ``Stream`` of its messages
+        """
+        if self.keepalive:
+            return Stream(self.stream_messages(self.send(data)))
+        return Stream(self.stream_once(data))
+
+    def stream_once(self, data):
+        """
+        Generator of messages for a streamed request on a new connection
+        """
+        self.socket.connect()
+        try:
+            self.socket.write(data)
+            while 1:
+                message = self.socket.read()
+                yield message
+                if "chunk" not in message:
+                    return
+        finally:
+            self.socket.close()
+            self.socket.init()
+
+    def stream_messages(self, request_id):
+        """
+        Generator of messages for a streamed request sent with ``send()``
+        """
+        while 1:
+            chunks = self.chunks.get(request_id)
+            while chunks:
+                yield {"chunk": chunks.popleft()}
+
+            if request_id in self.responses:
+                self.chunks.pop(request_id, None)
+                yield self.responses.pop(request_id)
+                return
+
+            self.read_message(request_id)
+
     def call_service(self, data):
         """
         Write to and read from the service
         """
+        if self.keepalive:
+            return self.receive(self.send(data))
+
         self.socket.connect()
-        self.socket.write(data)
-        response = self.socket.read()
-        self.socket.close()
+        try:
+            self.socket.write(data)
+            response = self.socket.read()
+        finally:
+            self.socket.close()
+            self.socket.init()
         return response
 
+    def send(self, data):
+        """
+        Send a request on the keep-alive connection without waiting for the
+        response
+
+        Returns the request id to pass to ``receive()``
+        """
+        if not self.keepalive:
+            raise ValueError("Pipelining requires a keep-alive connection")
+
+        if not self.connected:
+            self.socket.connect()
+            self.connected = True
+
+        request_id = next(self.ids)
+        out = {
+            "id": request_id,
+            "keepalive": True,
+        }
+        out.update(data)
+        try:
+            self.socket.write(out)
+        except SocketError:
+            self.disconnect()
+            raise
+        return request_id
+
+    def receive(self, request_id):
+        """
+        Wait for the response to a request sent with ``send()``
+
+        Responses to other requests which arrive first are held until they are
+        asked for.
+        """
+        while request_id not in self.responses:
+            self.read_message(request_id)
+
+        self.chunks.pop(request_id, None)
+        return self.responses.pop(request_id)
+
+    def read_message(self, request_id):
+        """
+        Read the next message on the keep-alive connection and hold it until
+        it is asked for
+        """
+        try:
+            response = self.socket.read()
+        except SocketError:
+            self.disconnect()
+            raise
+
+        # A response without an id is an error reading the request
+        response_id = response.get("id", request_id)
+        if "chunk" in response:
+            self.chunks.setdefault(response_id, deque()).append(response["chunk"])
+        else:
+            self.responses[response_id] = response
+
+    def disconnect(self):
+        """
+        Close the keep-alive connection and prepare to reconnect
+        """
+        if self.connected:
+            self.connected = False
+            try:
+                self.socket.close()
+            except SocketError:
+                pass
+            self.socket.init()
+
     def close(self):
         """
         Call this once you're done with the client
         """
+        self.connected = False
         self.socket.close()
 
     def reset(self):
@@ -0,0 +1,245 @@
+"""
+Thread-safe pool of keep-alive connections to a service
+"""
+import os
+import select
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from ..constants import SOCKET_TIMEOUT
+from ..exceptions import SocketError
+from .client import Client, Requests
+
+
+class ClientPool(Requests):
+    """
+    Pool of keep-alive clients which can be shared between threads
+
+    Connections are checked before they are handed out, and replaced if the
+    service has closed them or been restarted.
+    """
+
+    def __init__(
+        self,
+        socket_path,
+        socket_secret,
+        socket_timeout=SOCKET_TIMEOUT,
+        min_size=0,
+        max_size=10,
+        idle_timeout=30,
+        codec=None,
+    ):
+        """
+        Arguments:
+            min_size        Number of idle connections to keep open
+            max_size        Maximum number of open connections. When they are
+                            all in use, callers wait up to ``socket_timeout``
+                            for one to be released, or indefinitely if it is
+                            ``None``.
+            idle_timeout    Number of seconds before an unused connection
+                            above ``min_size`` is closed
+            codec           Name of the codec to use; see ``Client``
+        """
+        self.socket_path = socket_path
+        self.socket_secret = socket_secret
+        self.socket_timeout = socket_timeout
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.codec = codec
+
+        self.lock = threading.Condition()
+        self.idle = deque()
+        self.size = 0
+        self.pid = os.getpid()
+        self.fill()
+
+    def call_service(self, data):
+        """
+        Write to and read from the service using a pooled connection
+
+        If the request can't be sent, it is retried once on a new connection.
+        """
+        for attempt in range(2):
+            client = self.acquire()
+            try:
+                request_id = client.send(data)
+            except SocketError:
+                # Request was not sent, safe to retry
+                self.discard(client)
+                if attempt:
+                    raise
+                continue
+
+            try:
+                response = client.receive(request_id)
+            except Exception:
+                self.discard(client)
+                raise
+
+            self.release(client)
+            return response
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager to borrow a keep-alive ``Client`` from the pool
+        """
+        client = self.acquire()
+        try:
+            yield client
+        except Exception:
+            self.discard(client)
+            raise
+        else:
+            self.release(client)
+
+    def acquire(self):
+        """
+        Take a live connection from the pool, or open a new one
+        """
+        deadline = None
+        if self.socket_timeout is not None:
+            deadline = time.monotonic() + self.socket_timeout
+        with self.lock:
+            self.check_fork()
+            while 1:
+                self.evict()
+                while self.idle:
+                    client, _ = self.idle.pop()
+                    if self.is_alive(client):
+                        return client
+                    self.size -= 1
+                    client.disconnect()
+
+                if self.size < self.max_size:
+                    self.size += 1
+                    break
+
+                if deadline is None:
+                    self.lock.wait()
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.lock.wait(remaining):
+                    raise SocketError("Timed out waiting for a connection")
+
+        try:
+            return self.connect()
+        except Exception:
+            with self.lock:
+                self.size -= 1
+                self.lock.notify()
+            raise
+
+    def release(self, client):
+        """
+        Return a connection to the pool
+        """
+        with self.lock:
+            if client.responses or client.chunks:
+                # Unclaimed responses, don't hand them to the next caller
+                self.size -= 1
+                client.disconnect()
+            else:
+                self.idle.append((client, time.monotonic()))
+            self.lock.notify()
+
+    def discard(self, client):
+        """
+        Close a connection which is no longer usable
+        """
+        client.disconnect()
+        with self.lock:
+            self.size -= 1
+            self.lock.notify()
+
+    def connect(self):
+        """
+        Open a new keep-alive connection
+        """
+        client = Client(
+            self.socket_path,
+            self.socket_secret,
+            self.socket_timeout,
+            keepalive=True,
+            codec=self.codec,
+        )
+        try:
+            client.socket.connect()
+            client.inode = os.stat(self.socket_path).st_ino
+        except OSError:
+            client.disconnect()
+            raise SocketError("Could not connect to service")
+        client.connected = True
+        return client
+
+    def is_alive(self, client):
+        """
+        Check a connection is still open and connected to the current service
+        """
+        if not client.connected:
+            return False
+
+        # The service will remove and recreate its socket file on restart
+        try:
+            if os.stat(self.socket_path).st_ino != client.inode:
+                return False
+        except OSError:
+            return False
+
+        # An idle connection should have nothing to read - if it does, the
+        # service has closed it
+        try:
+            readable = select.select([client.socket.socket], [], [], 0)[0]
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    def evict(self):
+        """
+        Close idle connections above the minimum size which have timed out
+        """
+        cutoff = time.monotonic() - self.idle_timeout
+        while self.idle and len(self.idle) > self.min_size:
+            client, used = self.idle[0]
+            if used > cutoff:
+                break
+            self.idle.popleft()
+            self.size -= 1
+            client.disconnect()
+
+    def fill(self):
+        """
+        Open connections up to the minimum size
+
+        Failures are ignored; connections will be opened when they are needed.
+        """
+        while self.size < self.min_size:
+            try:
+                client = self.connect()
+            except SocketError:
+                return
+            with self.lock:
+                self.size += 1
+                self.idle.append((client, time.monotonic()))
+
+    def check_fork(self):
+        """
+        Drop connections inherited from a parent process
+        """
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.idle.clear()
+            self.size = 0
+
+    def close(self):
+        """
+        Close all idle connections
+        """
+        with self.lock:
+            while self.idle:
+                client, _ = self.idle.pop()
+                self.size -= 1
+                client.disconnect()
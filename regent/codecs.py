@@ -0,0 +1,121 @@
+"""
+Message codecs
+
+Codecs are negotiated with a handshake byte when a connection opens; see
+``regent.socket`` for the protocol.
+"""
+import json
+
+from .exceptions import ProcessError
+
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+
+class Codec(object):
+    """
+    Encode and decode messages
+
+    Subclasses must set a unique ``id`` between 1 and 31, which is sent as the
+    handshake byte
+    """
+
+    id = None
+    name = None
+
+    #: Whether the codec's dependencies are installed
+    available = True
+
+    def encode(self, data):
+        raise NotImplementedError()
+
+    def decode(self, raw):
+        raise NotImplementedError()
+
+
+class JsonCodec(Codec):
+    """
+    Compact JSON using the standard library
+    """
+
+    id = 1
+    name = "json"
+
+    def encode(self, data):
+        return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+    def decode(self, raw):
+        try:
+            return json.loads(raw)
+        except ValueError as e:
+            raise ProcessError(
+                "Invalid message, could not decode JSON: {}".format(e),
+            )
+
+
+class OrjsonCodec(Codec):
+    """
+    JSON using orjson
+    """
+
+    id = 2
+    name = "orjson"
+    available = orjson is not None
+
+    def encode(self, data):
+        return orjson.dumps(data)
+
+    def decode(self, raw):
+        try:
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError as e:
+            raise ProcessError(
+                "Invalid message, could not decode JSON: {}".format(e),
+            )
+
+
+class MsgpackCodec(Codec):
+    """
+    MessagePack using msgpack
+    """
+
+    id = 3
+    name = "msgpack"
+    available = msgpack is not None
+
+    def encode(self, data):
+        return msgpack.packb(data, use_bin_type=True)
+
+    def decode(self, raw):
+        try:
+            return msgpack.unpackb(raw, raw=False)
+        except (ValueError, msgpack.UnpackException) as e:
+            raise ProcessError(
+                "Invalid message, could not decode msgpack: {}".format(e),
+            )
+
+
+CODECS = {codec.id: codec() for codec in (JsonCodec, OrjsonCodec, MsgpackCodec)}
+
+
+def get_codec(name):
+    """
+    Return the codec with the given name
+    """
+    for codec in CODECS.values():
+        if codec.name == name:
+            break
+    else:
+        raise ValueError("Unknown codec {}".format(name))
+
+    if not codec.available:
+        raise ValueError("Codec {} is not installed".format(name))
+    return codec
@@ -4,5 +4,17 @@ Regent constants
 # Socket timeout, in seconds
 SOCKET_TIMEOUT = 5
 
-# Max number of connections pending on the queue
-SOCKET_PENDING = 5
+# Max size of a message, in bytes
+SOCKET_MAX_SIZE = 16 * 1024 * 1024
+
+# Default max number of connections pending on the queue
+SOCKET_PENDING = 128
+
+# Keep-alive connection idle timeout, in seconds
+KEEPALIVE_TIMEOUT = 60
+
+# Command timeout, in seconds
+COMMAND_TIMEOUT = 60
+
+# Max size of the output captured from a command, in bytes
+COMMAND_MAX_OUTPUT = 1024 * 1024
@@ -1,11 +1,20 @@
-from __future__ import print_function
-
+"""
+Deprecated - use ``regent.log``
+"""
+import logging
 import os
 
+from .log import logger
+
 
 DEBUG = os.getenv("DEBUG", False)
 
 
 def debug(*msg):
-    if DEBUG:
-        print(*msg)
+    """
+    Log a debug message to the ``regent`` logger
+
+    Enabled by setting the ``DEBUG`` environment variable; see ``regent.log``
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(" ".join(str(part) for part in msg))
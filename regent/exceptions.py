@@ -19,9 +19,76 @@ class ProcessError(Exception):
     pass
 
 
+class PermissionDenied(ProcessError):
+    """
+    The request did not have the correct secret
+    """
+
+    def __init__(self, msg="Permission denied"):
+        super(PermissionDenied, self).__init__(msg)
+
+
+class ServiceBusy(ProcessError):
+    """
+    The service has too many requests waiting to be handled
+    """
+
+    def __init__(self, msg="Service busy"):
+        super(ServiceBusy, self).__init__(msg)
+
+
+class DeadlineExceeded(ProcessError):
+    """
+    The client stopped waiting before the request was handled
+    """
+
+    def __init__(self, msg="Deadline exceeded"):
+        super(DeadlineExceeded, self).__init__(msg)
+
+
+class CommandError(ProcessError):
+    """
+    A command failed
+
+    ``result`` is the ``Result`` of the command. Its output is not included in
+    the message, which is sent to the client.
+    """
+
+    def __init__(self, msg, result=None):
+        self.result = result
+        super(CommandError, self).__init__(msg)
+
+
+class CommandTimeout(CommandError):
+    """
+    A command did not finish in time, and was killed
+    """
+
+    pass
+
+
 class DoesNotExist(Exception):
     """
     Object in database does not exist
     """
 
     pass
+
+
+class ValidationError(ProcessError):
+    """
+    The request data did not match the operation's schema
+
+    ``errors`` is a dict of field names to error messages
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        super(ValidationError, self).__init__(
+            "Invalid data: {}".format(
+                "; ".join(
+                    "{}: {}".format(name, msg) if name else msg
+                    for name, msg in sorted(errors.items())
+                )
+            )
+        )
@@ -0,0 +1,102 @@
+"""
+Logging
+
+Regent logs to the ``regent`` logger, and traces requests to the
+``regent.request`` logger at the ``DEBUG`` level. Log arguments are only
+formatted if a record is emitted, and the service checks whether requests are
+traced once when it starts, so tracing costs almost nothing when it is off.
+
+Setting the ``DEBUG`` environment variable logs everything to stderr; set it to
+``json`` to log in JSON.
+"""
+import itertools
+import json
+import logging
+import os
+
+
+logger = logging.getLogger("regent")
+request_logger = logging.getLogger("regent.request")
+
+
+class Sampler(object):
+    """
+    Select one in every ``1 / rate`` calls
+    """
+
+    def __init__(self, rate=1):
+        if not 0 < rate <= 1:
+            raise ValueError("Sample rate must be between 0 and 1")
+        self.interval = max(int(round(1 / rate)), 1)
+        self.counter = itertools.count()
+
+    def __call__(self):
+        return next(self.counter) % self.interval == 0
+
+
+class Redacted(object):
+    """
+    Request to be logged, without its secret
+
+    The request is only formatted if the record is emitted.
+    """
+
+    __slots__ = ("request",)
+
+    def __init__(self, request):
+        self.request = request
+
+    def __str__(self):
+        request = self.request
+        if isinstance(request, dict) and "secret" in request:
+            request = dict(request, secret="***")
+        return str(request)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format records as single lines of JSON
+
+    Request fields passed as ``extra`` are included as keys.
+    """
+
+    #: Extra record attributes to include
+    fields = ("op", "id", "uid", "peer")
+
+    def format(self, record):
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in self.fields:
+            if hasattr(record, field):
+                data[field] = getattr(record, field)
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+def configure(level=logging.DEBUG, json=False, stream=None):
+    """
+    Log regent messages to a stream, stderr by default
+
+    Arguments:
+        level       Minimum level to log
+        json        If ``True``, log using ``JsonFormatter``
+    """
+    handler = logging.StreamHandler(stream)
+    if json:
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(
+            logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+        )
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    return handler
+
+
+if os.getenv("DEBUG"):
+    configure(json=os.getenv("DEBUG") == "json")
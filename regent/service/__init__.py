@@ -1,5 +1,6 @@
 """
 Regent service
 """
+from .async_server import AsyncService  # noqa
 from .operation import Operation  # noqa
 from .server import Service  # noqa
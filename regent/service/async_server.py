@@ -0,0 +1,597 @@
+"""
+Regent asyncio service
+
+Speaks the same protocol as ``Service``, but handles connections on an asyncio
+event loop. Operations and auth classes may define their methods as coroutines.
+"""
+import asyncio
+import contextvars
+import functools
+import inspect
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from ..exceptions import (
+    DeadlineExceeded,
+    PermissionDenied,
+    ProcessError,
+    ServiceBusy,
+    SocketError,
+)
+from ..log import logger, request_logger
+from ..socket import ENCODE_ERRORS, AsyncSocket
+from .auth import Auth
+from .cache import MISSING, AsyncCoalescer
+from .operation import new_uid, progress_handler
+from .outbox import AsyncOutbox
+from .server import Service, expired, perform
+from .storage import delivery_record
+
+
+async def resolve(value):
+    """
+    Await the value if it is awaitable, otherwise return it
+    """
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+
+async def call(fn, *args, **kwargs):
+    """
+    Call a hook or store method without blocking the event loop
+
+    Coroutine functions are awaited on the loop; anything else is called in
+    the loop's default executor.
+    """
+    if inspect.iscoroutinefunction(fn):
+        return await fn(*args, **kwargs)
+    loop = asyncio.get_running_loop()
+    result = await loop.run_in_executor(None, functools.partial(fn, *args, **kwargs))
+    return await resolve(result)
+
+
+def perform_by(op, deadline):
+    """
+    Perform an operation in a worker thread, unless the client stopped
+    waiting while it was queued for the thread
+    """
+    if expired(deadline):
+        raise DeadlineExceeded()
+    return op.perform()
+
+
+async def iterate(chunks):
+    """
+    Iterate over a synchronous generator in the thread pool, so it doesn't
+    block the event loop
+    """
+    loop = asyncio.get_running_loop()
+    done = object()
+    try:
+        while 1:
+            chunk = await loop.run_in_executor(None, next, chunks, done)
+            if chunk is done:
+                return
+            yield chunk
+    finally:
+        chunks.close()
+
+
+class AsyncService(Service):
+    """
+    Service which runs on an asyncio event loop
+
+    Synchronous operation and auth methods, such as ``perform()``, and calls
+    to the store are run in the thread pool so they don't block the event
+    loop; coroutine methods are awaited on the loop.
+
+    Requests are not queued for threads, so ``queue_size`` is the max number
+    of requests in progress at once.
+    """
+
+    coalescer_class = AsyncCoalescer
+    limit_class = asyncio.Semaphore
+    outbox_class = AsyncOutbox
+
+    def listen(self):
+        """
+        Listen on the socket and run the server on a new event loop
+        """
+        self.socket.listen()
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        """
+        Main server coroutine, on a socket which is already listening
+
+        Runs until ``stop()`` is called, or the worker reaches its request or
+        memory limit, then finishes the requests and background operations in
+        progress and returns.
+        """
+        self.tracing = request_logger.isEnabledFor(logging.DEBUG)
+        self.jobs = set()
+        self.reading = set()
+
+        loop = asyncio.get_running_loop()
+        if self.threads:
+            self.thread_pool = ThreadPoolExecutor(max_workers=self.threads)
+            loop.set_default_executor(self.thread_pool)
+        if self.processes:
+            self.process_pool = ProcessPoolExecutor(max_workers=self.processes)
+
+        if self.outbox_eager:
+            self.start_outbox()
+
+        server = await asyncio.start_unix_server(
+            self.handle,
+            sock=self.socket.socket,
+            limit=self.socket.max_size,
+        )
+
+        async with server:
+            while not self.stopping:
+                await asyncio.sleep(1)
+                if self.exhausted():
+                    self.stop()
+
+            # Close keep-alive connections waiting for their next request
+            for task in self.reading:
+                task.cancel()
+            self.stop_outbox()
+
+        tasks = asyncio.all_tasks() - {asyncio.current_task()}
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for pool in (self.thread_pool, self.process_pool):
+            if pool:
+                pool.shutdown()
+
+    async def handle(self, reader, writer):
+        """
+        Handle a connected client
+
+        Requests which ask for the connection to be kept alive are processed
+        concurrently while the next request is read.
+        """
+        logger.debug("Connected")
+        client = AsyncSocket(
+            reader,
+            writer,
+            self.socket.timeout,
+            self.socket.max_size,
+            negotiate=True,
+        )
+        pending = set()
+        timeout = None
+        requests = 0
+        task = asyncio.current_task()
+
+        while 1:
+            if requests:
+                if self.stopping:
+                    break
+                self.reading.add(task)
+            try:
+                request = await client.read(timeout)
+            except asyncio.CancelledError:
+                if not self.stopping:
+                    raise
+                break
+            except Exception as e:
+                # A keep-alive client closing its connection is not an error
+                if not requests or not isinstance(e, SocketError):
+                    logger.debug("Error reading request: %s", e, exc_info=True)
+                    await self.respond(client, None, {"error": "{}".format(e)})
+                break
+            finally:
+                self.reading.discard(task)
+
+            requests += 1
+            self.handled += 1
+            if not (isinstance(request, dict) and request.get("keepalive")):
+                await self.handle_request(client, request)
+                break
+
+            task = asyncio.ensure_future(self.handle_request(client, request))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+            timeout = self.keepalive_timeout
+
+        if pending:
+            await asyncio.gather(*pending)
+
+        try:
+            await client.close()
+        except SocketError:
+            logger.debug("Error closing client")
+
+    async def handle_request(self, client, request):
+        """
+        Process a request and write the response
+        """
+        metrics = self.metrics
+        if self.queue_size:
+            if self.queued >= self.queue_size:
+                if metrics:
+                    metrics.inc("busy")
+                await self.respond(client, request, self.error_response(ServiceBusy()))
+                return
+            self.queued += 1
+
+        op_name = None
+        if metrics:
+            metrics.add("in_flight", 1)
+
+        if self.tracing and self.sampler():
+            self.trace(request, client.peer)
+
+        if not client.authenticated:
+            hold = self.throttle.wait(client.peer)
+            if hold:
+                # The peer is backed off after failing the secret check, so
+                # don't check this request's secret until its turn
+                await asyncio.sleep(hold)
+
+        try:
+            uid, data = await self.process(request)
+            client.authenticated = True
+            op_name = self.metric_label(request)
+            if inspect.isasyncgen(data):
+                await self.stream(client, request, data)
+                data = None
+            response = {
+                "success": True,
+                "uid": uid,
+                "data": data,
+            }
+
+        except PermissionDenied as e:
+            # Delay this connection without blocking the loop
+            logger.debug("Permission denied for peer %s", client.peer)
+            await asyncio.sleep(self.throttle.failed(client.peer))
+            response = {
+                "error": "{}".format(e),
+            }
+            if metrics:
+                metrics.inc("denied")
+
+        except Exception as e:
+            # Only raised once the secret has been checked
+            client.authenticated = True
+            op_name = self.metric_label(request)
+            # Try to report the error
+            logger.debug("Error processing request: %s", e, exc_info=True)
+            response = self.error_response(e)
+            if metrics:
+                metrics.inc("errors", op_name)
+
+        if metrics:
+            metrics.inc("requests", op_name)
+            start = time.perf_counter()
+        await self.respond(client, request, response)
+        if metrics:
+            metrics.observe("write", op_name, start)
+            metrics.add("in_flight", -1)
+        if self.queue_size:
+            self.queued -= 1
+
+    async def respond(self, client, request, response):
+        """
+        Write a response, tagged with the request's correlation id if it had
+        one
+        """
+        if isinstance(request, dict) and "id" in request:
+            response["id"] = request["id"]
+        try:
+            await client.write(response)
+        except SocketError:
+            # Fail silently if we can't talk to the client
+            logger.debug("Error writing to client")
+        except ENCODE_ERRORS as e:
+            # The codec can't encode the result, so report that instead
+            logger.debug("Error encoding response: %s", e, exc_info=True)
+            if "error" not in response:
+                await self.respond(client, request, self.error_response(e))
+
+    async def stream(self, client, request, chunks):
+        """
+        Write each chunk of a streamed response as a separate message
+
+        Writes wait for the client to drain its buffer, which pauses the
+        operation rather than buffering its output.
+        """
+        try:
+            async for chunk in chunks:
+                message = {"chunk": chunk}
+                if "id" in request:
+                    message["id"] = request["id"]
+                await client.write(message)
+        finally:
+            await chunks.aclose()
+
+    async def process(self, request):
+        """
+        Process a request
+
+        Returns uid and response, raises ProcessError if anything goes wrong
+        """
+        # Check the secret
+        metrics = self.metrics
+        if metrics:
+            start = time.perf_counter()
+        if not self.check_secret(request):
+            raise PermissionDenied()
+        if metrics:
+            metrics.observe("secret", None, start)
+        self.check_deadline(request)
+
+        if "batch" in request:
+            return None, await self.process_batch(request)
+        if "job" in request:
+            return None, await call(self.load_job, request["job"])
+        if "delivery" in request:
+            return None, await call(self.load_delivery, request["delivery"])
+        return await self.process_op(request, stream=request.get("stream") is True)
+
+    async def process_batch(self, request):
+        """
+        Process a batch of operations which share the request's secret
+
+        Items are processed in order, or concurrently if the request sets
+        ``parallel``.
+
+        Returns a list with a response for each item
+        """
+        items = request["batch"]
+        if not isinstance(items, list):
+            raise ProcessError("Invalid message: batch must be a list")
+
+        if request.get("parallel"):
+            return await asyncio.gather(*(self.process_item(item) for item in items))
+        return [await self.process_item(item) for item in items]
+
+    async def process_item(self, item):
+        """
+        Process an item from a batch
+
+        Returns the response for the item
+        """
+        if not isinstance(item, dict):
+            return {"error": "Invalid message: batch item must be an object"}
+
+        try:
+            uid, data = await self.process_op(item)
+        except Exception as e:
+            logger.debug("Error processing batch item: %s", e, exc_info=True)
+            if self.metrics:
+                self.metrics.inc("errors", item.get("op"))
+            return self.error_response(e)
+        return {"success": True, "uid": uid, "data": data}
+
+    async def process_op(self, request, stream=False):
+        """
+        Process a request for a single operation, once the secret has been
+        checked
+
+        Returns uid and response, raises ProcessError if anything goes wrong
+        """
+        # Prepare the operation
+        if "op" in request:
+            if request["op"] not in self.operations:
+                raise ProcessError("Unknown operation")
+
+            op, auth = await self.op_new(request["op"], request.get("data"))
+
+        elif "uid" in request:
+            op, auth = await self.op_existing(request["uid"], request.get("data"))
+
+        else:
+            raise ProcessError("Invalid message: operation not found")
+
+        # Handle authentication response from op
+        if auth is True:
+            pass
+
+        elif auth is False:
+            raise ProcessError("Authorisation failed")
+
+        elif isinstance(auth, Auth):
+            if auth.outbox:
+                return op.uid, await self.op_defer(op, auth)
+
+            response = await call(auth.request, op)
+            await call(self.op_suspend, op, auth)
+            return op.uid, response
+
+        # Auth ok
+        if request.get("background") is True:
+            return None, await self.submit(op)
+        response = await self.perform_cached(op, request, stream)
+        return None, response
+
+    async def perform_cached(self, op, request, stream):
+        """
+        Perform the operation, or take its result from the cache or from an
+        identical request in progress
+        """
+        deadline = request.get("deadline")
+        if stream:
+            return await self.perform(op, stream=True, deadline=deadline)
+
+        cache = self.caches.get(type(op))
+        cache_key = op.cache_key() if cache else None
+        if cache_key is not None:
+            response = cache.get(cache_key)
+            if self.metrics:
+                hit = response is not MISSING
+                self.metrics.inc(
+                    "cache_hits" if hit else "cache_misses", self.get_name(op)
+                )
+            if response is not MISSING:
+                return response
+            generation = cache.generation
+
+        key = self.coalesce_key(op, request, stream)
+        if key:
+            response = await self.coalescer.run(key, lambda: self.perform(op))
+        else:
+            response = await self.perform(op, deadline=deadline)
+
+        if cache_key is not None:
+            cache.set(cache_key, response, generation)
+        return response
+
+    async def perform(self, op, stream=False, deadline=None):
+        """
+        Perform the operation, respecting its concurrency limit
+
+        Operations may yield their result from a generator or an async
+        generator. Synchronous generators are advanced in the thread pool. If
+        ``stream`` is set, returns an async generator of the chunks which holds
+        the limit until it is exhausted; otherwise the chunks are collected
+        into a list.
+
+        Raises ``DeadlineExceeded`` if the ``deadline`` passes while the
+        operation waits for its limit or a thread.
+        """
+        limit = self.limits.get(type(op))
+        if limit:
+            await limit.acquire()
+            if expired(deadline):
+                limit.release()
+                raise DeadlineExceeded()
+        start = time.perf_counter() if self.metrics else None
+        streaming = False
+        try:
+            loop = asyncio.get_running_loop()
+            if self.process_pool and type(op) in self.process_operations:
+                return await loop.run_in_executor(self.process_pool, perform, op)
+
+            if inspect.isasyncgenfunction(op.perform):
+                result = op.perform()
+            elif inspect.iscoroutinefunction(op.perform):
+                result = await op.perform()
+            else:
+                # Copy the context so progress can be reported from the thread
+                context = contextvars.copy_context()
+                result = await loop.run_in_executor(
+                    None, context.run, perform_by, op, deadline
+                )
+
+            if inspect.isgenerator(result):
+                result = iterate(result)
+            if inspect.isasyncgen(result):
+                if stream:
+                    streaming = True
+                    return self.hold(op, result, limit, start)
+                result = [chunk async for chunk in result]
+            return result
+        finally:
+            if not streaming:
+                self.performed(op, limit, start)
+
+    async def submit(self, op):
+        """
+        Perform an operation in the background, as a task on the event loop
+
+        Returns the record of the job, with the ``job`` id to poll
+        """
+        job_id = new_uid()
+        record = await call(self.save_job, job_id, "pending")
+        task = asyncio.ensure_future(self.run_job(job_id, op))
+        self.jobs.add(task)
+        task.add_done_callback(self.jobs.discard)
+        return record
+
+    async def run_job(self, job_id, op):
+        """
+        Perform an operation in the background and store its result
+        """
+        progress_handler.set(
+            lambda progress: self.save_job(job_id, "running", progress=progress)
+        )
+        try:
+            await call(self.save_job, job_id, "running")
+            result = await self.perform(op)
+        except Exception as e:
+            logger.debug("Error performing job: %s", e, exc_info=True)
+            await call(self.save_job, job_id, "failed", error="{}".format(e))
+        else:
+            try:
+                await call(self.save_job, job_id, "done", result=result)
+            except Exception as e:
+                # Such as a result the store can't encode
+                logger.error("Error storing job result: %s", e, exc_info=True)
+                await call(self.save_job, job_id, "failed", error="{}".format(e))
+
+    async def hold(self, op, chunks, limit, start):
+        """
+        Yield the chunks of a streamed result, then release the operation's
+        limit
+        """
+        try:
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            await chunks.aclose()
+            self.performed(op, limit, start)
+
+    async def op_new(self, op_name, data):
+        """
+        Create a new operation
+
+        Returns:
+            op      Operation instance
+            auth    Whether the op wants auth (or is rejecting request)
+        """
+        metrics = self.metrics
+        if metrics:
+            start = time.perf_counter()
+        operation = self.get_operation(op_name)
+        validate = self.validators.get(operation)
+        if validate:
+            data = validate(data)
+        op = operation()
+        try:
+            await call(op.prepare, data)
+        except ValueError as e:
+            raise ProcessError("Invalid data: {}".format(e))
+        if metrics:
+            start = metrics.observe("prepare", op_name, start)
+
+        auth = await call(op.auth)
+        if metrics:
+            metrics.observe("auth", op_name, start)
+        return op, auth
+
+    async def op_existing(self, uid, data):
+        """
+        Defrost and process auth for an existing operation on hold
+
+        Returns:
+            op      Operation instance
+            auth    Result of processing the auth response
+        """
+        op, auth_obj = await call(self.op_load, uid)
+        if self.metrics:
+            start = time.perf_counter()
+        await call(auth_obj.process, op, data)
+        auth = await call(op.auth_response, auth_obj)
+        if self.metrics:
+            self.metrics.observe("auth", self.get_name(op), start)
+        return op, auth
+
+    async def op_defer(self, op, auth):
+        """
+        Put an operation on hold, and add its auth request to the outbox
+
+        The store is written in the thread pool, and the outbox is woken on
+        the loop.
+
+        Returns the record of the delivery
+        """
+        await call(self.op_queue, op, auth)
+        self.start_outbox()
+        self.outbox.wake()
+        return delivery_record(op.uid, "pending", 0, None)
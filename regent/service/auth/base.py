@@ -8,6 +8,12 @@ class Auth(Serialisable):
 
     state = True
 
+    #: If ``True``, ``request()`` is called in the background by the service's
+    #: outbox after the operation has been put on hold, and retried if it
+    #: raises an exception. Its return value is not sent to the client, and
+    #: attributes it sets are not saved.
+    outbox = False
+
     def request(self, op):
         """
         Send the auth request
@@ -0,0 +1,175 @@
+"""
+Sharing results between requests
+"""
+import asyncio
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+#: Returned by ``Cache.get()`` when there is no value
+MISSING = object()
+
+
+def canonical(data):
+    """
+    Return the data as canonical JSON, or ``None`` if it can't be serialised
+    """
+    try:
+        return json.dumps(data, sort_keys=True, separators=(",", ":"))
+    except (TypeError, ValueError):
+        return None
+
+
+def make_key(op_name, data):
+    """
+    Return a key for an operation and its request data, or ``None`` if the
+    data can't be canonicalised
+    """
+    data = canonical(data)
+    if data is None:
+        return None
+    return "{}:{}".format(op_name, data)
+
+
+class Cache(object):
+    """
+    Cache of results which expire after ``ttl`` seconds
+
+    When there are more than ``max_size`` entries, the least recently used is
+    evicted.
+    """
+
+    def __init__(self, ttl, max_size=128):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = 0
+
+    def get(self, key):
+        """
+        Return the value for the key, or ``MISSING``
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return MISSING
+            expires, value = entry
+            if expires <= time.monotonic():
+                del self.entries[key]
+                return MISSING
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, generation):
+        """
+        Store a value, unless the cache has been invalidated since
+        ``generation`` was read, in which case the value may be stale
+        """
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """
+        Remove the value for the key, or all values
+        """
+        with self.lock:
+            self.generation += 1
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+
+class Flight(object):
+    """
+    A call in progress, which other callers can wait for
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Coalescer(object):
+    """
+    Single-flight calls
+
+    While a call for a key is in progress, other calls for the same key wait
+    for it and share its result or exception, instead of making their own.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def run(self, key, fn):
+        """
+        Call ``fn()``, or wait for the call in progress for the key
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = fn()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+        return flight.result
+
+
+class AsyncCoalescer(object):
+    """
+    Single-flight calls on an asyncio event loop
+
+    Async equivalent of ``Coalescer``
+    """
+
+    def __init__(self):
+        self.flights = {}
+
+    async def run(self, key, fn):
+        """
+        Await ``fn()``, or wait for the call in progress for the key
+        """
+        flight = self.flights.get(key)
+        if flight:
+            return await asyncio.shield(flight)
+
+        flight = self.flights[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await fn()
+        except Exception as e:
+            flight.set_exception(e)
+            # Don't warn if nobody was waiting
+            flight.exception()
+            raise
+        except BaseException:
+            flight.cancel()
+            raise
+        else:
+            flight.set_result(result)
+        finally:
+            del self.flights[key]
+        return result
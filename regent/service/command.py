@@ -0,0 +1,547 @@
+"""
+Running commands
+
+Operations should run commands with ``Command``, which gives each command a
+timeout, caps the output it captures, and limits how many can run at once::
+
+    UFW = Command(["ufw"], timeout=30, limit=1)
+
+    class FirewallStatus(Operation):
+        def perform(self):
+            return UFW.run("status").stdout
+
+Commands run in their own process group, so a command which times out is
+killed along with any processes it started. They are started by
+``subprocess``, which uses ``vfork()`` where the platform supports it, so a
+large service process is not copied to start each command.
+
+``run()`` and ``stream()`` block the calling thread, so should be used by a
+``Service`` with ``threads``. ``run_async()`` and ``stream_async()`` wait on the
+event loop, for operations with coroutine methods on an ``AsyncService``.
+"""
+import asyncio
+import codecs
+import os
+import selectors
+import signal
+import subprocess
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+from ..constants import COMMAND_MAX_OUTPUT, COMMAND_TIMEOUT
+from ..exceptions import CommandError, CommandTimeout
+from ..log import logger
+
+
+#: Number of seconds to let a command exit after ``SIGTERM`` before it is sent
+#: ``SIGKILL``
+KILL_TIMEOUT = 1
+
+#: Max size of each read from a command's output, in bytes
+CHUNK_SIZE = 65536
+
+
+def kill_group(pid, signum):
+    """
+    Send a signal to a process group, if it still exists
+    """
+    try:
+        os.killpg(pid, signum)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+class Output(object):
+    """
+    Output from a command, captured up to ``max_size`` bytes
+
+    If ``keep`` is ``False`` the output is counted but not kept.
+    """
+
+    def __init__(self, max_size, keep=True):
+        self.max_size = max_size
+        self.keep = keep
+        self.size = 0
+        self.data = bytearray()
+        self.truncated = False
+
+    def feed(self, data):
+        """
+        Capture output
+
+        Returns the part which fits under the cap
+        """
+        space = self.max_size - self.size
+        if len(data) > space:
+            self.truncated = True
+            data = data[:space]
+        self.size += len(data)
+        if self.keep:
+            self.data += data
+        return data
+
+    def __str__(self):
+        return self.data.decode("utf-8", "replace")
+
+
+class Result(object):
+    """
+    Result of a command which has finished
+
+    Attributes:
+        args        Command line which was run
+        returncode  Exit status, or the negative signal number if it was
+                    killed by a signal
+        stdout      Output, decoded as UTF-8
+        stderr      Error output, decoded as UTF-8
+        truncated   ``True`` if output was discarded because it was too long
+    """
+
+    def __init__(self, args, returncode, stdout, stderr, truncated):
+        self.args = args
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.truncated = truncated
+
+
+class Command(object):
+    """
+    A command which operations can run
+    """
+
+    def __init__(
+        self,
+        args,
+        timeout=COMMAND_TIMEOUT,
+        max_output=COMMAND_MAX_OUTPUT,
+        limit=None,
+        check=True,
+        env=None,
+        cwd=None,
+    ):
+        """
+        Arguments:
+            args        Program to run, or a list of the program and any
+                        arguments which come before those passed to ``run()``
+            timeout     Number of seconds the command can take, including
+                        any time waiting for a slot, before it is killed
+            max_output  Max number of bytes of output and of error output to
+                        capture. Anything more is discarded.
+            limit       Max number of times the command can run at once.
+                        Further runs wait for a slot.
+            check       If ``True``, raise ``CommandError`` if the command
+                        exits with a non-zero status
+            env         Environment for the command, if not the service's
+            cwd         Working directory for the command
+        """
+        if isinstance(args, str):
+            args = [args]
+        self.args = list(args)
+        self.name = os.path.basename(self.args[0])
+        self.timeout = timeout
+        self.max_output = max_output
+        self.limit = limit
+        self.check = check
+        self.env = env
+        self.cwd = cwd
+        self.lock = threading.BoundedSemaphore(limit) if limit else None
+        self.async_lock = None
+
+    def argv(self, args):
+        """
+        Return the command line with extra arguments
+        """
+        return self.args + [str(arg) for arg in args]
+
+    def run(self, *args, input=None):
+        """
+        Run the command with extra arguments and wait for it to finish
+
+        Arguments:
+            input       Bytes or string to write to the command's stdin
+
+        Returns a ``Result``. Raises ``CommandTimeout`` if it takes too long,
+        or ``CommandError`` if it fails.
+        """
+        deadline = time.monotonic() + self.timeout
+        argv = self.argv(args)
+        stdout = Output(self.max_output)
+        stderr = Output(self.max_output)
+        with self.slot(deadline):
+            proc = self.spawn(argv, input)
+            try:
+                for pipe, data in self.read(proc, deadline, input):
+                    (stdout if pipe is proc.stdout else stderr).feed(data)
+                returncode = self.wait(proc, deadline)
+            except BaseException:
+                self.kill(proc)
+                raise
+            finally:
+                self.close(proc)
+        return self.result(argv, returncode, stdout, stderr)
+
+    def stream(self, *args, input=None):
+        """
+        Run the command with extra arguments, and generate its output as it
+        arrives
+
+        An operation can ``yield from`` this to stream the output to the
+        client. Up to ``max_output`` bytes are generated, as strings. If the
+        generator is closed before the command finishes, it is killed.
+
+        Raises ``CommandTimeout`` if it takes too long, or ``CommandError`` if
+        it fails.
+        """
+        deadline = time.monotonic() + self.timeout
+        argv = self.argv(args)
+        stdout = Output(self.max_output, keep=False)
+        stderr = Output(self.max_output)
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        with self.slot(deadline):
+            proc = self.spawn(argv, input)
+            try:
+                for pipe, data in self.read(proc, deadline, input):
+                    if pipe is proc.stdout:
+                        text = decoder.decode(stdout.feed(data))
+                        if text:
+                            yield text
+                    else:
+                        stderr.feed(data)
+                text = decoder.decode(b"", True)
+                if text:
+                    yield text
+                returncode = self.wait(proc, deadline)
+            except BaseException:
+                self.kill(proc)
+                raise
+            finally:
+                self.close(proc)
+        self.result(argv, returncode, stdout, stderr)
+
+    @contextmanager
+    def slot(self, deadline):
+        """
+        Context manager to wait for a slot to run the command
+        """
+        if not self.lock:
+            yield
+            return
+
+        if not self.lock.acquire(timeout=max(deadline - time.monotonic(), 0)):
+            raise CommandTimeout(
+                "Command {} timed out waiting to run".format(self.name)
+            )
+        try:
+            yield
+        finally:
+            self.lock.release()
+
+    def spawn(self, argv, input):
+        """
+        Start the command in a new process group
+        """
+        logger.debug("Running %s", argv)
+        try:
+            return subprocess.Popen(
+                argv,
+                stdin=subprocess.DEVNULL if input is None else subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                env=self.env,
+                cwd=self.cwd,
+                start_new_session=True,
+            )
+        except OSError as e:
+            raise CommandError("Could not run command {}: {}".format(self.name, e))
+
+    def read(self, proc, deadline, input):
+        """
+        Write the input to the command, and generate ``(pipe, data)`` for its
+        output until it closes its stdout and stderr
+        """
+        with selectors.DefaultSelector() as selector:
+            selector.register(proc.stdout, selectors.EVENT_READ)
+            selector.register(proc.stderr, selectors.EVENT_READ)
+            if input is not None:
+                if isinstance(input, str):
+                    input = input.encode("utf-8")
+                pending = memoryview(input)
+                if pending:
+                    os.set_blocking(proc.stdin.fileno(), False)
+                    selector.register(proc.stdin, selectors.EVENT_WRITE)
+                else:
+                    proc.stdin.close()
+
+            while selector.get_map():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise CommandTimeout("Command {} timed out".format(self.name))
+
+                for key, _ in selector.select(remaining):
+                    pipe = key.fileobj
+                    if pipe is proc.stdin:
+                        try:
+                            written = os.write(pipe.fileno(), pending[:CHUNK_SIZE])
+                        except BlockingIOError:
+                            continue
+                        except BrokenPipeError:
+                            # Command doesn't want the rest of its input
+                            written = len(pending)
+                        pending = pending[written:]
+                        if not pending:
+                            selector.unregister(pipe)
+                            pipe.close()
+                        continue
+
+                    data = os.read(pipe.fileno(), CHUNK_SIZE)
+                    if data:
+                        yield pipe, data
+                    else:
+                        selector.unregister(pipe)
+
+    def wait(self, proc, deadline):
+        """
+        Wait for the command to exit once it has closed its output
+
+        Returns its exit status
+        """
+        try:
+            return proc.wait(max(deadline - time.monotonic(), 0))
+        except subprocess.TimeoutExpired:
+            raise CommandTimeout("Command {} timed out".format(self.name))
+
+    def kill(self, proc):
+        """
+        Kill the command and any processes it started
+        """
+        logger.debug("Killing %s", self.name)
+        kill_group(proc.pid, signal.SIGTERM)
+        try:
+            proc.wait(KILL_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            pass
+        kill_group(proc.pid, signal.SIGKILL)
+        proc.wait()
+
+    def close(self, proc):
+        """
+        Close the pipes to a command
+        """
+        for pipe in (proc.stdin, proc.stdout, proc.stderr):
+            if pipe:
+                pipe.close()
+
+    def result(self, argv, returncode, stdout, stderr):
+        """
+        Return the ``Result`` of a command which has finished
+
+        Raises ``CommandError`` if it failed and ``check`` is set
+        """
+        result = Result(
+            argv,
+            returncode,
+            str(stdout),
+            str(stderr),
+            stdout.truncated or stderr.truncated,
+        )
+        if returncode:
+            logger.debug("%s exited with %s: %s", self.name, returncode, result.stderr)
+            if self.check:
+                raise CommandError(
+                    "Command {} failed with exit status {}".format(
+                        self.name, returncode
+                    ),
+                    result,
+                )
+        return result
+
+    async def run_async(self, *args, input=None):
+        """
+        Run the command with extra arguments and wait for it to finish,
+        without blocking the event loop
+
+        Async equivalent of ``run()``
+        """
+        deadline = time.monotonic() + self.timeout
+        argv = self.argv(args)
+        stdout = Output(self.max_output)
+        stderr = Output(self.max_output)
+        async with self.async_slot(deadline):
+            proc = await self.spawn_async(argv, input)
+            tasks = self.start_tasks(proc, input, stderr)
+            tasks.append(asyncio.ensure_future(self.drain(proc.stdout, stdout)))
+            try:
+                returncode = await self.wait_async(proc, tasks, deadline)
+            except BaseException:
+                await self.kill_async(proc, tasks)
+                raise
+        return self.result(argv, returncode, stdout, stderr)
+
+    async def stream_async(self, *args, input=None):
+        """
+        Run the command with extra arguments, and generate its output as it
+        arrives, without blocking the event loop
+
+        Async equivalent of ``stream()``
+        """
+        deadline = time.monotonic() + self.timeout
+        argv = self.argv(args)
+        stdout = Output(self.max_output, keep=False)
+        stderr = Output(self.max_output)
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        async with self.async_slot(deadline):
+            proc = await self.spawn_async(argv, input)
+            tasks = self.start_tasks(proc, input, stderr)
+            try:
+                while 1:
+                    try:
+                        data = await asyncio.wait_for(
+                            proc.stdout.read(CHUNK_SIZE),
+                            deadline - time.monotonic(),
+                        )
+                    except asyncio.TimeoutError:
+                        raise CommandTimeout("Command {} timed out".format(self.name))
+                    if not data:
+                        break
+                    text = decoder.decode(stdout.feed(data))
+                    if text:
+                        yield text
+                text = decoder.decode(b"", True)
+                if text:
+                    yield text
+                returncode = await self.wait_async(proc, tasks, deadline)
+            except BaseException:
+                await self.kill_async(proc, tasks)
+                raise
+        self.result(argv, returncode, stdout, stderr)
+
+    @asynccontextmanager
+    async def async_slot(self, deadline):
+        """
+        Async context manager to wait for a slot to run the command
+        """
+        if not self.limit:
+            yield
+            return
+
+        # Created on first use, to belong to the running event loop
+        if self.async_lock is None:
+            self.async_lock = asyncio.BoundedSemaphore(self.limit)
+        try:
+            await asyncio.wait_for(
+                self.async_lock.acquire(), max(deadline - time.monotonic(), 0)
+            )
+        except asyncio.TimeoutError:
+            raise CommandTimeout(
+                "Command {} timed out waiting to run".format(self.name)
+            )
+        try:
+            yield
+        finally:
+            self.async_lock.release()
+
+    async def spawn_async(self, argv, input):
+        """
+        Start the command in a new process group
+        """
+        logger.debug("Running %s", argv)
+        try:
+            return await asyncio.create_subprocess_exec(
+                *argv,
+                stdin=subprocess.DEVNULL if input is None else subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                env=self.env,
+                cwd=self.cwd,
+                start_new_session=True,
+            )
+        except OSError as e:
+            raise CommandError("Could not run command {}: {}".format(self.name, e))
+
+    def start_tasks(self, proc, input, stderr):
+        """
+        Start tasks to write the input to the command and capture its error
+        output
+
+        Returns a list of the tasks
+        """
+        tasks = [asyncio.ensure_future(self.drain(proc.stderr, stderr))]
+        if input is not None:
+            if isinstance(input, str):
+                input = input.encode("utf-8")
+            tasks.append(asyncio.ensure_future(self.feed(proc.stdin, input)))
+        return tasks
+
+    async def drain(self, stream, output):
+        """
+        Capture output from a stream until it closes
+        """
+        while 1:
+            data = await stream.read(CHUNK_SIZE)
+            if not data:
+                return
+            output.feed(data)
+
+    async def feed(self, stream, input):
+        """
+        Write input to a stream and close it
+        """
+        try:
+            stream.write(input)
+            await stream.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # Command doesn't want the rest of its input
+            pass
+        stream.close()
+
+    async def wait_async(self, proc, tasks, deadline):
+        """
+        Wait for the command's tasks to finish and for it to exit
+
+        Returns its exit status
+        """
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*tasks, proc.wait()),
+                max(deadline - time.monotonic(), 0),
+            )
+        except asyncio.TimeoutError:
+            raise CommandTimeout("Command {} timed out".format(self.name))
+        return proc.returncode
+
+    async def kill_async(self, proc, tasks):
+        """
+        Kill the command and any processes it started, and cancel its tasks
+        """
+        logger.debug("Killing %s", self.name)
+        kill_group(proc.pid, signal.SIGTERM)
+        try:
+            await asyncio.wait_for(proc.wait(), KILL_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+        kill_group(proc.pid, signal.SIGKILL)
+        for task in tasks:
+            task.cancel()
+        await proc.wait()
+
+
+def run(args, *extra, input=None, **kwargs):
+    """
+    Run a command once and wait for it to finish
+
+    Takes the arguments of ``Command`` and ``Command.run()``; returns a
+    ``Result``
+    """
+    return Command(args, **kwargs).run(*extra, input=input)
+
+
+async def run_async(args, *extra, input=None, **kwargs):
+    """
+    Run a command once and wait for it to finish, without blocking the event
+    loop
+
+    Async equivalent of ``run()``
+    """
+    return await Command(args, **kwargs).run_async(*extra, input=input)
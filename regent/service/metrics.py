@@ -0,0 +1,290 @@
+"""
+Service metrics
+
+Counters, gauges and latency histograms for each phase of a request, which
+can be read with an admin operation or exported in the Prometheus text format.
+"""
+import os
+import socket
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+from .operation import Operation
+
+
+# Upper bounds of latency histogram buckets, in seconds
+BUCKETS = (
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        Estimate a quantile as the upper bound of the bucket it falls in
+        """
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float("inf")
+
+
+class Metrics(object):
+    """
+    Metrics for a service
+
+    Request phases are:
+        accept      from accepting the connection to starting to handle it,
+                    including time waiting for a worker thread
+        read        reading and decoding the request
+        secret      checking the secret
+        prepare     ``Operation.prepare()``
+        auth        ``Operation.auth()``, or processing an auth response
+        perform     ``Operation.perform()``
+        write       encoding and writing the response
+        load        loading a suspended operation from storage
+        save        saving a suspended operation to storage
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(int)
+        self.gauges = defaultdict(int)
+        self.histograms = defaultdict(Histogram)
+        self.collectors = []
+        self.started = time.time()
+
+    def observe(self, phase, op, start):
+        """
+        Record the time taken by a phase which started at ``start``, from
+        ``time.perf_counter()``
+
+        Returns the current time, to start the next phase
+        """
+        now = time.perf_counter()
+        with self.lock:
+            self.histograms[(phase, op)].observe(now - start)
+        return now
+
+    def inc(self, name, op=None, value=1):
+        """
+        Increment a counter
+        """
+        with self.lock:
+            self.counters[(name, op)] += value
+
+    def add(self, name, value):
+        """
+        Change a gauge
+        """
+        with self.lock:
+            self.gauges[name] += value
+
+    def collect(self, fn):
+        """
+        Register a function which returns a dict of extra gauge values
+        """
+        self.collectors.append(fn)
+
+    def get_gauges(self):
+        with self.lock:
+            gauges = dict(self.gauges)
+        for fn in self.collectors:
+            gauges.update(fn())
+        return gauges
+
+    def snapshot(self):
+        """
+        Return the current metrics as a JSON-serialisable dict
+        """
+        with self.lock:
+            counters = defaultdict(dict)
+            for (name, op), value in self.counters.items():
+                counters[name][op or ""] = value
+
+            phases = defaultdict(dict)
+            for (phase, op), histogram in self.histograms.items():
+                phases[phase][op or ""] = {
+                    "count": histogram.count,
+                    "sum": histogram.sum,
+                    "p50": histogram.quantile(0.5),
+                    "p99": histogram.quantile(0.99),
+                }
+
+        return {
+            "uptime": time.time() - self.started,
+            "counters": counters,
+            "gauges": self.get_gauges(),
+            "phases": phases,
+        }
+
+    def prometheus(self):
+        """
+        Return the current metrics in the Prometheus text format
+        """
+        lines = []
+        with self.lock:
+            names = sorted({name for name, op in self.counters})
+            for name in names:
+                lines.append("# TYPE regent_{}_total counter".format(name))
+                for (counter, op), value in sorted(
+                    self.counters.items(), key=lambda item: str(item[0])
+                ):
+                    if counter == name:
+                        lines.append(
+                            "regent_{}_total{} {}".format(name, labels(op=op), value)
+                        )
+
+            lines.append("# TYPE regent_phase_seconds histogram")
+            for (phase, op), histogram in sorted(
+                self.histograms.items(), key=lambda item: str(item[0])
+            ):
+                cumulative = 0
+                for bound, count in zip(
+                    histogram.buckets + (float("inf"),), histogram.counts
+                ):
+                    cumulative += count
+                    lines.append(
+                        "regent_phase_seconds_bucket{} {}".format(
+                            labels(phase=phase, op=op, le=format_bound(bound)),
+                            cumulative,
+                        )
+                    )
+                lines.append(
+                    "regent_phase_seconds_sum{} {}".format(
+                        labels(phase=phase, op=op), histogram.sum
+                    )
+                )
+                lines.append(
+                    "regent_phase_seconds_count{} {}".format(
+                        labels(phase=phase, op=op), histogram.count
+                    )
+                )
+
+        for name, value in sorted(self.get_gauges().items()):
+            lines.append("# TYPE regent_{} gauge".format(name))
+            lines.append("regent_{} {}".format(name, value))
+
+        return "\n".join(lines) + "\n"
+
+    def export(self, path=None, socket_path=None, interval=10):
+        """
+        Start background threads to export metrics in the Prometheus text
+        format
+
+        Arguments:
+            path            Path of a file to write every ``interval`` seconds
+            socket_path     Path of a unix socket which writes the metrics to
+                            each connection
+        """
+        if path:
+            thread = threading.Thread(
+                target=self.write_forever,
+                args=(path, interval),
+                daemon=True,
+            )
+            thread.start()
+
+        if socket_path:
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                os.remove(socket_path)
+            except OSError:
+                pass
+            server.bind(socket_path)
+            server.listen(5)
+            thread = threading.Thread(
+                target=self.serve_forever,
+                args=(server,),
+                daemon=True,
+            )
+            thread.start()
+
+    def write(self, path):
+        """
+        Write the metrics to a file, replacing it atomically
+        """
+        tmp_path = "{}.tmp".format(path)
+        with open(tmp_path, "w") as file:
+            file.write(self.prometheus())
+        os.replace(tmp_path, path)
+
+    def write_forever(self, path, interval):
+        while 1:
+            self.write(path)
+            time.sleep(interval)
+
+    def serve_forever(self, server):
+        while 1:
+            conn, _ = server.accept()
+            try:
+                conn.sendall(self.prometheus().encode("utf-8"))
+            except OSError:
+                pass
+            finally:
+                conn.close()
+
+
+def labels(**values):
+    """
+    Format Prometheus labels, ignoring any which are not set
+    """
+    pairs = [
+        '{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for key, value in values.items()
+        if value is not None
+    ]
+    if not pairs:
+        return ""
+    return "{" + ",".join(pairs) + "}"
+
+
+def format_bound(bound):
+    if bound == float("inf"):
+        return "+Inf"
+    return repr(bound)
+
+
+class MetricsOperation(Operation):
+    """
+    Read-only admin operation which returns a snapshot of the metrics
+
+    Register with ``Service.register_metrics()``
+    """
+
+    metrics = None
+
+    def perform(self):
+        return self.metrics.snapshot()
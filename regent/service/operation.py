@@ -1,17 +1,73 @@
 """
 Regent operation
 """
-import random
-import time
+import contextvars
+import secrets
 
+from .cache import canonical
+from .serialiser import Serialisable
+
+
+#: Function to record the progress of the background operation being performed
+progress_handler = contextvars.ContextVar("progress_handler", default=None)
+
+
+def new_uid():
+    """
+    Return a new unique and unguessable uid for an operation
+    """
+    return secrets.token_urlsafe(16)
+
+
+class Operation(Serialisable):
+    """
+    An operation which a client can request
+
+    Subclasses can declare ``__slots__`` for the attributes they set in
+    ``prepare()``, to avoid creating a ``__dict__`` for each request.
+    """
+
+    __slots__ = ("_uid",)
+
+    #: If ``True``, concurrent requests for this operation with identical data
+    #: wait for one call to ``perform()`` and share its result. Only use this
+    #: for operations which are idempotent and don't depend on who is asking.
+    coalesce = False
+
+    #: Number of seconds to cache the result of ``perform()``, keyed on
+    #: ``cache_key()``. Only use this for operations which don't change
+    #: anything and don't depend on who is asking.
+    cache_ttl = None
+
+    #: Maximum number of results to cache
+    cache_size = 128
+
+    #: Dict of field names and ``regent.service.schema`` fields to validate the
+    #: request data against, before the operation is created
+    schema = None
+
+    #: Names of operations whose cached results should be discarded after this
+    #: operation is performed
+    invalidates = ()
 
-class Operation(object):
     def __init__(self):
-        timestamp = str(time.time()).replace(".", "")
-        self.uid = "{:0>12}{:0>9}".format(
-            timestamp,
-            random.randint(0, 999999999),
-        )
+        self._uid = None
+
+    @property
+    def uid(self):
+        """
+        Unique id, generated when it is first needed
+
+        The uid is not serialised, so an operation loaded from storage will be
+        given a new one.
+        """
+        if getattr(self, "_uid", None) is None:
+            self._uid = new_uid()
+        return self._uid
+
+    @uid.setter
+    def uid(self, value):
+        self._uid = value
 
     def prepare(self, data):
         """
@@ -19,8 +75,13 @@ class Operation(object):
         attributes.
 
         Raise ValueError if there is a problem with the data.
+
+        If the operation has a ``schema``, the data will already have been
+        validated, and by default each field is stored as an attribute.
         """
-        return
+        if self.schema is not None:
+            for name, value in data.items():
+                setattr(self, name, value)
 
     def auth(self):
         """
@@ -51,8 +112,33 @@ class Operation(object):
         """
         return auth.state
 
+    def cache_key(self):
+        """
+        Return the key to cache the result under
+
+        By default this is built from the attributes set by ``prepare()``.
+        Return ``None`` to skip the cache for this request.
+        """
+        return canonical(self.get_attrs())
+
+    def report_progress(self, progress):
+        """
+        Record the progress of an operation which was requested in the
+        background, for clients polling for its result
+
+        Progress can be any serialisable value, such as a percentage. It is
+        ignored if the operation is not running in the background.
+        """
+        handler = progress_handler.get()
+        if handler:
+            handler(progress)
+
     def perform(self):
         """
         Perform the operation
+
+        Return data for the response, or yield it in chunks to be streamed to
+        clients which ask for it; see ``Client.stream()``. Other clients will
+        receive the chunks as a list.
         """
         pass
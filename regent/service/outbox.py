@@ -0,0 +1,217 @@
+"""
+Outbox of auth requests
+
+When an ``Auth`` class sets ``outbox = True``, its requests are sent in the
+background. The operation is put on hold and its uid returned to the client
+straight away, then the outbox calls ``Auth.request()``, retrying with backoff
+if it raises an exception.
+
+The outbox is kept in the service's store, so with a database it survives a
+restart and is shared by ``Prefork`` workers. Each request is only taken by one
+worker at a time.
+"""
+import asyncio
+import inspect
+import threading
+
+from ..log import logger
+from .serialiser import deserialise
+
+
+class Outbox(object):
+    """
+    Send auth requests from a background thread
+    """
+
+    def __init__(
+        self,
+        attempts=5,
+        delay=1,
+        max_delay=300,
+        batch_size=100,
+        lease=300,
+        interval=1,
+    ):
+        """
+        Arguments:
+            attempts    Number of times to try to send a request before
+                        recording it as failed
+            delay       Number of seconds to wait before the first retry,
+                        doubling for each retry up to ``max_delay``
+            batch_size  Max number of requests to take from the store at once
+            lease       Number of seconds before requests which were taken
+                        from the store but not sent, such as by a worker which
+                        died, are taken again
+            interval    Number of seconds between checks for requests which
+                        are due
+        """
+        self.attempts = attempts
+        self.delay = delay
+        self.max_delay = max_delay
+        self.batch_size = batch_size
+        self.lease = lease
+        self.interval = interval
+        self.db = None
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.thread = None
+
+    def put(self, uid, frozen_op, frozen_auth):
+        """
+        Add the auth request for an operation on hold to the outbox
+
+        Call ``wake()`` once it has been committed to send it straight away.
+        """
+        self.db.queue_delivery(uid, frozen_op, frozen_auth)
+
+    def wake(self):
+        """
+        Check for requests which are due without waiting for the interval
+        """
+        self.wakeup.set()
+
+    def supported(self):
+        """
+        Check the store can hold an outbox
+        """
+        return hasattr(self.db, "claim_deliveries")
+
+    def start(self):
+        """
+        Start sending requests
+        """
+        if not self.supported():
+            return
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop sending requests, once any being sent have been sent
+        """
+        self.stopping = True
+        self.wakeup.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while not self.stopping:
+            self.wakeup.clear()
+            try:
+                claimed = self.send_due()
+            except Exception as e:
+                logger.error("Error sending auth requests: %s", e, exc_info=True)
+                claimed = 0
+            if claimed < self.batch_size:
+                self.wakeup.wait(self.interval)
+
+    def send_due(self):
+        """
+        Send requests which are due
+
+        Returns the number of requests taken from the store
+        """
+        claimed = self.db.claim_deliveries(self.batch_size, self.lease)
+        for uid, frozen_op, frozen_auth, attempts in claimed:
+            try:
+                op, auth = self.thaw(uid, frozen_op, frozen_auth)
+                auth.request(op)
+            except Exception as e:
+                self.failed(uid, attempts + 1, e)
+            else:
+                self.sent(uid, attempts + 1)
+        return len(claimed)
+
+    def thaw(self, uid, frozen_op, frozen_auth):
+        """
+        Return the operation and auth object for a request
+        """
+        op = deserialise(frozen_op)
+        op.uid = uid
+        return op, deserialise(frozen_auth)
+
+    def sent(self, uid, attempts):
+        logger.debug("Sent auth request for %s", uid)
+        self.db.save_delivery(uid, "sent", attempts)
+
+    def failed(self, uid, attempts, error):
+        """
+        Record a failed attempt to send a request, and schedule a retry
+        """
+        logger.warning(
+            "Could not send auth request for %s, attempt %s: %s",
+            uid,
+            attempts,
+            error,
+            exc_info=error,
+        )
+        error = "{}".format(error)
+        if attempts >= self.attempts:
+            self.db.save_delivery(uid, "failed", attempts, error)
+            return
+
+        delay = min(self.delay * 2 ** (attempts - 1), self.max_delay)
+        self.db.save_delivery(uid, "pending", attempts, error, delay)
+
+
+class AsyncOutbox(Outbox):
+    """
+    Send auth requests from a task on the event loop
+
+    Async equivalent of ``Outbox``. ``Auth.request()`` may be a coroutine;
+    if it isn't, it is called in the loop's default executor, as are calls to
+    the store, so they don't block other requests.
+    """
+
+    def start(self):
+        if not self.supported():
+            return
+        self.stopping = False
+        # Created here to belong to the running event loop
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        """
+        Stop sending requests
+
+        The task finishes once any requests being sent have been sent.
+        """
+        self.stopping = True
+        self.wakeup.set()
+
+    async def run(self):
+        while not self.stopping:
+            self.wakeup.clear()
+            try:
+                claimed = await self.send_due()
+            except Exception as e:
+                logger.error("Error sending auth requests: %s", e, exc_info=True)
+                claimed = 0
+            if claimed < self.batch_size:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def send_due(self):
+        loop = asyncio.get_running_loop()
+        claimed = await loop.run_in_executor(
+            None, self.db.claim_deliveries, self.batch_size, self.lease
+        )
+        for uid, frozen_op, frozen_auth, attempts in claimed:
+            try:
+                op, auth = self.thaw(uid, frozen_op, frozen_auth)
+                if inspect.iscoroutinefunction(auth.request):
+                    result = auth.request(op)
+                else:
+                    result = await loop.run_in_executor(None, auth.request, op)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                await loop.run_in_executor(None, self.failed, uid, attempts + 1, e)
+            else:
+                await loop.run_in_executor(None, self.sent, uid, attempts + 1)
+        return len(claimed)
@@ -0,0 +1,149 @@
+"""
+Pre-forked workers
+
+A master process listens on the service socket, then forks workers which each
+run the server loop and accept connections from the inherited socket, so a
+service can use more than one core. Workers which exit are replaced.
+
+Each worker has its own thread pools, caches, throttle and metrics. Operations
+on hold must be kept in a store which is shared between processes, such as the
+SQLite database.
+"""
+import asyncio
+import inspect
+import os
+import resource
+import signal
+import time
+
+from ..log import logger
+
+
+#: Minimum number of seconds between restarts of a worker which failed
+RESTART_DELAY = 1
+
+
+def memory_usage():
+    """
+    Return the resident memory of this process, in bytes
+    """
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        # Peak usage, in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Prefork(object):
+    """
+    Run a service in several worker processes which share its socket
+
+    Usage::
+
+        service = Service(socket_path, socket_secret, db_path=db_path)
+        service.register("whoami", WhoAmI)
+        Prefork(service, workers=4).listen()
+    """
+
+    def __init__(self, service, workers=None, max_requests=None, max_memory=None):
+        """
+        Arguments:
+            service         ``Service`` or ``AsyncService`` instance
+            workers         Number of worker processes. Defaults to the number
+                            of CPUs.
+            max_requests    Number of requests a worker handles before it is
+                            replaced
+            max_memory      Resident memory in bytes at which a worker is
+                            replaced
+        """
+        if not getattr(service.db, "shared", True):
+            raise ValueError(
+                "Workers need a store shared between processes, such as db_path"
+            )
+        self.service = service
+        self.workers = workers or os.cpu_count() or 1
+        self.max_requests = max_requests
+        self.max_memory = max_memory
+        self.pids = {}
+        self.stopping = False
+
+    def listen(self):
+        """
+        Listen on the socket and start the workers
+
+        Replaces workers as they exit, until the master receives ``SIGTERM``
+        or ``SIGINT``, which it passes on to the workers.
+        """
+        self.service.socket.listen()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        for _ in range(self.workers):
+            self.spawn()
+
+        while self.pids:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+
+            started = self.pids.pop(pid, None)
+            if started is None:
+                continue
+
+            failed = not os.WIFEXITED(status) or os.WEXITSTATUS(status)
+            if failed:
+                logger.warning("Worker %s failed with status %s", pid, status)
+                # Don't restart a worker which fails at once in a tight loop
+                delay = started + RESTART_DELAY - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            if not self.stopping:
+                self.spawn()
+
+    def stop(self, signum=None, frame=None):
+        """
+        Stop the workers once they have finished their requests in progress
+        """
+        self.stopping = True
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def spawn(self):
+        """
+        Fork a worker process
+        """
+        pid = os.fork()
+        if pid:
+            logger.debug("Started worker %s", pid)
+            self.pids[pid] = time.monotonic()
+            return
+
+        status = 1
+        try:
+            self.serve()
+            status = 0
+        except Exception:
+            logger.exception("Worker failed")
+        finally:
+            # Never return to the master's loop
+            os._exit(status)
+
+    def serve(self):
+        """
+        Run the server loop in a worker process
+        """
+        service = self.service
+        service.max_requests = self.max_requests
+        service.max_memory = self.max_memory
+        signal.signal(signal.SIGTERM, lambda signum, frame: service.stop())
+        signal.signal(signal.SIGINT, lambda signum, frame: service.stop())
+
+        if inspect.iscoroutinefunction(service.serve):
+            asyncio.run(service.serve())
+        else:
+            service.serve()
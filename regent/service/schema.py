@@ -0,0 +1,311 @@
+"""
+Declarative schemas for operation data
+
+An operation can set ``schema`` to a dict of field names and fields::
+
+    from regent.service.schema import Integer, IPAddress
+
+    class FirewallOpen(Operation):
+        schema = {
+            "ip": IPAddress(version=4, allow_private=False),
+            "port": Integer(min=1, max=65535, required=False, default=22),
+        }
+
+The schema is compiled into a validator when the operation is registered. The
+validator checks the request data before the operation is created, and passes
+the cleaned data to ``prepare()``. Unexpected fields are rejected. If any
+fields are invalid, ``ValidationError`` is raised with a message for each.
+"""
+import ipaddress
+import re
+
+from ..exceptions import ValidationError
+
+
+class Field(object):
+    """
+    Base field
+
+    Subclasses implement ``validator()``, which returns a function to check and
+    clean a value, raising ``ValueError`` if it is invalid.
+    """
+
+    def __init__(self, required=True, default=None):
+        """
+        Arguments:
+            required    If ``True``, the field must be present and not null
+            default     Value to use if an optional field is missing
+        """
+        self.required = required
+        self.default = default
+
+    def validator(self):
+        raise NotImplementedError()
+
+
+class Boolean(Field):
+    def validator(self):
+        def check(value):
+            if not isinstance(value, bool):
+                raise ValueError("Expected a boolean")
+            return value
+
+        return check
+
+
+class Integer(Field):
+    def __init__(self, min=None, max=None, **kwargs):
+        super(Integer, self).__init__(**kwargs)
+        self.min = min
+        self.max = max
+
+    def validator(self):
+        minimum = self.min
+        maximum = self.max
+
+        def check(value):
+            if not isinstance(value, int) or isinstance(value, bool):
+                raise ValueError("Expected an integer")
+            if minimum is not None and value < minimum:
+                raise ValueError("Must be at least {}".format(minimum))
+            if maximum is not None and value > maximum:
+                raise ValueError("Must be at most {}".format(maximum))
+            return value
+
+        return check
+
+
+class Float(Integer):
+    def validator(self):
+        minimum = self.min
+        maximum = self.max
+
+        def check(value):
+            if not isinstance(value, (int, float)) or isinstance(value, bool):
+                raise ValueError("Expected a number")
+            if minimum is not None and value < minimum:
+                raise ValueError("Must be at least {}".format(minimum))
+            if maximum is not None and value > maximum:
+                raise ValueError("Must be at most {}".format(maximum))
+            return float(value)
+
+        return check
+
+
+class String(Field):
+    def __init__(self, min_length=None, max_length=None, pattern=None, **kwargs):
+        """
+        Arguments:
+            pattern     Regular expression the whole string must match
+        """
+        super(String, self).__init__(**kwargs)
+        self.min_length = min_length
+        self.max_length = max_length
+        self.pattern = pattern
+
+    def validator(self):
+        min_length = self.min_length
+        max_length = self.max_length
+        match = re.compile(self.pattern).fullmatch if self.pattern else None
+
+        def check(value):
+            if not isinstance(value, str):
+                raise ValueError("Expected a string")
+            if min_length is not None and len(value) < min_length:
+                raise ValueError("Must be at least {} characters".format(min_length))
+            if max_length is not None and len(value) > max_length:
+                raise ValueError("Must be at most {} characters".format(max_length))
+            if match and not match(value):
+                raise ValueError("Invalid format")
+            return value
+
+        return check
+
+
+class Choice(Field):
+    """
+    One of a set of values
+    """
+
+    def __init__(self, choices, **kwargs):
+        super(Choice, self).__init__(**kwargs)
+        self.choices = choices
+
+    def validator(self):
+        choices = frozenset(self.choices)
+
+        def check(value):
+            try:
+                if value in choices:
+                    return value
+            except TypeError:
+                pass
+            raise ValueError("Unexpected value")
+
+        return check
+
+
+class IPAddress(Field):
+    """
+    An IPv4 or IPv6 address, cleaned to its compressed form
+    """
+
+    def __init__(
+        self,
+        version=None,
+        allow_private=True,
+        allow_loopback=True,
+        allow_multicast=True,
+        **kwargs
+    ):
+        """
+        Arguments:
+            version     ``4`` or ``6`` to only allow that version
+        """
+        super(IPAddress, self).__init__(**kwargs)
+        self.version = version
+        self.allow_private = allow_private
+        self.allow_loopback = allow_loopback
+        self.allow_multicast = allow_multicast
+
+    def validator(self):
+        version = self.version
+        allow_private = self.allow_private
+        allow_loopback = self.allow_loopback
+        allow_multicast = self.allow_multicast
+
+        def check(value):
+            if not isinstance(value, str):
+                raise ValueError("Expected a string")
+            try:
+                addr = ipaddress.ip_address(value)
+            except ValueError:
+                raise ValueError("Invalid IP")
+            if version and addr.version != version:
+                raise ValueError("IPv{} only".format(version))
+            if (
+                (not allow_private and addr.is_private)
+                or (not allow_loopback and addr.is_loopback)
+                or (not allow_multicast and addr.is_multicast)
+            ):
+                raise ValueError("IP not allowed")
+            return str(addr)
+
+        return check
+
+
+class Network(Field):
+    """
+    An IPv4 or IPv6 network in CIDR notation, cleaned to its compressed form
+    """
+
+    def __init__(self, version=None, strict=True, allow_private=True, **kwargs):
+        """
+        Arguments:
+            version     ``4`` or ``6`` to only allow that version
+            strict      If ``True``, reject networks with host bits set
+        """
+        super(Network, self).__init__(**kwargs)
+        self.version = version
+        self.strict = strict
+        self.allow_private = allow_private
+
+    def validator(self):
+        version = self.version
+        strict = self.strict
+        allow_private = self.allow_private
+
+        def check(value):
+            if not isinstance(value, str):
+                raise ValueError("Expected a string")
+            try:
+                network = ipaddress.ip_network(value, strict=strict)
+            except ValueError:
+                raise ValueError("Invalid network")
+            if version and network.version != version:
+                raise ValueError("IPv{} only".format(version))
+            if not allow_private and network.is_private:
+                raise ValueError("Network not allowed")
+            return str(network)
+
+        return check
+
+
+class List(Field):
+    """
+    A list of values which match another field
+    """
+
+    def __init__(self, field, min_length=None, max_length=None, **kwargs):
+        super(List, self).__init__(**kwargs)
+        self.field = field
+        self.min_length = min_length
+        self.max_length = max_length
+
+    def validator(self):
+        check_item = self.field.validator()
+        min_length = self.min_length
+        max_length = self.max_length
+
+        def check(value):
+            if not isinstance(value, list):
+                raise ValueError("Expected a list")
+            if min_length is not None and len(value) < min_length:
+                raise ValueError("Must have at least {} items".format(min_length))
+            if max_length is not None and len(value) > max_length:
+                raise ValueError("Must have at most {} items".format(max_length))
+            cleaned = []
+            for index, item in enumerate(value):
+                try:
+                    cleaned.append(check_item(item))
+                except ValueError as e:
+                    raise ValueError("Item {}: {}".format(index, e))
+            return cleaned
+
+        return check
+
+
+def compile_schema(schema):
+    """
+    Compile a dict of field names and fields into a validator
+
+    The validator takes the request data, and returns a dict of cleaned data or
+    raises ``ValidationError``.
+    """
+    fields = tuple(
+        (name, field.required, field.default, field.validator())
+        for name, field in schema.items()
+    )
+    names = frozenset(schema)
+
+    def validate(data):
+        if data is None:
+            data = {}
+        elif not isinstance(data, dict):
+            raise ValidationError({"": "Expected an object"})
+
+        cleaned = {}
+        errors = {}
+        for name, required, default, check in fields:
+            value = data.get(name)
+            if value is None:
+                if required:
+                    errors[name] = "Required"
+                else:
+                    cleaned[name] = default
+                continue
+            try:
+                cleaned[name] = check(value)
+            except ValueError as e:
+                errors[name] = str(e)
+
+        if not names.issuperset(data):
+            for name in data:
+                if name not in names:
+                    errors[str(name)] = "Unexpected field"
+
+        if errors:
+            raise ValidationError(errors)
+        return cleaned
+
+    return validate
@@ -1,60 +1,202 @@
 """
 Regent serialiser
 
-Serialises a class's attributes to JSON
+Serialises a class's attributes to bytes, for storing operations and their
+auth objects while they wait for authorisation.
+
+Classes are identified by a type id, which defaults to ``module:ClassName``.
+Classes are added to the registry when they are registered with the service
+or first serialised, so that type ids can be resolved without importing
+anything. A frozen object is a codec id byte followed by the encoded list
+``[type_id, version, attrs]``; msgpack is used if it is installed, otherwise
+compact JSON.
 """
 import json
+from functools import lru_cache
 from importlib import import_module
 
+from ..codecs import CODECS, JsonCodec, MsgpackCodec
+from ..exceptions import ProcessError
+
+
+CODEC = CODECS[MsgpackCodec.id] if MsgpackCodec.available else CODECS[JsonCodec.id]
+
 
 def get_class_from_name(module_name, class_name):
     """
     Given a module and class name, return the class
     """
     module = import_module(module_name)
-    if not hasattr(module, class_name):
-        raise ValueError(
-            "Cannot serialise {} - not found in {}".format(
-                class_name,
-                module_name,
+    obj = module
+    for name in class_name.split("."):
+        if not hasattr(obj, name):
+            raise ValueError(
+                "Cannot serialise {} - not found in {}".format(
+                    class_name,
+                    module_name,
+                )
             )
-        )
+        obj = getattr(obj, name)
+
+    return obj
+
+
+@lru_cache(maxsize=None)
+def get_slot_names(cls):
+    """
+    Return the names of the slots declared by a class and its bases
+    """
+    names = []
+    for base in reversed(cls.__mro__):
+        slots = base.__dict__.get("__slots__", ())
+        if isinstance(slots, str):
+            slots = (slots,)
+        names.extend(name for name in slots if name not in names)
+    return tuple(names)
+
 
-    return getattr(module, class_name)
+@lru_cache(maxsize=None)
+def has_public_slots(cls):
+    """
+    Check if a class has slots for attributes which are serialised
+    """
+    return any(not name.startswith("_") for name in get_slot_names(cls))
 
 
 class Serialisable(object):
+    """
+    Object which can be serialised
+
+    Subclasses may declare ``__slots__`` for their attributes instead of using
+    an instance ``__dict__``.
+    """
+
+    __slots__ = ()
+
+    #: Stable id for the class in storage. Defaults to ``module:ClassName``;
+    #: set it to keep stored objects loadable if the class is moved or renamed.
+    type_id = None
+
+    #: Version of the attributes. Increase it when they change, and implement
+    #: ``upgrade()`` to convert attributes stored by older versions.
+    version = 1
+
     def serialise(self):
         """
-        Return a tuple representing this object instance
+        Return bytes representing this object instance
+        """
+        return registry.dumps(self)
+
+    def get_attrs(self):
+        """
+        Return a dict of instance attributes which don't start with an
+        underscore, from slots and the instance ``__dict__``
+        """
+        attrs = {}
+        for name in get_slot_names(type(self)):
+            if not name.startswith("_") and hasattr(self, name):
+                attrs[name] = getattr(self, name)
+        if hasattr(self, "__dict__"):
+            attrs.update((k, v) for k, v in vars(self).items() if not k.startswith("_"))
+        return attrs
+
+    @classmethod
+    def upgrade(cls, attrs, version):
+        """
+        Convert attributes stored by an older version of the class
+
+        Returns the attributes for the current version
+        """
+        return attrs
+
+
+class Registry(object):
+    """
+    Map of type ids to ``Serialisable`` classes
+    """
+
+    def __init__(self):
+        self.classes = {}
+        self.type_ids = {}
+
+    def register(self, cls):
+        """
+        Add a class to the registry
 
-            (module_name, class_name, attrs)
+        Returns its type id
         """
-        module_name = self.__module__
-        class_name = self.__class__.__name__
+        type_id = cls.__dict__.get("type_id") or "{}:{}".format(
+            cls.__module__, cls.__qualname__
+        )
+        self.classes[type_id] = cls
+        self.type_ids[cls] = type_id
+        return type_id
 
-        # Test it's actually there
-        get_class_from_name(module_name, class_name)
+    def get_class(self, type_id):
+        """
+        Return the class for a type id, importing it if it hasn't been
+        registered
+        """
+        cls = self.classes.get(type_id)
+        if cls is not None:
+            return cls
 
-        # Serialise the attributes
-        attrs = self.serialise_attrs()
+        module_name, sep, class_name = type_id.partition(":")
+        if not sep:
+            raise ValueError("Unknown type {}".format(type_id))
+        cls = get_class_from_name(module_name, class_name)
+        self.register(cls)
+        return cls
 
-        return (module_name, class_name, attrs)
+    def dumps(self, obj):
+        """
+        Return an object as bytes
+        """
+        cls = type(obj)
+        type_id = self.type_ids.get(cls) or self.register(cls)
+        return bytes([CODEC.id]) + CODEC.encode([type_id, cls.version, obj.get_attrs()])
 
-    def serialise_attrs(self):
+    def loads(self, frozen):
         """
-        Serialise all instance attributes which don't start with an underscore
+        Return an instantiated object from bytes returned by ``dumps()``
         """
-        attrs = {k: v for k, v in vars(self).items() if not k.startswith("_")}
-        return json.dumps(attrs)
+        codec = CODECS.get(frozen[0]) if frozen else None
+        if codec is None or not codec.available:
+            raise ValueError("Unknown serialisation format")
+        try:
+            type_id, version, attrs = codec.decode(frozen[1:])
+        except (ProcessError, TypeError, ValueError):
+            raise ValueError("Invalid serialised object")
+
+        cls = self.get_class(type_id)
+        if version != cls.version:
+            attrs = cls.upgrade(attrs, version)
 
+        obj = cls()
+        if has_public_slots(cls) or not hasattr(obj, "__dict__"):
+            for key, value in attrs.items():
+                setattr(obj, key, value)
+        else:
+            obj.__dict__.update(attrs)
+        return obj
 
-def deserialise(module_name, class_name, attrs):
+
+#: Default registry
+registry = Registry()
+
+
+def deserialise(frozen):
     """
     Return an instantiated Serialisable object which was previously serialised
+
+    Also accepts the ``(module_name, class_name, attrs)`` tuples stored by
+    older versions.
     """
-    cls = get_class_from_name(module_name, class_name)
-    obj = cls()
-    for key, value in attrs.items():
-        setattr(obj, key, value)
-    return obj
+    if isinstance(frozen, (tuple, list)):
+        module_name, class_name, attrs = frozen
+        obj = get_class_from_name(module_name, class_name)()
+        for key, value in json.loads(attrs).items():
+            setattr(obj, key, value)
+        return obj
+
+    return registry.loads(frozen)
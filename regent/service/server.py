@@ -1,92 +1,730 @@
 """
 Regent service
 
-Socket Protocol
----------------
-
-Message is a JSON string, with its length prepended in first 4 bytes.
-
-Version: 1
-
-Once decoded, the JSON string contains:
-    {
-        'version':  1,
-        'data':     <json data object>
-    }
+See ``regent.socket`` for the socket protocol.
 """
+import heapq
+import hmac
+import inspect
+import itertools
+import logging
+import selectors
+import socket
 import time
-import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
 
-from ..constants import SOCKET_TIMEOUT
-from ..debug import debug
-from ..exceptions import DoesNotExist, ProcessError, SocketError
-from ..socket import Socket
+from ..constants import (
+    KEEPALIVE_TIMEOUT,
+    SOCKET_MAX_SIZE,
+    SOCKET_PENDING,
+    SOCKET_TIMEOUT,
+)
+from ..exceptions import (
+    DeadlineExceeded,
+    DoesNotExist,
+    PermissionDenied,
+    ProcessError,
+    ServiceBusy,
+    SocketError,
+    ValidationError,
+)
+from ..log import Redacted, Sampler, logger, request_logger
+from ..socket import ENCODE_ERRORS, Socket, peer_credentials
 from . import storage
 from .auth import Auth
-from .serialiser import deserialise
+from .cache import MISSING, Cache, Coalescer, make_key
+from .metrics import Metrics, MetricsOperation
+from .operation import new_uid, progress_handler
+from .outbox import Outbox
+from .prefork import memory_usage
+from .schema import compile_schema
+from .serialiser import deserialise, get_class_from_name, registry
+from .storage import delivery_record
+from .throttle import Throttle
+
+
+def perform(op):
+    """
+    Perform an operation
+
+    Module-level so it can be pickled and sent to a process pool worker.
+    Generators can't be returned from another process, so any chunks are
+    collected into a list.
+    """
+    result = op.perform()
+    if inspect.isgenerator(result):
+        result = list(result)
+    return result
+
+
+def expired(deadline):
+    """
+    Check if a request's deadline has passed
+    """
+    return isinstance(deadline, (int, float)) and deadline < time.time()
+
+
+def import_operation(path):
+    """
+    Import an operation class from a path of the form ``module.ClassName`` or
+    ``module:ClassName``
+    """
+    module_name, sep, class_name = path.partition(":")
+    if not sep:
+        module_name, _, class_name = path.rpartition(".")
+    return get_class_from_name(module_name, class_name)
+
+
+class Connection(object):
+    """
+    A connected client, which may have several requests in flight
+
+    The client is closed when the server has stopped reading from it and every
+    request has been answered.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.requests = 0
+        self.peer = peer_credentials(client.socket)
+        self.dispatched = time.perf_counter()
+        self.active = time.monotonic()
+        self.refs = 1
+        self.lock = Lock()
+        self.write_lock = Lock()
+        # Set once a request has passed the secret check
+        self.authenticated = False
+
+    def acquire(self):
+        with self.lock:
+            self.refs += 1
+
+    def release(self):
+        with self.lock:
+            self.refs -= 1
+            if self.refs:
+                return
+
+        try:
+            self.client.close()
+        except SocketError:
+            logger.debug("Error closing client")
+
+    def write(self, data):
+        with self.write_lock:
+            self.client.write(data)
 
 
 class Service(object):
+    coalescer_class = Coalescer
+    limit_class = BoundedSemaphore
+    outbox_class = Outbox
+
     def __init__(
         self,
         socket_path,
         socket_secret,
         db_path=None,
         socket_timeout=SOCKET_TIMEOUT,
+        threads=None,
+        processes=None,
+        keepalive_timeout=KEEPALIVE_TIMEOUT,
+        throttle=None,
+        socket_max_size=SOCKET_MAX_SIZE,
+        db=None,
+        metrics=False,
+        trace_sample=1,
+        background=2,
+        socket_fd=None,
+        socket_backlog=SOCKET_PENDING,
+        queue_size=None,
+        outbox=None,
     ):
         """
         Create the socket path
+
+        Arguments:
+            db_path     Path to a private directory for a SQLite database of
+                        operations waiting for authorisation. If not set,
+                        they are kept in memory and lost on restart.
+            db          Storage instance, such as ``storage.Memory(ttl=3600)``.
+                        Overrides ``db_path``.
+            threads     Number of worker threads to handle requests. If not
+                        set, requests are handled one at a time in the main
+                        server loop.
+            processes   Number of worker processes for operations registered
+                        with ``process=True``. If not set, they are performed
+                        in the thread which is handling the request.
+            keepalive_timeout
+                        Number of seconds to keep an idle keep-alive
+                        connection open
+            throttle    ``Throttle`` instance to delay responses to peers who
+                        fail the secret check
+            socket_max_size
+                        Maximum size of a request, in bytes
+            metrics     If ``True``, collect metrics in ``self.metrics``
+            trace_sample
+                        Fraction of requests to trace when the
+                        ``regent.request`` logger is enabled for ``DEBUG``
+            background  Number of worker threads for operations requested
+                        in the background
+            socket_fd   File descriptor of a listening socket to use instead
+                        of binding to ``socket_path``, such as the one from
+                        ``regent.socket.systemd_fd()``
+            socket_backlog
+                        Max number of connections waiting to be accepted
+            queue_size  Max number of requests waiting for a worker thread.
+                        Further requests are refused with a ``Service busy``
+                        error.
+            outbox      ``Outbox`` instance to send auth requests for ``Auth``
+                        classes which set ``outbox = True``. If one is passed
+                        it is started with the service, so requests left
+                        pending by a restart are sent; otherwise the default
+                        outbox isn't started until a request is added to it.
         """
         self.operations = {}
+        self.operation_names = {}
+        self.lazy = {}
+        self.register_lock = Lock()
+        self.limits = {}
+        self.caches = {}
+        self.validators = {}
+        self.process_operations = set()
+        self.threads = threads
+        self.processes = processes
+        self.background = background
+        self.thread_pool = None
+        self.batch_pool = None
+        self.background_pool = None
+        self.process_pool = None
+        self.keepalive_timeout = keepalive_timeout
+        self.idle = []
+        self.idle_lock = Lock()
+        self.ready = []
+        self.throttle = throttle or Throttle()
+        self.delayed = []
+        self.delayed_ids = itertools.count()
+        self.delayed_lock = Lock()
+        self.coalescer = self.coalescer_class()
+        self.stopping = False
+        self.handled = 0
+        self.queue_size = queue_size
+        self.queued = 0
+        self.queue_lock = Lock()
 
-        if db_path:
+        # Worker limits, set by ``Prefork``
+        self.max_requests = None
+        self.max_memory = None
+
+        if db:
+            self.db = db
+        elif db_path:
             self.db = storage.Database(db_path)
         else:
             self.db = storage.Memory()
 
-        self.socket = Socket(socket_path, socket_secret, socket_timeout)
+        self.outbox = outbox or self.outbox_class()
+        self.outbox.db = self.db
+        self.outbox_eager = outbox is not None
+        self.outbox_started = False
+        self.outbox_lock = Lock()
+
+        self.tracing = False
+        self.sampler = Sampler(trace_sample)
+
+        self.metrics = None
+        if metrics:
+            self.metrics = Metrics()
+            if hasattr(self.db, "stats"):
+                self.metrics.collect(self.storage_stats)
+
+        self.socket = Socket(
+            socket_path,
+            socket_secret,
+            socket_timeout,
+            socket_max_size,
+            fd=socket_fd,
+            backlog=socket_backlog,
+        )
 
     def listen(self):
         """
-        Main server loop
+        Listen on the socket and run the server loop
         """
         self.socket.listen()
+        self.serve()
 
-        while 1:
-            client = self.socket.accept()
-            debug("Connected")
+    def serve(self):
+        """
+        Main server loop, on a socket which is already listening
 
-            try:
-                request = client.read()
-                debug("Received: {}".format(request))
-                uid, data = self.process(request)
-                client.write(
-                    {
-                        "success": True,
-                        "uid": uid,
-                        "data": data,
-                    }
-                )
+        Accepts new connections and watches idle keep-alive connections, and
+        hands them to ``handle()`` when there is a request to read.
 
-            except Exception as e:
-                # Try to report the error
-                debug("Error processing request:", e, traceback.format_exc())
-                try:
-                    client.write(
-                        {
-                            "error": "{}".format(e),
-                        }
-                    )
-                except SocketError:
-                    # Fail silently if we can't talk to the client
-                    # That may have been the original error
-                    debug("Error writing to client")
+        Runs until ``stop()`` is called, or the worker reaches its request or
+        memory limit, then finishes the requests in progress and returns.
+        """
+        # Other processes may be accepting from the same socket
+        self.socket.socket.setblocking(False)
+        self.tracing = request_logger.isEnabledFor(logging.DEBUG)
 
-            try:
-                client.close()
-            except SocketError:
-                debug("Error closing client")
-                continue
+        if self.threads:
+            self.thread_pool = ThreadPoolExecutor(max_workers=self.threads)
+            # Separate pool so batches can't wait on themselves
+            self.batch_pool = ThreadPoolExecutor(max_workers=self.threads)
+        if self.processes:
+            self.process_pool = ProcessPoolExecutor(max_workers=self.processes)
+        self.background_pool = ThreadPoolExecutor(max_workers=self.background)
+        if self.outbox_eager:
+            self.start_outbox()
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket.socket, selectors.EVENT_READ)
+        self.wake_reader, self.wake_writer = socket.socketpair()
+        self.wake_reader.setblocking(False)
+        self.wake_writer.setblocking(False)
+        self.selector.register(self.wake_reader, selectors.EVENT_READ)
+        swept = time.monotonic()
+
+        while not self.stopping:
+            timeout = self.respond_delayed()
+            if self.ready:
+                timeout = 0
+            for key, events in self.selector.select(timeout=timeout):
+                if key.fileobj is self.socket.socket:
+                    try:
+                        client = self.socket.accept()
+                    except BlockingIOError:
+                        # Another worker got there first
+                        continue
+                    logger.debug("Connected")
+                    self.dispatch(Connection(client))
+
+                elif key.fileobj is self.wake_reader:
+                    self.woken()
+
+                else:
+                    self.selector.unregister(key.fileobj)
+                    self.dispatch(key.data)
+
+            # Pipelined requests which were already buffered
+            ready, self.ready = self.ready, []
+            for connection in ready:
+                self.dispatch(connection)
+
+            # Close keep-alive connections which have been idle too long
+            now = time.monotonic()
+            if now - swept > 1:
+                swept = now
+                self.close_idle(now - self.keepalive_timeout)
+                if self.exhausted():
+                    self.stop()
+
+        self.shutdown()
+
+    def stop(self):
+        """
+        Stop the server loop
+
+        Safe to call from a signal handler or another thread. The loop stops
+        within a second.
+        """
+        self.stopping = True
+
+    def exhausted(self):
+        """
+        Check if the worker has reached its request or memory limit
+        """
+        if self.max_requests and self.handled >= self.max_requests:
+            logger.info("Worker reached its request limit")
+            return True
+        if self.max_memory and memory_usage() > self.max_memory:
+            logger.info("Worker reached its memory limit")
+            return True
+        return False
+
+    def shutdown(self):
+        """
+        Wait for requests and background operations in progress, then close
+        the remaining connections
+        """
+        self.stop_outbox()
+        for pool in (
+            self.thread_pool,
+            self.batch_pool,
+            self.background_pool,
+            self.process_pool,
+        ):
+            if pool:
+                pool.shutdown()
+
+        self.respond_delayed(force=True)
+        with self.idle_lock:
+            idle, self.idle = self.idle, []
+        idle.extend(self.ready)
+        idle.extend(key.data for key in self.selector.get_map().values() if key.data)
+        for connection in idle:
+            connection.release()
+
+        self.selector.close()
+        self.wake_reader.close()
+        self.wake_writer.close()
+
+    def dispatch(self, connection):
+        """
+        Handle the next request on the connection, in a worker thread if
+        available
+        """
+        connection.dispatched = time.perf_counter()
+        if self.thread_pool:
+            if self.queue_size:
+                with self.queue_lock:
+                    busy = self.queued >= self.queue_size
+                    if not busy:
+                        self.queued += 1
+                if busy:
+                    self.reject(connection)
+                    return
+
+            if self.metrics:
+                self.metrics.add("queued", 1)
+            self.thread_pool.submit(self.handle, connection)
+        else:
+            self.handle(connection)
+
+    def reject(self, connection):
+        """
+        Read the next request on the connection and refuse it because the
+        queue is full
+        """
+        try:
+            request = self.read_rejected(connection)
+        except Exception as e:
+            logger.debug("Error reading request: %s", e)
+            connection.release()
+            return
+
+        if self.metrics:
+            self.metrics.inc("busy")
+        self.respond(connection, request, self.error_response(ServiceBusy()))
+        if isinstance(request, dict) and request.get("keepalive"):
+            # Via the server loop, so a pipeline of refused requests can't
+            # recurse
+            self.return_idle(connection)
+        else:
+            connection.release()
+
+    def read_rejected(self, connection):
+        """
+        Read a request which will be refused, without waiting long for it
+        """
+        reader = connection.client.reader
+        timeout, reader.timeout = reader.timeout, min(reader.timeout, 0.1)
+        try:
+            return connection.client.read()
+        finally:
+            reader.timeout = timeout
+
+    def wait(self, connection):
+        """
+        Return a keep-alive connection to the server loop to wait for its next
+        request
+        """
+        if not self.thread_pool:
+            # Already in the server loop
+            self.resume(connection)
+            return
+
+        if connection.client.has_message():
+            # Pipelined request already buffered
+            self.dispatch(connection)
+            return
+
+        self.return_idle(connection)
+
+    def return_idle(self, connection):
+        """
+        Pass a keep-alive connection from a worker thread to the server loop
+        """
+        with self.idle_lock:
+            self.idle.append(connection)
+        self.wake()
+
+    def wake(self):
+        """
+        Wake the server loop from a worker thread
+        """
+        try:
+            self.wake_writer.send(b"\0")
+        except BlockingIOError:
+            # Server loop already has a wake-up pending
+            pass
+
+    def woken(self):
+        """
+        Resume connections returned by ``wait()`` from worker threads
+        """
+        try:
+            while self.wake_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        with self.idle_lock:
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            self.resume(connection)
+
+    def resume(self, connection):
+        """
+        Dispatch the next request on a keep-alive connection from the server
+        loop if it has already been received, otherwise watch for it
+
+        Buffered requests are dispatched on the next pass of the loop rather
+        than straight away, so a long pipeline can't exhaust the stack.
+        """
+        if connection.client.has_message():
+            self.ready.append(connection)
+        else:
+            self.watch(connection)
+
+    def watch(self, connection):
+        """
+        Watch a keep-alive connection for its next request
+        """
+        connection.active = time.monotonic()
+        self.selector.register(
+            connection.client.socket,
+            selectors.EVENT_READ,
+            connection,
+        )
+
+    def close_idle(self, cutoff):
+        """
+        Close keep-alive connections which have been idle since the cutoff
+        """
+        for key in list(self.selector.get_map().values()):
+            connection = key.data
+            if connection and connection.active < cutoff:
+                logger.debug("Closing idle connection")
+                self.selector.unregister(key.fileobj)
+                connection.release()
+
+    def handle(self, connection):
+        """
+        Read and respond to the next request on a connection
+
+        If the request asks for the connection to be kept alive, it is returned
+        to the server loop to wait for the next request before this one is
+        processed, so that pipelined requests can be processed concurrently.
+        """
+        if self.queue_size and self.thread_pool:
+            with self.queue_lock:
+                self.queued -= 1
+
+        metrics = self.metrics
+        if metrics:
+            if self.thread_pool:
+                metrics.add("queued", -1)
+            start = metrics.observe("accept", None, connection.dispatched)
+
+        client = connection.client
+        try:
+            request = client.read()
+        except Exception as e:
+            # A keep-alive client closing its connection is not an error
+            if not connection.requests or not isinstance(e, SocketError):
+                logger.debug("Error reading request: %s", e, exc_info=True)
+                self.respond(connection, None, {"error": "{}".format(e)})
+                if metrics:
+                    metrics.inc("errors")
+            connection.release()
+            return
+
+        if metrics:
+            # Not labelled, as the op name hasn't been checked yet
+            metrics.observe("read", None, start)
+            metrics.add("in_flight", 1)
+
+        connection.requests += 1
+        self.handled += 1
+        if isinstance(request, dict) and request.get("keepalive"):
+            connection.acquire()
+            self.wait(connection)
+
+        if self.tracing and self.sampler():
+            self.trace(request, connection.peer)
+
+        if not connection.authenticated:
+            hold = self.throttle.wait(connection.peer)
+            if hold:
+                # The peer is backed off after failing the secret check, so
+                # don't check this request's secret until its turn
+                self.delay(connection, request, None, hold)
+                return
+
+        self.answer(connection, request)
+
+    def answer(self, connection, request):
+        """
+        Process a request which has been read, and write the response
+        """
+        metrics = self.metrics
+        try:
+            uid, data = self.process(request)
+            connection.authenticated = True
+            op_name = self.metric_label(request)
+            if inspect.isgenerator(data):
+                self.stream(connection, request, data)
+                data = None
+            response = {
+                "success": True,
+                "uid": uid,
+                "data": data,
+            }
+
+        except PermissionDenied as e:
+            # Basic protection against brute-forcing: delay the response to
+            # this connection, without holding up anyone else
+            logger.debug("Permission denied for peer %s", connection.peer)
+            delay = self.throttle.failed(connection.peer)
+            self.delay(connection, request, {"error": "{}".format(e)}, delay)
+            if metrics:
+                metrics.inc("requests")
+                metrics.inc("denied")
+                metrics.add("in_flight", -1)
+            return
+
+        except Exception as e:
+            # Only raised once the secret has been checked
+            connection.authenticated = True
+            op_name = self.metric_label(request)
+            # Try to report the error
+            logger.debug("Error processing request: %s", e, exc_info=True)
+            response = self.error_response(e)
+            if metrics:
+                metrics.inc("errors", op_name)
+
+        if metrics:
+            metrics.inc("requests", op_name)
+            start = time.perf_counter()
+        self.respond(connection, request, response)
+        if metrics:
+            metrics.observe("write", op_name, start)
+            metrics.add("in_flight", -1)
+        connection.release()
+
+    def trace(self, request, peer):
+        """
+        Log a request to the ``regent.request`` logger
+        """
+        extra = {"peer": peer}
+        if isinstance(request, dict):
+            for field in ("op", "id", "uid"):
+                if field in request:
+                    extra[field] = request[field]
+        request_logger.debug("Received: %s", Redacted(request), extra=extra)
+
+    def delay(self, connection, request, response, seconds):
+        """
+        Write a response and release the connection after a delay
+
+        If ``response`` is ``None``, the request is answered after the delay
+        instead.
+        """
+        due = time.monotonic() + seconds
+        with self.delayed_lock:
+            heapq.heappush(
+                self.delayed,
+                (due, next(self.delayed_ids), connection, request, response),
+            )
+        if self.thread_pool:
+            self.wake()
+
+    def respond_delayed(self, force=False):
+        """
+        Write any delayed responses which are due, or all of them if
+        ``force`` is set
+
+        Returns the number of seconds the server loop can wait for the next
+        """
+        now = time.monotonic()
+        due = []
+        with self.delayed_lock:
+            while self.delayed and (force or self.delayed[0][0] <= now):
+                due.append(heapq.heappop(self.delayed))
+            wait = self.delayed[0][0] - now if self.delayed else 1
+
+        for _, _, connection, request, response in due:
+            if response is None:
+                if not force:
+                    self.answer_held(connection, request)
+                    continue
+                # Stopping before its turn
+                response = self.error_response(ServiceBusy())
+                if self.metrics:
+                    self.metrics.add("in_flight", -1)
+            self.respond(connection, request, response)
+            connection.release()
+        return min(wait, 1)
+
+    def answer_held(self, connection, request):
+        """
+        Answer a request which was held by the throttle, in a worker thread if
+        available
+        """
+        if self.thread_pool:
+            self.thread_pool.submit(self.answer, connection, request)
+        else:
+            self.answer(connection, request)
+
+    def respond(self, connection, request, response):
+        """
+        Write a response, tagged with the request's correlation id if it had
+        one
+        """
+        if isinstance(request, dict) and "id" in request:
+            response["id"] = request["id"]
+        try:
+            connection.write(response)
+        except SocketError:
+            # Fail silently if we can't talk to the client
+            # That may have been the original error
+            logger.debug("Error writing to client")
+        except ENCODE_ERRORS as e:
+            # The codec can't encode the result, so report that instead
+            logger.debug("Error encoding response: %s", e, exc_info=True)
+            if "error" not in response:
+                self.respond(connection, request, self.error_response(e))
+
+    def stream(self, connection, request, chunks):
+        """
+        Write each chunk of a streamed response as a separate message
+
+        Writes block while the client is slow to read, which pauses the
+        operation rather than buffering its output. The generator is closed if
+        the client goes away.
+        """
+        try:
+            for chunk in chunks:
+                message = {"chunk": chunk}
+                if "id" in request:
+                    message["id"] = request["id"]
+                connection.write(message)
+        finally:
+            chunks.close()
+
+    def error_response(self, error):
+        """
+        Return the response for an error processing a request
+        """
+        response = {
+            "error": "{}".format(error),
+        }
+        if isinstance(error, ValidationError):
+            response["errors"] = error.errors
+        return response
 
     def process(self, request):
         """
@@ -95,15 +733,66 @@ class Service(object):
         Returns uid and response, raises ProcessError if anything goes wrong
         """
         # Check the secret
-        if "secret" not in request or request["secret"] != self.socket.secret:
-            # Auth failed.
-            # Sleep for 1 sec - very basic protection against brute-forcing.
-            # Given someone would already have shell access to the server
-            # though to be able to write to the service, by the time this
-            # becomes an issue you probably have more serious problems.
-            time.sleep(1)
-            raise ProcessError("Permission denied")
+        metrics = self.metrics
+        if metrics:
+            start = time.perf_counter()
+        if not self.check_secret(request):
+            # Auth failed - the connection handler will delay the response
+            raise PermissionDenied()
+        if metrics:
+            metrics.observe("secret", None, start)
+        self.check_deadline(request)
+
+        if "batch" in request:
+            return None, self.process_batch(request)
+        if "job" in request:
+            return None, self.load_job(request["job"])
+        if "delivery" in request:
+            return None, self.load_delivery(request["delivery"])
+        return self.process_op(request, stream=request.get("stream") is True)
+
+    def process_batch(self, request):
+        """
+        Process a batch of operations which share the request's secret
+
+        Items are processed in order, or concurrently if the request sets
+        ``parallel`` and the service has a thread pool.
+
+        Returns a list with a response for each item
+        """
+        items = request["batch"]
+        if not isinstance(items, list):
+            raise ProcessError("Invalid message: batch must be a list")
+
+        if request.get("parallel") and self.batch_pool:
+            return list(self.batch_pool.map(self.process_item, items))
+        return [self.process_item(item) for item in items]
+
+    def process_item(self, item):
+        """
+        Process an item from a batch
+
+        Returns the response for the item
+        """
+        if not isinstance(item, dict):
+            return {"error": "Invalid message: batch item must be an object"}
+
+        try:
+            uid, data = self.process_op(item)
+        except Exception as e:
+            logger.debug("Error processing batch item: %s", e, exc_info=True)
+            if self.metrics:
+                self.metrics.inc("errors", item.get("op"))
+            return self.error_response(e)
+        return {"success": True, "uid": uid, "data": data}
+
+    def process_op(self, request, stream=False):
+        """
+        Process a request for a single operation, once the secret has been
+        checked
 
+        Returns uid and response, raises ProcessError if anything goes wrong
+        """
         # Prepare the operation
         if "op" in request:
             # New operation - check it's valid then create it
@@ -129,20 +818,225 @@ class Service(object):
             raise ProcessError("Authorisation failed")
 
         elif isinstance(auth, Auth):
+            if auth.outbox:
+                # Put the operation on hold and send the request later
+                return op.uid, self.op_defer(op, auth)
+
             # Send the auth request
             response = auth.request(op)
 
             # Out-of-stream authorisation required - put operation on hold
-            frozen_op = op.serialise()
-            frozen_auth = auth.serialise()
-            self.db.save(op.uid, frozen_op, frozen_auth)
-
+            self.op_suspend(op, auth)
             return op.uid, response
 
         # Auth ok
-        response = op.perform()
+        if request.get("background") is True:
+            return None, self.submit(op)
+        response = self.perform_cached(op, request, stream)
         return None, response
 
+    def perform_cached(self, op, request, stream):
+        """
+        Perform the operation, or take its result from the cache or from an
+        identical request in progress
+        """
+        deadline = request.get("deadline")
+        if stream:
+            return self.perform(op, stream=True, deadline=deadline)
+
+        cache = self.caches.get(type(op))
+        cache_key = op.cache_key() if cache else None
+        if cache_key is not None:
+            response = cache.get(cache_key)
+            if self.metrics:
+                hit = response is not MISSING
+                self.metrics.inc(
+                    "cache_hits" if hit else "cache_misses", self.get_name(op)
+                )
+            if response is not MISSING:
+                return response
+            generation = cache.generation
+
+        key = self.coalesce_key(op, request, stream)
+        if key:
+            response = self.coalescer.run(key, lambda: self.perform(op))
+        else:
+            response = self.perform(op, deadline=deadline)
+
+        if cache_key is not None:
+            cache.set(cache_key, response, generation)
+        return response
+
+    def coalesce_key(self, op, request, stream):
+        """
+        Return the key to share a new operation's result with identical
+        requests in progress, or ``None`` if it should be performed alone
+        """
+        if not op.coalesce or stream or "op" not in request:
+            return None
+        return make_key(request["op"], request.get("data"))
+
+    def perform(self, op, stream=False, deadline=None):
+        """
+        Perform the operation, respecting its concurrency limit and sending it
+        to the process pool if it was registered as CPU-bound
+
+        If the operation yields its result and ``stream`` is set, returns a
+        generator which holds the limit until it is exhausted; otherwise the
+        chunks are collected into a list.
+
+        Raises ``DeadlineExceeded`` if the ``deadline`` passes while the
+        operation waits for its limit.
+        """
+        limit = self.limits.get(type(op))
+        if limit:
+            limit.acquire()
+            if expired(deadline):
+                limit.release()
+                raise DeadlineExceeded()
+        start = time.perf_counter() if self.metrics else None
+        streaming = False
+        try:
+            if self.process_pool and type(op) in self.process_operations:
+                return self.process_pool.submit(perform, op).result()
+
+            result = op.perform()
+            if inspect.isgenerator(result):
+                if stream:
+                    streaming = True
+                    return self.hold(op, result, limit, start)
+                result = list(result)
+            return result
+        finally:
+            if not streaming:
+                self.performed(op, limit, start)
+
+    def submit(self, op):
+        """
+        Perform an operation in the background
+
+        Returns the record of the job, with the ``job`` id to poll
+        """
+        job_id = new_uid()
+        record = self.save_job(job_id, "pending")
+        self.background_pool.submit(self.run_job, job_id, op)
+        return record
+
+    def run_job(self, job_id, op):
+        """
+        Perform an operation in a background worker and store its result
+        """
+        token = progress_handler.set(
+            lambda progress: self.save_job(job_id, "running", progress=progress)
+        )
+        try:
+            self.save_job(job_id, "running")
+            result = self.perform(op)
+        except Exception as e:
+            logger.debug("Error performing job: %s", e, exc_info=True)
+            self.save_job(job_id, "failed", error="{}".format(e))
+        else:
+            try:
+                self.save_job(job_id, "done", result=result)
+            except Exception as e:
+                # Such as a result the store can't encode
+                logger.error("Error storing job result: %s", e, exc_info=True)
+                self.save_job(job_id, "failed", error="{}".format(e))
+        finally:
+            progress_handler.reset(token)
+
+    def save_job(self, job_id, status, progress=None, result=None, error=None):
+        """
+        Store the record of a background operation
+
+        Returns the record
+        """
+        record = {
+            "job": job_id,
+            "status": status,
+            "progress": progress,
+            "result": result,
+            "error": error,
+        }
+        self.db.save_result(job_id, record)
+        return record
+
+    def load_job(self, job_id):
+        """
+        Return the record of a background operation
+        """
+        try:
+            if not isinstance(job_id, str):
+                raise DoesNotExist()
+            return self.db.load_result(job_id)
+        except DoesNotExist:
+            raise ProcessError("Job not found")
+
+    def load_delivery(self, uid):
+        """
+        Return the record of an auth request sent by the outbox
+        """
+        try:
+            if not isinstance(uid, str):
+                raise DoesNotExist()
+            return self.db.load_delivery(uid)
+        except DoesNotExist:
+            raise ProcessError("Delivery not found")
+
+    def hold(self, op, chunks, limit, start):
+        """
+        Yield the chunks of a streamed result, then release the operation's
+        limit
+        """
+        try:
+            yield from chunks
+        finally:
+            self.performed(op, limit, start)
+
+    def performed(self, op, limit, start):
+        """
+        Record that an operation has finished and release its limit
+        """
+        if self.metrics:
+            self.metrics.observe("perform", self.get_name(op), start)
+        if limit:
+            limit.release()
+        for name in op.invalidates:
+            self.invalidate(name)
+
+    def check_deadline(self, request):
+        """
+        Check the client is still waiting for the response
+
+        Raises ``DeadlineExceeded`` if the request's deadline has passed
+        """
+        if expired(request.get("deadline")):
+            if self.metrics:
+                self.metrics.inc("expired", request.get("op"))
+            raise DeadlineExceeded()
+
+    def metric_label(self, request):
+        """
+        Return the op name to label the metrics of a request which has passed
+        the secret check, or ``None`` if it is not a registered operation
+        """
+        op_name = request.get("op") if isinstance(request, dict) else None
+        if isinstance(op_name, str) and op_name in self.operations:
+            return op_name
+        return None
+
+    def check_secret(self, request):
+        """
+        Check the request has the correct secret
+        """
+        secret = request.get("secret") if isinstance(request, dict) else None
+        if not isinstance(secret, str):
+            return False
+        return hmac.compare_digest(
+            secret.encode("utf-8"),
+            self.socket.secret.encode("utf-8"),
+        )
+
     def op_new(self, op_name, data):
         """
         Create a new operation
@@ -152,14 +1046,26 @@ class Service(object):
             auth    Whether the op wants auth (or is rejecting request)
         """
         # Create new op obj and prepare the data
-        op = self.operations[op_name]()
+        metrics = self.metrics
+        if metrics:
+            start = time.perf_counter()
+        operation = self.get_operation(op_name)
+        validate = self.validators.get(operation)
+        if validate:
+            # Reject invalid data before creating the operation
+            data = validate(data)
+        op = operation()
         try:
             op.prepare(data)
         except ValueError as e:
             raise ProcessError("Invalid data: {}".format(e))
+        if metrics:
+            start = metrics.observe("prepare", op_name, start)
 
         # Ask op if it wants to auth
         auth = op.auth()
+        if metrics:
+            metrics.observe("auth", op_name, start)
 
         return op, auth
 
@@ -171,26 +1077,206 @@ class Service(object):
             op      Operation instance
             auth    Result of processing the auth response
         """
+        op, auth_obj = self.op_load(uid)
+
+        # Process auth
+        if self.metrics:
+            start = time.perf_counter()
+        auth_obj.process(op, data)
+        auth = op.auth_response(auth_obj)
+        if self.metrics:
+            self.metrics.observe("auth", self.get_name(op), start)
+
+        return op, auth
+
+    def op_load(self, uid):
+        """
+        Load an operation on hold and its auth object from the store
+
+        Returns:
+            op      Operation instance
+            auth    Auth instance
+        """
         # Load existing op obj and its auth obj from the store
+        if self.metrics:
+            start = time.perf_counter()
         try:
             frozen_op, frozen_auth = self.db.load(uid)
         except DoesNotExist:
-            raise ProcessError
+            raise ProcessError("Operation not found")
+        if self.metrics:
+            self.metrics.observe("load", None, start)
 
         # Deserialise
         try:
-            op = deserialise(*frozen_op)
-            auth_obj = deserialise(*frozen_auth)
+            op = deserialise(frozen_op)
+            auth = deserialise(frozen_auth)
         except ValueError as e:
             raise ProcessError(
                 "Could not deserialise operation: {}".format(e),
             )
-
-        # Process auth
-        auth_obj.process(op, data)
-        auth = op.auth_response(auth_obj)
+        if self.lazy:
+            self.load_imported(type(op))
 
         return op, auth
 
-    def register(self, name, operation):
+    def op_suspend(self, op, auth):
+        """
+        Put an operation on hold while waiting for out-of-stream authorisation
+
+        Returns the frozen operation and auth object
+        """
+        if self.metrics:
+            start = time.perf_counter()
+        frozen_op = op.serialise()
+        frozen_auth = auth.serialise()
+        self.db.save(op.uid, frozen_op, frozen_auth)
+        if self.metrics:
+            self.metrics.observe("save", None, start)
+        return frozen_op, frozen_auth
+
+    def op_defer(self, op, auth):
+        """
+        Put an operation on hold, and add its auth request to the outbox
+
+        Returns the record of the delivery
+        """
+        self.op_queue(op, auth)
+        self.start_outbox()
+        self.outbox.wake()
+        return delivery_record(op.uid, "pending", 0, None)
+
+    def start_outbox(self):
+        """
+        Start the outbox, if it hasn't been started
+        """
+        with self.outbox_lock:
+            if not self.outbox_started:
+                self.outbox_started = True
+                self.outbox.start()
+
+    def stop_outbox(self):
+        """
+        Stop the outbox, if it has been started
+        """
+        with self.outbox_lock:
+            if self.outbox_started:
+                self.outbox_started = False
+                self.outbox.stop()
+
+    def op_queue(self, op, auth):
+        """
+        Put an operation on hold and add its auth request to the outbox, in a
+        single write to the store
+        """
+        with self.db.batch():
+            frozen_op, frozen_auth = self.op_suspend(op, auth)
+            self.outbox.put(op.uid, frozen_op, frozen_auth)
+
+    def register(self, name, operation, limit=None, process=False):
+        """
+        Register an operation class under the given name
+
+        Arguments:
+            name        Name the client will use to request the operation
+            operation   ``Operation`` subclass, or the path to import it from,
+                        as ``module.ClassName``. A path is not imported until
+                        the operation is first requested.
+            limit       Maximum number of concurrent ``perform()`` calls for
+                        this operation. Further requests will wait for a slot.
+            process     If ``True``, perform the operation in the process
+                        pool. The operation must be picklable.
+        """
+        if isinstance(operation, str):
+            self.operations[name] = operation
+            self.lazy[name] = (limit, process)
+            return
+
         self.operations[name] = operation
+        self.operation_names[operation] = name
+        registry.register(operation)
+        if limit:
+            self.limits[operation] = self.limit_class(limit)
+        if process:
+            self.process_operations.add(operation)
+        if operation.schema is not None:
+            self.validators[operation] = compile_schema(operation.schema)
+        if operation.cache_ttl:
+            self.caches[operation] = Cache(operation.cache_ttl, operation.cache_size)
+
+    def get_operation(self, name):
+        """
+        Return the operation class registered under a name, importing it if it
+        was registered by path
+        """
+        operation = self.operations[name]
+        if not isinstance(operation, str):
+            return operation
+
+        with self.register_lock:
+            operation = self.operations[name]
+            if isinstance(operation, str):
+                try:
+                    cls = import_operation(operation)
+                except (ImportError, ValueError) as e:
+                    logger.error("Could not import operation %s: %s", operation, e)
+                    raise ProcessError("Could not load operation")
+                limit, process = self.lazy.pop(name)
+                self.register(name, cls, limit=limit, process=process)
+                operation = cls
+        return operation
+
+    def load_imported(self, operation):
+        """
+        Finish registering an operation class which was registered by path
+        but has been imported another way, such as by deserialising it
+        """
+        if operation in self.operation_names:
+            return
+        paths = {
+            "{}{}{}".format(operation.__module__, sep, operation.__qualname__)
+            for sep in ".:"
+        }
+        for name in list(self.lazy):
+            if self.operations.get(name) in paths:
+                self.get_operation(name)
+
+    def invalidate(self, name, key=None):
+        """
+        Discard cached results for an operation
+
+        Arguments:
+            name        Name of the operation
+            key         ``cache_key()`` of the result to discard. If not set,
+                        all results are discarded.
+        """
+        cache = self.caches.get(self.operations.get(name))
+        if cache:
+            cache.invalidate(key)
+
+    def register_metrics(self, name="metrics"):
+        """
+        Register a read-only admin operation which returns the metrics
+        """
+        if not self.metrics:
+            raise ValueError("Metrics are not enabled")
+        operation = type(
+            "MetricsOperation",
+            (MetricsOperation,),
+            {"metrics": self.metrics},
+        )
+        self.register(name, operation)
+
+    def get_name(self, op):
+        """
+        Return the name an operation was registered with
+        """
+        return self.operation_names.get(type(op), type(op).__name__)
+
+    def storage_stats(self):
+        """
+        Return storage stats as metrics gauges
+        """
+        return {
+            "storage_{}".format(key): value for key, value in self.db.stats().items()
+        }
@@ -1,47 +1,529 @@
 """
 Storage for service serialisation
 """
+import heapq
+import json
 import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 
+from ..codecs import CODECS
+from ..constants import SOCKET_TIMEOUT
 from ..exceptions import DoesNotExist
+from .serialiser import CODEC
+
+
+#: Number of seconds to keep the result of a background operation
+RESULT_TTL = 3600
+
+#: Minimum number of seconds between deleting expired operations from the
+#: database
+EXPIRE_INTERVAL = 60
+
+#: Statuses of auth request deliveries which have finished
+DELIVERED = ("sent", "failed")
+
+
+def delivery_record(uid, status, attempts, error):
+    """
+    Return the record of an auth request delivery
+    """
+    return {"uid": uid, "status": status, "attempts": attempts, "error": error}
 
 
 class Memory(object):
     """
-    In-memory storage of frozen ops and auth
+    In-memory storage of frozen ops and auth, the results of background
+    operations, and the outbox of auth requests
+
+    Entries can be given a time to live, after which they are discarded, and
+    the number of entries can be capped, in which case the oldest are evicted
+    to make room for new ones.
+
+    Entries are private to the process, so this can't be used with
+    ``Prefork``.
     """
 
-    def __init__(self):
-        self.data = {}
+    #: Whether the store can be shared between processes
+    shared = False
+
+    def __init__(self, ttl=None, max_entries=None, result_ttl=RESULT_TTL):
+        """
+        Arguments:
+            ttl             Number of seconds to keep an entry
+            max_entries     Maximum number of entries to keep, and of results
+            result_ttl      Number of seconds to keep a result after it was
+                            last updated
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.result_ttl = result_ttl
+        self.data = OrderedDict()
+        self.results = OrderedDict()
+        self.deliveries = {}
+        self.expiry = []
+        self.lock = threading.Lock()
+        self.evictions = 0
+        self.expirations = 0
 
     def load(self, uid):
-        if uid not in self.data:
-            raise DoesNotExist()
+        with self.lock:
+            self.expire()
+            if uid not in self.data:
+                raise DoesNotExist()
 
-        frozen_op, frozen_auth = self.data.pop(uid)
+            frozen_op, frozen_auth, expires = self.data.pop(uid)
         return frozen_op, frozen_auth
 
     def save(self, uid, frozen_op, frozen_auth):
-        self.data[uid] = (frozen_op, frozen_auth)
+        with self.lock:
+            self.expire()
+            expires = None
+            if self.ttl:
+                expires = time.monotonic() + self.ttl
+                heapq.heappush(self.expiry, (expires, uid))
+
+            self.data.pop(uid, None)
+            self.data[uid] = (frozen_op, frozen_auth, expires)
+
+            if self.max_entries:
+                while len(self.data) > self.max_entries:
+                    self.data.popitem(last=False)
+                    self.evictions += 1
+
+    @contextmanager
+    def batch(self):
+        """
+        Context manager to group saves, for compatibility with
+        ``Database.batch()``. Saves to memory take effect at once.
+        """
+        yield
+
+    def expire(self):
+        """
+        Discard entries which have passed their time to live
+        """
+        if not self.expiry:
+            return
+
+        now = time.monotonic()
+        while self.expiry and self.expiry[0][0] <= now:
+            expires, uid = heapq.heappop(self.expiry)
+            entry = self.data.get(uid)
+            if entry and entry[2] == expires:
+                del self.data[uid]
+                self.expirations += 1
+
+        # Drop heap entries for loaded or evicted uids
+        if len(self.expiry) > 2 * len(self.data) + 1024:
+            self.expiry = [
+                (entry[2], uid) for uid, entry in self.data.items() if entry[2]
+            ]
+            heapq.heapify(self.expiry)
+
+    def save_result(self, job_id, record):
+        """
+        Save the record of a background operation
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.results.pop(job_id, None)
+            self.results[job_id] = (record, now + self.result_ttl)
+
+            # Results are in order of expiry
+            while self.results:
+                _, expires = next(iter(self.results.values()))
+                if expires > now and (
+                    not self.max_entries or len(self.results) <= self.max_entries
+                ):
+                    break
+                self.results.popitem(last=False)
+
+    def load_result(self, job_id):
+        """
+        Return the record of a background operation
+        """
+        with self.lock:
+            record, expires = self.results.get(job_id, (None, 0))
+        if expires <= time.monotonic():
+            raise DoesNotExist()
+        return record
+
+    def queue_delivery(self, uid, frozen_op, frozen_auth):
+        """
+        Add an auth request to the outbox, to be sent as soon as possible
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.deliveries[uid] = {
+                "op": frozen_op,
+                "auth": frozen_auth,
+                "status": "pending",
+                "attempts": 0,
+                "error": None,
+                "due": now,
+                "updated": now,
+            }
+
+    def claim_deliveries(self, limit, lease):
+        """
+        Return up to ``limit`` auth requests which are due to be sent, as
+        ``(uid, frozen_op, frozen_auth, attempts)``
+
+        They won't be returned again for ``lease`` seconds, unless they are
+        saved as pending.
+        """
+        with self.lock:
+            now = time.monotonic()
+            claimed = []
+            for uid, entry in self.deliveries.items():
+                if entry["status"] == "pending" and entry["due"] <= now:
+                    entry["due"] = now + lease
+                    claimed.append((uid, entry["op"], entry["auth"], entry["attempts"]))
+                    if len(claimed) >= limit:
+                        break
+            return claimed
+
+    def save_delivery(self, uid, status, attempts, error=None, delay=0):
+        """
+        Record an attempt to send an auth request
+
+        Arguments:
+            status      ``pending`` to try again after ``delay`` seconds,
+                        ``sent`` or ``failed``
+        """
+        with self.lock:
+            now = time.monotonic()
+            entry = self.deliveries.get(uid)
+            if entry is None:
+                return
+            entry.update(
+                status=status,
+                attempts=attempts,
+                error=error,
+                due=now + delay,
+                updated=now,
+            )
+            if status in DELIVERED:
+                entry["op"] = entry["auth"] = None
+                cutoff = now - self.result_ttl
+                expired = [
+                    key
+                    for key, value in self.deliveries.items()
+                    if value["status"] in DELIVERED and value["updated"] < cutoff
+                ]
+                for key in expired:
+                    del self.deliveries[key]
+
+    def load_delivery(self, uid):
+        """
+        Return the record of an auth request delivery
+        """
+        with self.lock:
+            entry = self.deliveries.get(uid)
+            if entry is None:
+                raise DoesNotExist()
+            return delivery_record(
+                uid, entry["status"], entry["attempts"], entry["error"]
+            )
+
+    def stats(self):
+        """
+        Return the number of entries, evictions and expirations
+        """
+        with self.lock:
+            return {
+                "entries": len(self.data),
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+def thaw(frozen):
+    """
+    Return a frozen object from the database
+
+    Objects are stored as bytes; older versions stored a JSON list as text.
+    """
+    if isinstance(frozen, str):
+        return json.loads(frozen)
+    return frozen
 
 
 class Database(object):
     """
-    Database storage
+    SQLite storage of frozen ops and auth, the results of background
+    operations, and the outbox of auth requests, which survives a restart
+
+    Each thread gets its own connection, and a forked process opens new
+    connections rather than using its parent's. The database uses write-ahead
+    logging, so saves don't block loads and don't wait for a disk sync.
     """
 
-    def __init__(self, db_path):
-        self.db_path = db_path
+    #: Whether the store can be shared between processes
+    shared = True
 
-        # ++ connect
-        raise NotImplementedError()
+    filename = "regent.sqlite3"
+
+    def __init__(self, db_path, ttl=None, result_ttl=RESULT_TTL):
+        """
+        Arguments:
+            db_path     Path to a private directory for the database. It will
+                        be created if it does not exist.
+            ttl         Number of seconds to keep an entry. Expired entries
+                        are deleted every ``EXPIRE_INTERVAL`` seconds when
+                        another is saved.
+            result_ttl  Number of seconds to keep a result after it was last
+                        updated
+        """
+        self.db_path = db_path
+        self.ttl = ttl
+        self.result_ttl = result_ttl
+        self.local = threading.local()
+        self.expired = time.monotonic()
 
         # Ensure private path exists and has correct ownership and permissions
+        os.makedirs(self.db_path, mode=0o700, exist_ok=True)
         os.chown(self.db_path, os.getuid(), -1)
         os.chmod(self.db_path, 0o700)
+        self.filename = os.path.join(self.db_path, self.filename)
+
+        conn = self.connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS operations ("
+            "uid TEXT PRIMARY KEY, "
+            "op TEXT NOT NULL, "
+            "auth TEXT NOT NULL, "
+            "created REAL NOT NULL"
+            ")"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS operations_created " "ON operations (created)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "job TEXT PRIMARY KEY, "
+            "record BLOB NOT NULL, "
+            "updated REAL NOT NULL"
+            ")"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS results_updated ON results (updated)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "uid TEXT PRIMARY KEY, "
+            "op BLOB, "
+            "auth BLOB, "
+            "status TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL, "
+            "error TEXT, "
+            "due REAL NOT NULL, "
+            "updated REAL NOT NULL"
+            ")"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, due)")
+
+    def connect(self):
+        """
+        Return the connection for this thread
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(
+                self.filename,
+                timeout=SOCKET_TIMEOUT,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+            self.local.batch = False
+        return conn
+
+    def load(self, uid):
+        conn = self.connect()
+        created = time.time() - self.ttl if self.ttl else 0
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT op, auth FROM operations WHERE uid=? AND created >= ?",
+                (uid, created),
+            ).fetchone()
+            if row is None:
+                raise DoesNotExist()
+            conn.execute("DELETE FROM operations WHERE uid=?", (uid,))
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+        return tuple(thaw(frozen) for frozen in row)
+
+    def save(self, uid, frozen_op, frozen_auth):
+        conn = self.connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO operations (uid, op, auth, created) "
+            "VALUES (?, ?, ?, ?)",
+            (uid, frozen_op, frozen_auth, time.time()),
+        )
+        if self.ttl and time.monotonic() - self.expired > EXPIRE_INTERVAL:
+            self.expire()
+
+    @contextmanager
+    def batch(self):
+        """
+        Context manager to commit several saves in one transaction
+        """
+        conn = self.connect()
+        if self.local.batch:
+            yield
+            return
+
+        self.local.batch = True
+        conn.execute("BEGIN")
+        try:
+            yield
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+        finally:
+            self.local.batch = False
+
+    def save_result(self, job_id, record):
+        """
+        Save the record of a background operation
+
+        Expired results are deleted when an operation finishes.
+        """
+        conn = self.connect()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO results (job, record, updated) VALUES (?, ?, ?)",
+            (job_id, bytes([CODEC.id]) + CODEC.encode(record), now),
+        )
+        if record.get("status") in ("done", "failed"):
+            conn.execute(
+                "DELETE FROM results WHERE updated < ?",
+                (now - self.result_ttl,),
+            )
+
+    def load_result(self, job_id):
+        """
+        Return the record of a background operation
+        """
+        conn = self.connect()
+        row = conn.execute(
+            "SELECT record FROM results WHERE job=? AND updated >= ?",
+            (job_id, time.time() - self.result_ttl),
+        ).fetchone()
+        if row is None:
+            raise DoesNotExist()
+        raw = row[0]
+        return CODECS[raw[0]].decode(raw[1:])
+
+    def queue_delivery(self, uid, frozen_op, frozen_auth):
+        """
+        Add an auth request to the outbox, to be sent as soon as possible
+        """
+        conn = self.connect()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO outbox "
+            "(uid, op, auth, status, attempts, error, due, updated) "
+            "VALUES (?, ?, ?, 'pending', 0, NULL, ?, ?)",
+            (uid, frozen_op, frozen_auth, now, now),
+        )
+
+    def claim_deliveries(self, limit, lease):
+        """
+        Return up to ``limit`` auth requests which are due to be sent, as
+        ``(uid, frozen_op, frozen_auth, attempts)``
+
+        They won't be returned again for ``lease`` seconds, unless they are
+        saved as pending, so several processes can share the outbox.
+        """
+        conn = self.connect()
+        now = time.time()
+        query = (
+            "SELECT uid, op, auth, attempts FROM outbox "
+            "WHERE status='pending' AND due <= ? ORDER BY due LIMIT ?"
+        )
+
+        # Check without taking the write lock, as the outbox is usually empty
+        if not conn.execute(query, (now, 1)).fetchone():
+            return []
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(query, (now, limit)).fetchall()
+            conn.executemany(
+                "UPDATE outbox SET due=? WHERE uid=?",
+                [(now + lease, row[0]) for row in rows],
+            )
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return rows
+
+    def save_delivery(self, uid, status, attempts, error=None, delay=0):
+        """
+        Record an attempt to send an auth request
+
+        Arguments:
+            status      ``pending`` to try again after ``delay`` seconds,
+                        ``sent`` or ``failed``
+        """
+        conn = self.connect()
+        now = time.time()
+        if status in DELIVERED:
+            conn.execute(
+                "UPDATE outbox SET op=NULL, auth=NULL, status=?, attempts=?, "
+                "error=?, updated=? WHERE uid=?",
+                (status, attempts, error, now, uid),
+            )
+            conn.execute(
+                "DELETE FROM outbox WHERE status IN (?, ?) AND updated < ?",
+                DELIVERED + (now - self.result_ttl,),
+            )
+        else:
+            conn.execute(
+                "UPDATE outbox SET status=?, attempts=?, error=?, due=?, updated=? "
+                "WHERE uid=?",
+                (status, attempts, error, now + delay, now, uid),
+            )
+
+    def load_delivery(self, uid):
+        """
+        Return the record of an auth request delivery
+        """
+        conn = self.connect()
+        row = conn.execute(
+            "SELECT status, attempts, error FROM outbox WHERE uid=?",
+            (uid,),
+        ).fetchone()
+        if row is None:
+            raise DoesNotExist()
+        return delivery_record(uid, *row)
 
-    def load(self, op_id):
-        raise NotImplementedError()
+    def expire(self, max_age=None):
+        """
+        Delete operations which were saved more than ``max_age`` seconds ago,
+        or ``ttl`` seconds if not given
+        """
+        max_age = max_age or self.ttl
+        if not max_age:
+            return
 
-    def save(self, op_id, frozen_op, frozen_auth):
-        raise NotImplementedError()
+        self.expired = time.monotonic()
+        conn = self.connect()
+        conn.execute(
+            "DELETE FROM operations WHERE created < ?",
+            (time.time() - max_age,),
+        )
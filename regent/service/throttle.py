@@ -0,0 +1,95 @@
+"""
+Throttling of failed secret checks
+"""
+import time
+from threading import Lock
+
+
+class Throttle(object):
+    """
+    Track failed secret checks for each peer, and back off exponentially
+
+    A peer is identified by the uid of the process at the other end of the
+    socket, so forking doesn't reset its backoff; peers without credentials
+    share one entry. After each failure the peer is backed off for twice as
+    long as the last time, up to ``max_delay`` seconds; failures are
+    forgotten after ``reset`` seconds without another.
+
+    While a peer is backed off, the service holds its requests before checking
+    their secrets, and checks them one at a time, a backoff apart, so the peer
+    can't try secrets in parallel. Connections which have already passed the
+    secret check are not held, and requests from other users are not
+    affected.
+    """
+
+    def __init__(self, delay=1, max_delay=60, reset=600):
+        self.delay = delay
+        self.max_delay = max_delay
+        self.reset = reset
+        self.failures = {}
+        self.lock = Lock()
+
+    def key(self, peer):
+        """
+        Return the uid from the peer's ``(pid, uid, gid)`` credentials
+
+        If credentials are not available, all peers share the same key.
+        """
+        return peer[1] if peer else None
+
+    def backoff(self, count):
+        """
+        Return the number of seconds to back off after ``count`` failures
+        """
+        return min(self.delay * 2 ** max(count - 1, 0), self.max_delay)
+
+    def wait(self, peer):
+        """
+        Reserve the next check of a secret from the peer
+
+        Returns the number of seconds to hold the request before checking its
+        secret, or 0 if the peer is not backed off
+        """
+        peer = self.key(peer)
+        if peer not in self.failures:
+            return 0
+
+        now = time.monotonic()
+        with self.lock:
+            count, until = self.failures.get(peer, (0, 0))
+            if until <= now:
+                return 0
+            # The check after this one waits for another backoff
+            self.failures[peer] = (count, until + self.backoff(count))
+        return until - now
+
+    def failed(self, peer):
+        """
+        Record a failure for the peer
+
+        Returns the number of seconds to delay the response
+        """
+        peer = self.key(peer)
+        now = time.monotonic()
+        with self.lock:
+            count, until = self.failures.get(peer, (0, 0))
+            if now - until > self.reset:
+                count = 0
+            count += 1
+            delay = self.backoff(count)
+            # Checks which have been reserved keep their place
+            self.failures[peer] = (count, max(until, now) + delay)
+            self.prune(now)
+        return delay
+
+    def prune(self, now):
+        """
+        Forget peers whose failures have expired
+        """
+        expired = [
+            peer
+            for peer, (count, until) in self.failures.items()
+            if now - until > self.reset
+        ]
+        for peer in expired:
+            del self.failures[peer]
@@ -1,69 +1,362 @@
 """
 Common socket tools
+
+Socket Protocol
+---------------
+
+Version 1: each message is a JSON object terminated by a newline. This is the
+default, and can be used by hand with ``socat``.
+
+Version 2: the client opens the connection by sending a single handshake byte,
+which is the id of the codec it wants to use (see ``regent.codecs``). Each
+message is then encoded by the codec and prefixed with its length as a 4 byte
+unsigned big-endian integer. The service sends the same handshake byte before
+its first response to acknowledge the codec.
+
+The service detects the version from the first byte: handshake bytes are
+control characters, which can't start a JSON message.
 """
 from __future__ import absolute_import
 
+import asyncio
 import json
 import os
 import select
 import socket
+import struct
+import time
 
-from .constants import SOCKET_PENDING
+from .codecs import CODECS, get_codec
+from .constants import SOCKET_MAX_SIZE, SOCKET_PENDING
 from .exceptions import ProcessError, SocketError
 
 
+# Read without blocking where supported, otherwise wait for data first
+MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)
+
+# Length prefix for messages when a codec has been negotiated
+LENGTH = struct.Struct(">I")
+
+# First file descriptor passed by systemd socket activation
+SD_LISTEN_FDS_START = 3
+
+
+def encode(data):
+    """
+    Encode a message as a newline-terminated JSON object
+    """
+    return json.dumps(data).encode("utf-8") + b"\n"
+
+
+def decode(raw):
+    """
+    Decode a newline-terminated JSON object
+    """
+    try:
+        raw = raw.decode("utf-8", "replace")
+        return json.loads(raw)
+    except ValueError as e:
+        raise ProcessError(
+            "Invalid message, could not decode JSON: {}".format(e),
+        )
+
+
+def systemd_fd():
+    """
+    Return the listening socket passed by systemd socket activation, or
+    ``None`` if this process was not socket activated
+
+    The variables are removed from the environment so they are not passed on to
+    child processes.
+    """
+    pid = os.environ.pop("LISTEN_PID", None)
+    fds = os.environ.pop("LISTEN_FDS", None)
+    os.environ.pop("LISTEN_FDNAMES", None)
+    if not fds or pid != str(os.getpid()):
+        return None
+    if int(fds) != 1:
+        raise ValueError("Expected one socket from systemd, got {}".format(fds))
+    return SD_LISTEN_FDS_START
+
+
+def peer_credentials(sock):
+    """
+    Return the ``(pid, uid, gid)`` of the process at the other end of a unix
+    socket, or ``None`` if the platform does not support ``SO_PEERCRED``
+    """
+    try:
+        creds = sock.getsockopt(
+            socket.SOL_SOCKET,
+            socket.SO_PEERCRED,
+            struct.calcsize("3i"),
+        )
+    except (AttributeError, OSError):
+        return None
+    return struct.unpack("3i", creds)
+
+
+class FrameReader(object):
+    """
+    Read frames from a socket
+
+    Frames are either terminated by a delimiter, or prefixed with their length
+    in 4 bytes once ``length_prefixed`` is set.
+
+    Data is received into a reusable buffer, and only newly received bytes are
+    searched for the delimiter. Anything received after a frame is kept for
+    the next one.
+    """
+
+    def __init__(
+        self,
+        socket,
+        timeout,
+        max_size=SOCKET_MAX_SIZE,
+        delimiter=b"\n",
+        chunk_size=65536,
+    ):
+        self.socket = socket
+        self.timeout = timeout
+        self.max_size = max_size
+        self.delimiter = delimiter
+        self.length_prefixed = False
+        self.buffer = bytearray()
+        self.chunk = memoryview(bytearray(chunk_size))
+        self.scanned = 0
+
+    def read(self):
+        """
+        Read the next frame, without its delimiter or length
+        """
+        deadline = self.deadline()
+        while 1:
+            frame = self.next_frame()
+            if frame is not None:
+                return frame
+            self.fill(deadline)
+
+    def peek(self):
+        """
+        Return the next byte without consuming it
+        """
+        deadline = self.deadline()
+        while not self.buffer:
+            self.fill(deadline)
+        return self.buffer[0]
+
+    def deadline(self):
+        """
+        Return when a read started now times out, or None if there is no
+        timeout
+        """
+        if self.timeout is None:
+            return None
+        return time.monotonic() + self.timeout
+
+    def skip(self, size):
+        """
+        Consume bytes from the buffer
+        """
+        del self.buffer[:size]
+        self.scanned = 0
+
+    def fill(self, deadline):
+        """
+        Receive more data into the buffer
+        """
+        # Try to read without waiting, then wait until the deadline
+        if not MSG_DONTWAIT:
+            self.wait(deadline)
+        while 1:
+            try:
+                size = self.socket.recv_into(self.chunk, 0, MSG_DONTWAIT)
+            except BlockingIOError:
+                self.wait(deadline)
+                continue
+            except socket.error:
+                raise SocketError("Could not read from client")
+            break
+
+        if size == 0:
+            raise SocketError("Unexpected end of data")
+        self.buffer += self.chunk[:size]
+
+    def wait(self, deadline):
+        """
+        Wait for data to arrive before the deadline, or indefinitely if the
+        deadline is None
+        """
+        remaining = None
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise SocketError("Failed waiting for data")
+        if not select.select([self.socket], [], [], remaining)[0]:
+            raise SocketError("Failed waiting for data")
+
+    def next_frame(self):
+        """
+        Return the next complete frame from the buffer, or None
+        """
+        if self.length_prefixed:
+            return self.next_block()
+        return self.next_line()
+
+    def next_line(self):
+        """
+        Return the next delimited frame from the buffer, or None
+        """
+        index = self.buffer.find(self.delimiter, self.scanned)
+        if index == -1:
+            self.scanned = len(self.buffer)
+            if self.scanned > self.max_size:
+                raise ProcessError("Invalid message, too large")
+            return None
+
+        # The delimiter may have arrived in the same chunk as the excess
+        if index > self.max_size:
+            raise ProcessError("Invalid message, too large")
+
+        frame = bytes(self.buffer[:index])
+        del self.buffer[: index + len(self.delimiter)]
+        self.scanned = 0
+        return frame
+
+    def next_block(self):
+        """
+        Return the next length-prefixed frame from the buffer, or None
+        """
+        if len(self.buffer) < LENGTH.size:
+            return None
+
+        size = LENGTH.unpack_from(self.buffer)[0]
+        if size > self.max_size:
+            raise ProcessError("Invalid message, too large")
+
+        end = LENGTH.size + size
+        if len(self.buffer) < end:
+            return None
+
+        frame = bytes(self.buffer[LENGTH.size : end])
+        del self.buffer[:end]
+        return frame
+
+    def has_frame(self):
+        """
+        Check if a complete frame has already been received
+        """
+        if self.length_prefixed:
+            if len(self.buffer) < LENGTH.size:
+                return False
+            return len(self.buffer) >= LENGTH.size + LENGTH.unpack_from(self.buffer)[0]
+        return self.buffer.find(self.delimiter, self.scanned) != -1
+
+
+#: Errors raised by the codecs when data can't be encoded
+ENCODE_ERRORS = (TypeError, ValueError, OverflowError)
+
+
+def pack(codec, data):
+    """
+    Encode a message for the codec, or as newline-terminated JSON if there is
+    no codec
+    """
+    if codec is None:
+        return encode(data)
+    raw = codec.encode(data)
+    return LENGTH.pack(len(raw)) + raw
+
+
+def unpack(codec, raw):
+    """
+    Decode a message for the codec, or as JSON if there is no codec
+    """
+    if codec is None:
+        return decode(raw)
+    return codec.decode(raw)
+
+
+def handshake_codec(byte):
+    """
+    Return the codec for the first byte a client sent, or ``None`` if the
+    client is using newline-terminated JSON
+
+    Raises ProcessError if the byte is a handshake for an unknown codec
+    """
+    if byte >= 0x20 or byte in b"\t\n\r":
+        return None
+    codec = CODECS.get(byte)
+    if codec is None or not codec.available:
+        raise ProcessError("Unsupported codec")
+    return codec
+
+
 class BaseSocket(object):
     """
-    Wrapper for socket which communicates using newline-terminated JSON objects
+    Wrapper for socket which communicates using newline-terminated JSON
+    objects, or length-prefixed messages if a codec has been negotiated
 
     Common functionality for server/client socket, and for new connections on
     a server
     """
 
-    def __init__(self, socket, timeout):
+    def __init__(
+        self,
+        socket,
+        timeout,
+        max_size=SOCKET_MAX_SIZE,
+        codec=None,
+        negotiate=False,
+    ):
+        """
+        Arguments:
+            codec       ``Codec`` instance, or ``None`` for newline-terminated
+                        JSON
+            negotiate   If ``True``, detect the codec from the first byte the
+                        client sends
+        """
         self.socket = socket
         self.timeout = timeout
+        self.max_size = max_size
+        self.codec = codec
+        self.negotiate = negotiate
+        self.handshake = b""
+        self.reader = FrameReader(socket, timeout, max_size)
 
     def write(self, data):
-        raw = json.dumps(data).encode("utf-8")
+        raw = pack(self.codec, data)
+        if self.handshake:
+            # Send the handshake with the first message
+            raw = self.handshake + raw
+            self.handshake = b""
         try:
-            self.socket.send(raw + b"\n")
+            self.socket.sendall(raw)
         except socket.error:
             raise SocketError("Could not write to client")
 
     def read(self):
-        raw = b""
-        while not raw.endswith(b"\n"):
-            # Use select so we can manage the timeout safely
-            sockets = select.select(
-                [self.socket],
-                [],
-                [],
-                self.timeout,
-            )[0]
-
-            # If there's nothing to be read, connection failed
-            if len(sockets) != 1:
-                raise SocketError("Failed waiting for data")
+        if self.negotiate:
+            self.negotiate = False
+            self.read_handshake()
+        return unpack(self.codec, self.reader.read())
 
-            # Read and store
-            try:
-                chunk = self.socket.recv(4096)
-            except socket.error:
-                raise SocketError("Could not read from client")
-            if len(chunk) == 0:
-                raise SocketError("Unexpected end of data")
-            raw += chunk
-
-        try:
-            raw = raw.decode("utf-8", "replace")
-            data = json.loads(raw)
-        except ValueError as e:
-            raise ProcessError(
-                "Invalid message, could not decode JSON: {}".format(e),
-            )
+    def read_handshake(self):
+        """
+        Detect the codec from the first byte the client sent, and acknowledge
+        it in the first response
+        """
+        codec = handshake_codec(self.reader.peek())
+        if codec is not None:
+            self.reader.skip(1)
+            self.reader.length_prefixed = True
+            self.codec = codec
+            self.handshake = bytes([codec.id])
 
-        return data
+    def has_message(self):
+        """
+        Check if a complete message has already been received
+        """
+        return self.reader.has_frame()
 
     def close(self):
         try:
@@ -73,46 +366,229 @@ class BaseSocket(object):
 
 
 class Socket(BaseSocket):
-    def __init__(self, path, secret, timeout):
+    def __init__(
+        self,
+        path,
+        secret,
+        timeout,
+        max_size=SOCKET_MAX_SIZE,
+        codec=None,
+        fd=None,
+        backlog=SOCKET_PENDING,
+    ):
+        """
+        Arguments:
+            codec       Name of the codec to use, or ``None`` for
+                        newline-terminated JSON
+            fd          File descriptor of a socket which is already bound and
+                        listening, to use instead of binding to the path
+            backlog     Max number of connections waiting to be accepted
+        """
         self.path = path
         self.secret = secret
         self.timeout = timeout
+        self.max_size = max_size
+        self.fd = fd
+        self.backlog = backlog
+        self.codec = get_codec(codec) if codec else None
+        self.negotiate = False
         self.init()
 
     def init(self):
         self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.reader = FrameReader(self.socket, self.timeout, self.max_size)
+        self.handshake = b""
+        self.acknowledged = self.codec is None
 
     def listen(self):
         """
         Listen on a socket as a server
+
+        The socket is bound to a temporary path and moved into place, so
+        clients never find the path missing while a service restarts.
         """
+        if self.fd is not None:
+            # Already listening, eg passed by systemd or a supervisor
+            self.socket.close()
+            self.socket = socket.socket(fileno=self.fd)
+            self.reader = FrameReader(self.socket, self.timeout, self.max_size)
+            return
+
+        tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
         try:
-            os.remove(self.path)
+            os.remove(tmp_path)
         except OSError:
             pass
 
-        self.socket.bind(self.path)
-        os.chmod(self.path, 0o777)
+        self.socket.bind(tmp_path)
+        os.chmod(tmp_path, 0o777)
 
-        # Queue up to SOCKET_PENDING connections
-        self.socket.listen(SOCKET_PENDING)
+        self.socket.listen(self.backlog)
+        os.replace(tmp_path, self.path)
 
     def accept(self):
         """
         Wait for a connection and accept it
         """
         client, address = self.socket.accept()
-        return BaseSocket(client, self.timeout)
+        return BaseSocket(client, self.timeout, self.max_size, negotiate=True)
 
     def connect(self):
         """
         Connect to a socket as a client
         """
         self.socket.connect(self.path)
+        if self.codec:
+            self.handshake = bytes([self.codec.id])
+            self.reader.length_prefixed = True
 
     def write(self, data):
-        out = {
-            "secret": self.secret,
-        }
+        """
+        Write a request with the secret, and the deadline after which the
+        client will have stopped waiting for the response
+        """
+        out = {"secret": self.secret}
+        if self.timeout is not None:
+            out["deadline"] = time.time() + self.timeout
         out.update(data)
         super(Socket, self).write(out)
+
+    def read(self):
+        if not self.acknowledged:
+            if self.reader.peek() != self.codec.id:
+                raise SocketError(
+                    "Service does not support codec {}".format(self.codec.name)
+                )
+            self.reader.skip(1)
+            self.acknowledged = True
+        return super(Socket, self).read()
+
+
+class AsyncSocket(object):
+    """
+    Wrapper for asyncio streams which communicates using newline-terminated
+    JSON objects, or length-prefixed messages if a codec has been negotiated
+
+    Async equivalent of ``BaseSocket``
+    """
+
+    def __init__(
+        self,
+        reader,
+        writer,
+        timeout,
+        max_size=SOCKET_MAX_SIZE,
+        codec=None,
+        negotiate=False,
+    ):
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+        self.max_size = max_size
+        self.codec = codec
+        self.negotiate = negotiate
+        self.handshake = b""
+        self.acknowledged = True
+        self.prefix = b""
+        self.write_lock = asyncio.Lock()
+        sock = writer.get_extra_info("socket")
+        self.peer = peer_credentials(sock) if sock else None
+        # Set by the service once a request has passed the secret check
+        self.authenticated = False
+
+    @classmethod
+    async def connect(cls, path, timeout, max_size=SOCKET_MAX_SIZE, codec=None):
+        """
+        Connect to a socket as a client
+
+        Arguments:
+            codec       Name of the codec to use, or ``None`` for
+                        newline-terminated JSON
+        """
+        codec = get_codec(codec) if codec else None
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_unix_connection(path, limit=max_size),
+                timeout,
+            )
+        except (OSError, asyncio.TimeoutError):
+            raise SocketError("Could not connect to service")
+
+        socket = cls(reader, writer, timeout, max_size, codec)
+        if codec:
+            socket.handshake = bytes([codec.id])
+            socket.acknowledged = False
+        return socket
+
+    async def write(self, data):
+        raw = pack(self.codec, data)
+        async with self.write_lock:
+            if self.handshake:
+                raw = self.handshake + raw
+                self.handshake = b""
+            self.writer.write(raw)
+            try:
+                await asyncio.wait_for(self.writer.drain(), self.timeout)
+            except (OSError, asyncio.TimeoutError):
+                raise SocketError("Could not write to client")
+
+    async def read(self, timeout=None):
+        """
+        Read a message, waiting up to ``timeout`` seconds, or the socket
+        timeout if not set
+        """
+        try:
+            raw = await asyncio.wait_for(self.read_frame(), timeout or self.timeout)
+        except asyncio.TimeoutError:
+            raise SocketError("Failed waiting for data")
+        except asyncio.IncompleteReadError:
+            raise SocketError("Unexpected end of data")
+        except ValueError:
+            # Stream limit exceeded
+            raise ProcessError("Invalid message, too large")
+        except OSError:
+            raise SocketError("Could not read from client")
+
+        return unpack(self.codec, raw)
+
+    async def read_frame(self):
+        """
+        Read the next frame, negotiating the codec first if necessary
+        """
+        if self.negotiate:
+            # Detect the codec from the first byte the client sent
+            self.negotiate = False
+            first = await self.reader.readexactly(1)
+            self.codec = handshake_codec(first[0])
+            if self.codec:
+                self.handshake = first
+            else:
+                self.prefix = first
+
+        if not self.acknowledged:
+            ack = await self.reader.readexactly(1)
+            if ack[0] != self.codec.id:
+                raise SocketError(
+                    "Service does not support codec {}".format(self.codec.name)
+                )
+            self.acknowledged = True
+
+        if self.codec is None:
+            raw = await self.reader.readline()
+            if not raw.endswith(b"\n"):
+                raise SocketError("Unexpected end of data")
+            raw, self.prefix = self.prefix + raw, b""
+            return raw
+
+        header = await self.reader.readexactly(LENGTH.size)
+        size = LENGTH.unpack(header)[0]
+        if size > self.max_size:
+            raise ProcessError("Invalid message, too large")
+        return await self.reader.readexactly(size)
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            raise SocketError("Client already disconnected")
@@ -0,0 +1,113 @@
+"""
+Tests for the clients
+"""
+import asyncio
+import threading
+
+import pytest
+
+from regent.client import AsyncClient, Client, ClientPool
+from regent.codecs import CODECS
+from regent.service import AsyncService, Operation, Service
+
+
+SECRET = "secret"
+
+
+class Echo(Operation):
+    def prepare(self, data):
+        self.data = data
+
+    def perform(self):
+        return self.data
+
+
+@pytest.fixture
+def service(tmp_path):
+    service = Service(str(tmp_path / "regent.sock"), SECRET, threads=2)
+    service.register("echo", Echo)
+    service.socket.listen()
+    thread = threading.Thread(target=service.serve, daemon=True)
+    thread.start()
+    yield service
+    service.stop()
+    thread.join(5)
+
+
+def check_requests(call):
+    assert call("request", "echo", 1)["data"] == 1
+    assert [r["data"] for r in call("request_many", [("echo", 1), ("echo", 2)])] == [
+        1,
+        2,
+    ]
+
+    job = call("submit", "echo", 3)["data"]["job"]
+    assert call("wait", job, timeout=5)["data"]["result"] == 3
+    assert call("poll", job)["data"]["status"] == "done"
+
+    assert call("delivery", "missing")["error"] == "Delivery not found"
+    assert call("auth", "missing")["error"]
+
+
+def test_client(service):
+    client = Client(service.socket.path, SECRET)
+    check_requests(lambda name, *args, **kwargs: getattr(client, name)(*args, **kwargs))
+
+
+def test_client_pool(service):
+    pool = ClientPool(service.socket.path, SECRET)
+    try:
+        check_requests(
+            lambda name, *args, **kwargs: getattr(pool, name)(*args, **kwargs)
+        )
+    finally:
+        pool.close()
+
+
+def test_async_client(service):
+    client = AsyncClient(service.socket.path, SECRET)
+    check_requests(
+        lambda name, *args, **kwargs: asyncio.run(
+            getattr(client, name)(*args, **kwargs)
+        )
+    )
+
+
+def test_without_socket_timeout(service):
+    client = Client(service.socket.path, SECRET, socket_timeout=None)
+    assert client.request("echo", 1)["data"] == 1
+
+    pool = ClientPool(service.socket.path, SECRET, socket_timeout=None, max_size=1)
+    try:
+        assert pool.request("echo", 3)["data"] == 3
+        assert pool.request("echo", 4)["data"] == 4
+    finally:
+        pool.close()
+
+    client = AsyncClient(service.socket.path, SECRET, socket_timeout=None)
+    assert asyncio.run(client.request("echo", 2))["data"] == 2
+
+
+@pytest.mark.parametrize("codec", CODECS.values(), ids=lambda codec: codec.name)
+@pytest.mark.parametrize("cls", [Service, AsyncService])
+def test_codec(tmp_path, cls, codec):
+    if not codec.available:
+        pytest.skip("{} is not installed".format(codec.name))
+    service = cls(str(tmp_path / "regent.sock"), SECRET)
+    service.register("echo", Echo)
+    service.socket.listen()
+    serve = service.serve
+    if cls is AsyncService:
+        serve = lambda: asyncio.run(service.serve())  # noqa: E731
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    try:
+        data = {"text": "caf\u00e9", "items": [1, 2.5, None, True]}
+        client = Client(service.socket.path, SECRET, codec=codec.name)
+        assert client.request("echo", data)["data"] == data
+
+        client = AsyncClient(service.socket.path, SECRET, codec=codec.name)
+        assert asyncio.run(client.request("echo", data))["data"] == data
+    finally:
+        service.stop()
+        thread.join(5)
@@ -0,0 +1,164 @@
+"""
+Tests for running commands
+"""
+import asyncio
+import sys
+import threading
+import time
+
+import pytest
+
+from regent.exceptions import CommandError, CommandTimeout
+from regent.service.command import Command
+
+
+#: Starts a child which outlives the shell unless its process group is killed,
+#: and writes the child's pid to the path in the first argument
+SPAWN_CHILD = ["sh", "-c", 'sleep 30 & echo $! > "$0"; wait']
+
+
+def alive(pid):
+    """
+    Check if a process is running, treating zombies as dead
+    """
+    try:
+        with open("/proc/{}/stat".format(pid)) as file:
+            stat = file.read()
+    except FileNotFoundError:
+        return False
+    return stat.rsplit(")", 1)[1].split()[0] != "Z"
+
+
+def read_pid(path):
+    for _ in range(100):
+        if path.exists() and path.read_text().strip():
+            return int(path.read_text())
+        time.sleep(0.01)
+    raise AssertionError("Command did not start")
+
+
+def python(code, **kwargs):
+    return Command([sys.executable, "-c", code], **kwargs)
+
+
+def test_run__output():
+    result = python("print('out'); import sys; sys.stderr.write('err')").run()
+    assert result.returncode == 0
+    assert result.stdout == "out\n"
+    assert result.stderr == "err"
+    assert not result.truncated
+
+
+def test_run__failed__raises_with_result():
+    with pytest.raises(CommandError) as error:
+        python("import sys; sys.exit(3)").run()
+    assert error.value.result.returncode == 3
+
+
+def test_run__timeout__kills_process_group(tmp_path):
+    pidfile = tmp_path / "pid"
+    command = Command(SPAWN_CHILD, timeout=0.5)
+    start = time.monotonic()
+    with pytest.raises(CommandTimeout):
+        command.run(pidfile)
+    assert time.monotonic() - start < 5
+    assert not alive(read_pid(pidfile))
+
+
+def test_run__output_capped():
+    result = python("print('x' * 1000)", max_output=100).run()
+    assert result.stdout == "x" * 100
+    assert result.truncated
+
+
+def test_run__input():
+    data = "x" * 1000000
+    result = Command(["cat"]).run(input=data)
+    assert result.stdout == data
+
+
+def test_run__limit__waits_for_slot():
+    command = Command(["sleep", "0.3"], limit=1)
+    start = time.monotonic()
+    threads = [threading.Thread(target=command.run) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert time.monotonic() - start >= 0.6
+
+
+def test_run__limit__times_out_waiting_for_slot():
+    command = Command(["sleep", "1"], limit=1, timeout=2)
+    thread = threading.Thread(target=command.run)
+    thread.start()
+    try:
+        time.sleep(0.1)
+        command.timeout = 0.2
+        with pytest.raises(CommandTimeout, match="waiting to run"):
+            command.run()
+    finally:
+        thread.join()
+
+
+def test_stream__output():
+    chunks = list(python("print('a'); print('b')").stream())
+    assert "".join(chunks) == "a\nb\n"
+
+
+def test_stream__closed__kills_command():
+    chunks = Command(["sh", "-c", "echo $$; exec sleep 30"]).stream()
+    pid = int(next(chunks))
+    chunks.close()
+    assert not alive(pid)
+
+
+def test_run_async__output_and_input():
+    result = asyncio.run(Command(["cat"]).run_async(input="hello"))
+    assert result.stdout == "hello"
+
+
+def test_run_async__timeout__kills_process_group(tmp_path):
+    pidfile = tmp_path / "pid"
+    command = Command(SPAWN_CHILD, timeout=0.5)
+    with pytest.raises(CommandTimeout):
+        asyncio.run(command.run_async(pidfile))
+    assert not alive(read_pid(pidfile))
+
+
+def test_run_async__cancelled__kills_process_group(tmp_path):
+    pidfile = tmp_path / "pid"
+    command = Command(SPAWN_CHILD)
+
+    async def cancel():
+        task = asyncio.ensure_future(command.run_async(pidfile))
+        await asyncio.sleep(0.3)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel())
+    assert not alive(read_pid(pidfile))
+
+
+def test_run_async__limit__waits_for_slot():
+    command = Command(["sleep", "0.3"], limit=1)
+
+    async def run_two():
+        await asyncio.gather(command.run_async(), command.run_async())
+
+    start = time.monotonic()
+    asyncio.run(run_two())
+    assert time.monotonic() - start >= 0.6
+
+
+def test_stream_async__closed__kills_command():
+    command = Command(["sh", "-c", "echo $$; exec sleep 30"])
+
+    async def first_chunk():
+        chunks = command.stream_async()
+        pid = int(await chunks.__anext__())
+        await chunks.aclose()
+        return pid
+
+    assert not alive(asyncio.run(first_chunk()))
@@ -0,0 +1,119 @@
+"""
+Tests for sending auth requests from the outbox
+"""
+import threading
+import time
+
+import pytest
+
+from regent.client import Client
+from regent.service import AsyncService, Operation, Service
+from regent.service.auth import Auth
+from regent.service.outbox import AsyncOutbox, Outbox
+
+
+SECRET = "secret"
+
+
+class SlowAuth(Auth):
+    outbox = True
+
+    def request(self, op):
+        time.sleep(1)
+
+
+class Guarded(Operation):
+    def auth(self):
+        return SlowAuth()
+
+
+class Notify(Auth):
+    outbox = True
+
+    def request(self, op):
+        pass
+
+
+class Notified(Operation):
+    def auth(self):
+        return Notify()
+
+
+class Echo(Operation):
+    def prepare(self, data):
+        self.data = data
+
+    def perform(self):
+        return self.data
+
+
+@pytest.fixture
+def async_service(tmp_path):
+    service = AsyncService(
+        str(tmp_path / "regent.sock"),
+        SECRET,
+        db_path=str(tmp_path),
+        outbox=AsyncOutbox(interval=0.1),
+    )
+    service.register("guarded", Guarded)
+    service.register("echo", Echo)
+    thread = threading.Thread(target=service.listen, daemon=True)
+    thread.start()
+    time.sleep(0.2)
+    yield service
+    service.stop()
+    thread.join(5)
+
+
+def test_async_outbox__sync_request__does_not_block_loop(async_service):
+    client = Client(async_service.socket.path, SECRET)
+    response = client.request("guarded")
+    assert response["data"]["status"] == "pending"
+
+    # Let the outbox start sending
+    time.sleep(0.3)
+    start = time.monotonic()
+    assert client.request("echo", 1)["data"] == 1
+    assert time.monotonic() - start < 0.5
+
+    time.sleep(1)
+    assert client.delivery(response["uid"])["data"]["status"] == "sent"
+
+
+@pytest.mark.parametrize("cls", [Service, AsyncService])
+def test_outbox__started_by_first_request(tmp_path, cls):
+    service = cls(str(tmp_path / "regent.sock"), SECRET, db_path=str(tmp_path))
+    service.register("notified", Notified)
+    thread = threading.Thread(target=service.listen, daemon=True)
+    thread.start()
+    time.sleep(0.2)
+    try:
+        assert not service.outbox_started
+
+        client = Client(service.socket.path, SECRET)
+        uid = client.request("notified")["uid"]
+        assert service.outbox_started
+        for _ in range(50):
+            if client.delivery(uid)["data"]["status"] == "sent":
+                break
+            time.sleep(0.1)
+        assert client.delivery(uid)["data"]["status"] == "sent"
+    finally:
+        service.stop()
+        thread.join(5)
+    assert not service.outbox_started
+
+
+def test_outbox__passed_in__started_with_service(tmp_path):
+    service = Service(
+        str(tmp_path / "regent.sock"), SECRET, db_path=str(tmp_path), outbox=Outbox()
+    )
+    thread = threading.Thread(target=service.listen, daemon=True)
+    thread.start()
+    time.sleep(0.2)
+    try:
+        assert service.outbox.thread.is_alive()
+    finally:
+        service.stop()
+        thread.join(5)
+    assert service.outbox.thread is None
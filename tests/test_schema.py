@@ -0,0 +1,149 @@
+"""
+Tests for operation data schemas
+"""
+import pytest
+
+from regent.exceptions import ValidationError
+from regent.service import Operation, Service
+from regent.service.schema import (
+    Boolean,
+    Choice,
+    Float,
+    Integer,
+    IPAddress,
+    List,
+    Network,
+    String,
+    compile_schema,
+)
+
+
+def errors(validate, data):
+    with pytest.raises(ValidationError) as error:
+        validate(data)
+    return error.value.errors
+
+
+def test_compile_schema__cleans_data():
+    validate = compile_schema(
+        {
+            "ip": IPAddress(),
+            "network": Network(),
+            "port": Integer(min=1, max=65535),
+            "weight": Float(),
+            "enabled": Boolean(),
+            "action": Choice(["allow", "deny"]),
+            "name": String(pattern=r"[a-z]+"),
+            "tags": List(String()),
+        }
+    )
+    assert validate(
+        {
+            "ip": "2001:db8:0:0::1",
+            "network": "10.0.0.0/8",
+            "port": 22,
+            "weight": 1,
+            "enabled": False,
+            "action": "deny",
+            "name": "web",
+            "tags": ["a", "b"],
+        }
+    ) == {
+        "ip": "2001:db8::1",
+        "network": "10.0.0.0/8",
+        "port": 22,
+        "weight": 1.0,
+        "enabled": False,
+        "action": "deny",
+        "name": "web",
+        "tags": ["a", "b"],
+    }
+
+
+def test_compile_schema__optional_fields_default():
+    validate = compile_schema(
+        {"port": Integer(required=False, default=22), "note": String(required=False)}
+    )
+    assert validate(None) == {"port": 22, "note": None}
+    assert validate({"port": None}) == {"port": 22, "note": None}
+
+
+def test_compile_schema__errors_for_each_field():
+    validate = compile_schema(
+        {
+            "ip": IPAddress(version=4, allow_private=False),
+            "port": Integer(min=1, max=65535),
+            "enabled": Boolean(),
+            "action": Choice(["allow", "deny"]),
+            "name": String(max_length=3),
+            "tags": List(String(), max_length=2),
+        }
+    )
+    assert errors(
+        validate,
+        {
+            "ip": "10.0.0.1",
+            "port": True,
+            "action": ["allow"],
+            "name": "long",
+            "tags": ["a", 1],
+            "extra": 1,
+        },
+    ) == {
+        "ip": "IP not allowed",
+        "port": "Expected an integer",
+        "enabled": "Required",
+        "action": "Unexpected value",
+        "name": "Must be at most 3 characters",
+        "tags": "Item 1: Expected a string",
+        "extra": "Unexpected field",
+    }
+
+
+@pytest.mark.parametrize(
+    "field, value, error",
+    [
+        (Integer(min=1), 0, "Must be at least 1"),
+        (Float(max=1), 1.5, "Must be at most 1"),
+        (String(pattern=r"[a-z]+"), "abc1", "Invalid format"),
+        (IPAddress(), "300.0.0.1", "Invalid IP"),
+        (IPAddress(version=6), "192.0.2.1", "IPv6 only"),
+        (IPAddress(allow_loopback=False), "::1", "IP not allowed"),
+        (Network(), "10.0.0.1/8", "Invalid network"),
+        (Network(strict=False), 1, "Expected a string"),
+        (List(Integer(), min_length=1), [], "Must have at least 1 items"),
+    ],
+)
+def test_field__invalid(field, value, error):
+    assert errors(compile_schema({"value": field}), {"value": value}) == {
+        "value": error
+    }
+
+
+def test_compile_schema__data_not_an_object():
+    assert errors(compile_schema({}), ["ip"]) == {"": "Expected an object"}
+
+
+class Open(Operation):
+    schema = {"port": Integer(min=1, max=65535)}
+
+    def prepare(self, data):
+        self.port = data["port"]
+
+    def perform(self):
+        return self.port
+
+
+def test_service__validates_before_prepare(tmp_path):
+    service = Service(str(tmp_path / "regent.sock"), "secret")
+    service.register("open", Open)
+
+    op, auth = service.op_new("open", {"port": 22})
+    assert op.port == 22
+
+    with pytest.raises(ValidationError) as error:
+        service.op_new("open", {"port": 0})
+    assert service.error_response(error.value) == {
+        "error": "Invalid data: port: Must be at least 1",
+        "errors": {"port": "Must be at least 1"},
+    }
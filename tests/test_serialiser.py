@@ -0,0 +1,107 @@
+"""
+Tests for serialising suspended operations
+"""
+import json
+
+import pytest
+
+from regent.service.serialiser import (
+    CODEC,
+    Registry,
+    Serialisable,
+    deserialise,
+    registry,
+)
+
+
+class Plain(Serialisable):
+    def __init__(self, value=None):
+        self.value = value
+        self._private = "not stored"
+
+
+class Slotted(Serialisable):
+    __slots__ = ("value", "_private")
+
+
+class Renamed(Serialisable):
+    type_id = "renamed"
+
+
+class RenamedChild(Renamed):
+    pass
+
+
+class Upgraded(Serialisable):
+    type_id = "upgraded"
+    version = 2
+
+    @classmethod
+    def upgrade(cls, attrs, version):
+        if version == 1:
+            attrs = {"port": int(attrs.pop("port_string"))}
+        return attrs
+
+
+def freeze(type_id, version, attrs):
+    return bytes([CODEC.id]) + CODEC.encode([type_id, version, attrs])
+
+
+def test_loads__round_trip():
+    obj = Plain({"a": [1, 2]})
+    obj._private = "changed"
+    loaded = registry.loads(obj.serialise())
+    assert type(loaded) is Plain
+    assert loaded.value == {"a": [1, 2]}
+    assert loaded._private == "not stored"
+
+
+def test_loads__slots():
+    obj = Slotted()
+    obj.value = 3
+    obj._private = 4
+    loaded = registry.loads(obj.serialise())
+    assert loaded.value == 3
+    assert not hasattr(loaded, "_private")
+
+
+def test_loads__imports_unregistered_class():
+    frozen = freeze("test_serialiser:Plain", 1, {"value": 5})
+    reg = Registry()
+    assert reg.loads(frozen).value == 5
+    assert reg.classes == {"test_serialiser:Plain": Plain}
+
+
+def test_register__type_id_not_inherited():
+    reg = Registry()
+    assert reg.register(Renamed) == "renamed"
+    assert reg.register(RenamedChild) == "test_serialiser:RenamedChild"
+
+
+def test_loads__unknown_type_id():
+    with pytest.raises(ValueError, match="Unknown type"):
+        Registry().loads(freeze("renamed", 1, {}))
+
+
+@pytest.mark.parametrize(
+    "frozen", [b"", b"\x00junk", bytes([CODEC.id]) + b"junk", freeze("x", 1, {})[:-2]]
+)
+def test_loads__invalid(frozen):
+    with pytest.raises(ValueError):
+        registry.loads(frozen)
+
+
+def test_loads__older_version__upgraded():
+    registry.register(Upgraded)
+    loaded = registry.loads(freeze("upgraded", 1, {"port_string": "22"}))
+    assert loaded.port == 22
+
+
+def test_loads__current_version__not_upgraded():
+    registry.register(Upgraded)
+    assert registry.loads(freeze("upgraded", 2, {"port": 22})).port == 22
+
+
+def test_deserialise__legacy_tuple():
+    loaded = deserialise(("test_serialiser", "Plain", json.dumps({"value": 6})))
+    assert loaded.value == 6
@@ -0,0 +1,281 @@
+"""
+Tests for the service
+"""
+import asyncio
+import json
+import socket
+import threading
+import time
+
+import pytest
+
+from regent.service import AsyncService, Operation, Service
+from regent.service.auth import Auth
+from regent.service.storage import Database
+from regent.service.throttle import Throttle
+
+
+SECRET = "secret"
+
+
+class Echo(Operation):
+    def prepare(self, data):
+        self.data = data
+
+    def perform(self):
+        return self.data
+
+
+class Raw(Operation):
+    def perform(self):
+        return b"raw"
+
+
+class Unstorable(Operation):
+    def perform(self):
+        return object()
+
+
+class SlowAuth(Auth):
+    def request(self, op):
+        time.sleep(1)
+        return "sent"
+
+
+class Guarded(Operation):
+    def auth(self):
+        return SlowAuth()
+
+
+@pytest.fixture
+def service(tmp_path):
+    service = Service(str(tmp_path / "regent.sock"), SECRET, throttle=Throttle(delay=2))
+    service.register("echo", Echo)
+    service.socket.listen()
+    thread = threading.Thread(target=service.serve, daemon=True)
+    thread.start()
+    yield service
+    service.stop()
+    thread.join(5)
+
+
+@pytest.fixture(params=[Service, AsyncService])
+def throttled(request, tmp_path):
+    service = request.param(
+        str(tmp_path / "regent.sock"),
+        SECRET,
+        throttle=Throttle(delay=0.3, max_delay=0.3),
+    )
+    service.register("echo", Echo)
+    service.socket.listen()
+    serve = service.serve
+    if request.param is AsyncService:
+        serve = lambda: asyncio.run(service.serve())  # noqa: E731
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    yield service
+    service.stop()
+    thread.join(5)
+
+
+def connect(service):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(10)
+    sock.connect(service.socket.path)
+    return sock
+
+
+def send(sock, request):
+    sock.sendall(json.dumps(request).encode() + b"\n")
+
+
+def read_lines(sock, count):
+    buffer = b""
+    while buffer.count(b"\n") < count:
+        data = sock.recv(65536)
+        if not data:
+            break
+        buffer += data
+    return [json.loads(line) for line in buffer.splitlines()]
+
+
+def test_pipelined_keepalive__without_threads__does_not_recurse(service):
+    count = 500
+    requests = b"".join(
+        json.dumps(
+            {"secret": SECRET, "op": "echo", "data": i, "keepalive": True, "id": i}
+        ).encode()
+        + b"\n"
+        for i in range(count)
+    )
+
+    sock = connect(service)
+    try:
+        sock.sendall(requests)
+        responses = read_lines(sock, count)
+    finally:
+        sock.close()
+
+    assert [response["data"] for response in responses] == list(range(count))
+    assert all(response["success"] for response in responses)
+
+
+def test_failed_secret__authenticated_connection_not_delayed(service):
+    valid = connect(service)
+    request = {"secret": SECRET, "op": "echo", "data": 1, "keepalive": True}
+    send(valid, request)
+    assert read_lines(valid, 1)[0]["data"] == 1
+
+    failing = connect(service)
+    try:
+        send(failing, {"secret": "wrong", "op": "echo", "data": 1})
+        time.sleep(0.1)
+        start = time.monotonic()
+        send(valid, dict(request, data=2))
+        assert read_lines(valid, 1)[0]["data"] == 2
+        assert time.monotonic() - start < 1
+
+        assert read_lines(failing, 1) == [{"error": "Permission denied"}]
+        assert time.monotonic() - start > 1
+    finally:
+        failing.close()
+        valid.close()
+
+
+def test_failed_secret__pipelined_guesses_checked_one_per_backoff(throttled):
+    guesses = ["wrong{}".format(i) for i in range(4)] + [SECRET]
+    requests = b"".join(
+        json.dumps(
+            {"secret": guess, "op": "echo", "data": i, "keepalive": True, "id": i}
+        ).encode()
+        + b"\n"
+        for i, guess in enumerate(guesses)
+    )
+
+    sock = connect(throttled)
+    try:
+        start = time.monotonic()
+        sock.sendall(requests)
+        found = None
+        while found is None:
+            for response in read_lines(sock, 1):
+                if response.get("success"):
+                    found = time.monotonic() - start
+    finally:
+        sock.close()
+
+    # The right secret isn't checked until the wrong ones have each had a
+    # backoff of 0.3 seconds
+    assert found >= 1.1
+
+
+def test_register__by_path__limit_applied_on_import(tmp_path):
+    service = AsyncService(str(tmp_path / "regent.sock"), SECRET)
+    service.register("echo", "test_server.Echo", limit=2)
+    assert service.lazy == {"echo": (2, False)}
+    assert service.limits == {}
+
+    operation = service.get_operation("echo")
+    assert operation is Echo
+    assert list(service.limits) == [Echo]
+    assert isinstance(service.limits[Echo], asyncio.Semaphore)
+
+
+def test_metrics__unchecked_op_names_not_labelled(tmp_path):
+    service = Service(str(tmp_path / "regent.sock"), SECRET, metrics=True)
+    service.register("echo", Echo)
+    service.socket.listen()
+    thread = threading.Thread(target=service.serve, daemon=True)
+    thread.start()
+    try:
+        for request in (
+            {"secret": "wrong", "op": ["unhashable"]},
+            {"secret": "wrong", "op": "unknown"},
+            {"secret": SECRET, "op": ["unhashable"]},
+            {"secret": SECRET, "op": "unknown"},
+            {"secret": SECRET, "op": "echo", "data": 1},
+        ):
+            sock = connect(service)
+            try:
+                send(sock, request)
+                assert read_lines(sock, 1)
+            finally:
+                sock.close()
+    finally:
+        service.stop()
+        thread.join(5)
+
+    labels = {op for _, op in service.metrics.counters}
+    labels.update(op for _, op in service.metrics.histograms)
+    assert labels == {None, "echo"}
+
+
+@pytest.mark.parametrize(
+    "cls, threads",
+    [(Service, None), (Service, 2), (AsyncService, None)],
+)
+def test_unencodable_result__reports_error(tmp_path, cls, threads):
+    service = cls(str(tmp_path / "regent.sock"), SECRET, threads=threads)
+    service.register("raw", Raw)
+    service.register("echo", Echo)
+    service.socket.listen()
+    serve = service.serve
+    if cls is AsyncService:
+        serve = lambda: asyncio.run(service.serve())  # noqa: E731
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    try:
+        sock = connect(service)
+        try:
+            send(sock, {"secret": SECRET, "op": "raw", "keepalive": True, "id": 1})
+            (response,) = read_lines(sock, 1)
+            assert response["id"] == 1
+            assert "not JSON serializable" in response["error"]
+
+            # The service is still running
+            send(sock, {"secret": SECRET, "op": "echo", "data": 2, "id": 2})
+            assert read_lines(sock, 1)[0]["data"] == 2
+        finally:
+            sock.close()
+    finally:
+        service.stop()
+        thread.join(5)
+
+
+def test_async_service__sync_auth_does_not_block_loop(tmp_path):
+    service = AsyncService(str(tmp_path / "regent.sock"), SECRET)
+    service.register("guarded", Guarded)
+    service.register("echo", Echo)
+    service.socket.listen()
+    thread = threading.Thread(target=lambda: asyncio.run(service.serve()), daemon=True)
+    thread.start()
+    try:
+        slow = connect(service)
+        fast = connect(service)
+        try:
+            send(slow, {"secret": SECRET, "op": "guarded"})
+            time.sleep(0.1)
+            start = time.monotonic()
+            send(fast, {"secret": SECRET, "op": "echo", "data": 1})
+            assert read_lines(fast, 1)[0]["data"] == 1
+            assert time.monotonic() - start < 0.5
+
+            assert read_lines(slow, 1)[0]["data"] == "sent"
+        finally:
+            slow.close()
+            fast.close()
+    finally:
+        service.stop()
+        thread.join(5)
+
+
+@pytest.mark.parametrize("cls", [Service, AsyncService])
+def test_run_job__unstorable_result__job_failed(tmp_path, cls):
+    service = cls(str(tmp_path / "regent.sock"), SECRET, db=Database(str(tmp_path)))
+    job = service.run_job("job", Unstorable())
+    if cls is AsyncService:
+        asyncio.run(job)
+
+    record = service.load_job("job")
+    assert record["status"] == "failed"
+    assert record["error"]
@@ -0,0 +1,89 @@
+"""
+Tests for reading frames from a socket
+"""
+import socket
+import threading
+
+import pytest
+
+from regent.codecs import CODECS, MsgpackCodec
+from regent.exceptions import ProcessError
+from regent.socket import LENGTH, BaseSocket, FrameReader, handshake_codec
+
+
+@pytest.fixture
+def pair():
+    left, right = socket.socketpair()
+    yield left, right
+    left.close()
+    right.close()
+
+
+def test_next_line__at_max_size(pair):
+    left, right = pair
+    reader = FrameReader(right, timeout=1, max_size=100)
+    left.sendall(b"x" * 100 + b"\n")
+    assert reader.read() == b"x" * 100
+
+
+def test_next_line__too_large_in_one_chunk(pair):
+    left, right = pair
+    reader = FrameReader(right, timeout=1, max_size=100)
+    left.sendall(b"x" * 5000 + b"\n")
+    with pytest.raises(ProcessError, match="too large"):
+        reader.read()
+
+
+def test_read__without_timeout__waits_for_data(pair):
+    left, right = pair
+    reader = FrameReader(right, timeout=None)
+    timer = threading.Timer(0.2, left.sendall, [b"late\n"])
+    timer.start()
+    try:
+        assert reader.read() == b"late"
+    finally:
+        timer.cancel()
+
+
+def test_handshake_codec__json_is_not_a_handshake():
+    for byte in b'{[" \t\n\r':
+        assert handshake_codec(byte) is None
+
+
+def test_handshake_codec__known_codec():
+    assert handshake_codec(MsgpackCodec.id) is CODECS[MsgpackCodec.id]
+
+
+def test_handshake_codec__unknown_codec():
+    with pytest.raises(ProcessError, match="Unsupported codec"):
+        handshake_codec(0x1F)
+
+
+def test_negotiate__codec__acknowledged_in_first_response(pair):
+    left, right = pair
+    codec = CODECS[MsgpackCodec.id]
+    server = BaseSocket(right, timeout=1, negotiate=True)
+
+    raw = codec.encode({"n": 1})
+    left.sendall(bytes([codec.id]) + LENGTH.pack(len(raw)) + raw)
+    assert server.read() == {"n": 1}
+
+    server.write({"n": 2})
+    server.write({"n": 3})
+    client = FrameReader(left, timeout=1)
+    assert client.peek() == codec.id
+    client.skip(1)
+    client.length_prefixed = True
+    assert codec.decode(client.read()) == {"n": 2}
+    assert codec.decode(client.read()) == {"n": 3}
+
+
+def test_negotiate__newline_json__no_handshake(pair):
+    left, right = pair
+    server = BaseSocket(right, timeout=1, negotiate=True)
+
+    left.sendall(b'{"n": 1}\n')
+    assert server.read() == {"n": 1}
+
+    server.write({"n": 2})
+    assert FrameReader(left, timeout=1).read() == b'{"n": 2}'
@@ -0,0 +1,83 @@
+"""
+Tests for the stores
+"""
+import time
+
+import pytest
+
+from regent.exceptions import DoesNotExist
+from regent.service import storage
+
+
+@pytest.fixture
+def db(tmp_path):
+    return storage.Database(str(tmp_path), ttl=60)
+
+
+def count(db, table):
+    return db.connect().execute("SELECT COUNT(*) FROM {}".format(table)).fetchone()[0]
+
+
+def age(db, uid, seconds):
+    db.connect().execute(
+        "UPDATE operations SET created=created-? WHERE uid=?", (seconds, uid)
+    )
+
+
+def test_database__ttl__expired_not_loaded(db):
+    db.save("old", b"op", b"auth")
+    age(db, "old", 120)
+    with pytest.raises(DoesNotExist):
+        db.load("old")
+
+
+def test_database__ttl__expired_deleted_on_save(db):
+    db.save("old", b"op", b"auth")
+    age(db, "old", 120)
+    db.expired -= storage.EXPIRE_INTERVAL + 1
+
+    db.save("new", b"op", b"auth")
+    assert count(db, "operations") == 1
+    assert db.load("new") == (b"op", b"auth")
+
+
+def test_database__expire(db):
+    db.save("old", b"op", b"auth")
+    age(db, "old", 30)
+    db.expire(10)
+    assert count(db, "operations") == 0
+
+
+def test_database__batch__rolled_back(db):
+    with pytest.raises(ValueError):
+        with db.batch():
+            db.save("uid", b"op", b"auth")
+            db.queue_delivery("uid", b"op", b"auth")
+            raise ValueError()
+
+    assert count(db, "operations") == 0
+    assert count(db, "outbox") == 0
+
+
+def test_database__batch__committed(db):
+    with db.batch():
+        db.save("uid", b"op", b"auth")
+        db.queue_delivery("uid", b"op", b"auth")
+
+    assert db.load_delivery("uid")["status"] == "pending"
+    assert db.load("uid") == (b"op", b"auth")
+
+
+def test_memory__batch():
+    db = storage.Memory()
+    with db.batch():
+        db.save("uid", b"op", b"auth")
+    assert db.load("uid") == (b"op", b"auth")
+
+
+def test_memory__ttl():
+    db = storage.Memory(ttl=0.01)
+    db.save("uid", b"op", b"auth")
+    time.sleep(0.02)
+    with pytest.raises(DoesNotExist):
+        db.load("uid")
@@ -0,0 +1,35 @@
+"""
+Tests for throttling failed secret checks
+"""
+import pytest
+
+from regent.service.throttle import Throttle
+
+
+def test_failed__backs_off_per_user():
+    throttle = Throttle(delay=1, max_delay=4)
+    assert [throttle.failed((100, 33, 33)) for _ in range(3)] == [1, 2, 4]
+
+    # Forking doesn't reset the backoff
+    assert throttle.failed((101, 33, 33)) == 4
+
+    # Other users are not affected
+    assert throttle.failed((102, 1000, 1000)) == 1
+
+
+def test_wait__not_backed_off():
+    throttle = Throttle(delay=1)
+    assert throttle.wait((100, 33, 33)) == 0
+
+
+def test_wait__checks_spaced_by_backoff():
+    throttle = Throttle(delay=1)
+    peer = (100, 33, 33)
+    throttle.failed(peer)
+
+    holds = [throttle.wait(peer) for _ in range(3)]
+    assert holds == pytest.approx([1, 2, 3], abs=0.1)
+
+    # A failure doesn't move checks which have been reserved
+    assert throttle.failed(peer) == 2
+    assert throttle.wait(peer) == pytest.approx(6, abs=0.1)